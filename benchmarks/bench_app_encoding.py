@@ -0,0 +1,61 @@
+"""
+Application-layer encoding of chat messages: JSON against the compact binary
+encoding. For each content size it reports the mean payload size and the CPU
+microseconds per message to encode and to decode (the receive side decodes
+straight from the bytes the presentation layer returns).
+
+    python benchmarks/bench_app_encoding.py
+    python benchmarks/bench_app_encoding.py --sizes 20 200 --repeat 50000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from application_layer import ApplicationLayer
+
+SENDERS = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+DEFAULT_SIZES = [20, 100, 1000]
+
+def messages(size: int, count: int = 256) -> list:
+    rng = random.Random(size)
+    start = 1735732800
+    return [{"sender": rng.choice(SENDERS),
+             "content": "".join(rng.choice("abcdefghij klmnop") for _ in range(size)),
+             "timestamp": time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * 37))}
+            for i in range(count)]
+
+def measure(layer: ApplicationLayer, objs: list, repeat: int):
+    """Mean (payload bytes, encode us, decode us) per message."""
+    encoded = [layer.encapsulate(obj) for obj in objs]
+    rounds = max(1, repeat // len(objs))
+    start = time.process_time()
+    for _ in range(rounds):
+        for obj in objs:
+            layer.encapsulate(obj)
+    middle = time.process_time()
+    for _ in range(rounds):
+        for data in encoded:
+            layer.decode(data)
+    end = time.process_time()
+    count = rounds * len(objs)
+    return (sum(map(len, encoded)) / len(encoded), (middle - start) / count * 1e6, (end - middle) / count * 1e6)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES, help="content sizes in characters")
+    parser.add_argument("--repeat", type=int, default=20000, help="messages encoded and decoded per measurement")
+    args = parser.parse_args()
+
+    print(f"{'content':>8} {'encoding':>9} {'bytes':>7} {'enc us':>7} {'dec us':>7}")
+    for size in args.sizes:
+        objs = messages(size)
+        for encoding in ("json", "binary"):
+            payload, encode_us, decode_us = measure(ApplicationLayer(encoding=encoding), objs, args.repeat)
+            print(f"{size:>8} {encoding:>9} {payload:>7.1f} {encode_us:>7.2f} {decode_us:>7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+Cost of capturing frames, and replay throughput.
+
+A frame is built by the server's own send path and received through every
+layer up to delivery, by a server without a capture and by one recording
+every frame into a memory-mapped ring (see osi/capture.py). Also reported is
+the cost of FrameCapture.record alone, and how fast replay.py feeds the
+captured frames back in as fast as possible.
+
+    python benchmarks/bench_capture.py
+    python benchmarks/bench_capture.py --wire-format binary --sizes 100 65536
+"""
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from cryptography.fernet import Fernet
+
+from capture import CaptureReader, FrameCapture, CAPTURE_IN
+from osi_server import OSIServer
+from replay import Replay, load_frames, replay_server
+
+LOOPBACK_IP = "127.0.0.1"
+DEFAULT_SIZES = [100, 16 * 1024, 1024 * 1024]
+SESSION_ID = str(uuid.uuid4())
+
+def build_server(wire_format: str, key: bytes, capture_path: str = None) -> OSIServer:
+    server = OSIServer(host=LOOPBACK_IP, port=0, wire_format=wire_format, arp_listener=False, ip=LOOPBACK_IP,
+                       presentation_key=key, capture_path=capture_path, capture_size=64 * 1024 * 1024)
+    server.data_link_layer.arp_table.learn(LOOPBACK_IP, server.data_link_layer.mac)
+    server.session_layer.store_session(LOOPBACK_IP, SESSION_ID)
+    server.app_layer.process_message = lambda message_obj, transport_port=None: None
+    return server
+
+def time_per_call(fn, arg, repeat: int) -> float:
+    """Mean microseconds per fn(arg)."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return (time.perf_counter() - start) / repeat * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="text")
+    parser.add_argument("--bytes-per-size", type=int, default=32 * 1024 * 1024,
+                        help="frame bytes processed per measurement")
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    directory = tempfile.mkdtemp()
+    plain = build_server(args.wire_format, key)
+    print(f"{'size':>9} {'receive us':>11} {'captured us':>12} {'record us':>10} {'replay MB/s':>12}")
+    for size in args.sizes:
+        path = os.path.join(directory, f"{size}.cap")
+        captured = build_server(args.wire_format, key, path)
+        content = base64.b64encode(os.urandom(size * 3 // 4 + 1)).decode("ascii")[:size]
+        payload = plain.encode_payload({"sender": "bench", "content": content})
+        frame = plain.encapsulate_frame(payload, LOOPBACK_IP, 3000).tobytes()
+        repeat = max(10, args.bytes_per_size // len(frame) // 10)
+
+        receive_us = time_per_call(lambda raw: plain.process_received_data(raw, None), frame, repeat)
+        captured_us = time_per_call(lambda raw: captured.process_received_data(raw, None), frame, repeat)
+        captured.capture.close()
+        ring = FrameCapture(os.path.join(directory, "record.cap"), 64 * 1024 * 1024)
+        record_us = time_per_call(lambda raw: ring.record(CAPTURE_IN, raw), frame, repeat)
+        ring.close()
+
+        reader = CaptureReader(path)
+        replay = Replay(replay_server(reader, key), load_frames(reader))
+        reader.close()
+        results = replay.run(speed=0)
+        print(f"{size:>9} {receive_us:>11.1f} {captured_us:>12.1f} {record_us:>10.2f} "
+              f"{results['bytes'] / 1e6 / results['seconds']:>12.1f}")
+        os.remove(path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Memory and threads of a server holding many idle chat client connections.
+
+A server is started in its own process, then the benchmark opens connections
+to it in steps, registering each as a chat client, and reads the server's
+resident set size and thread count from /proc after every step. Compare the
+asyncio engine (one event loop) with the threaded engine (a thread per
+connection).
+
+Each connection uses a file descriptor on both sides, so the open-file limit
+is raised to its hard limit first; 10,000 connections need a hard limit above
+that (ulimit -Hn). Linux only.
+
+    python benchmarks/bench_connections.py
+    python benchmarks/bench_connections.py --engine threaded --connections 1000 2000
+"""
+import argparse
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+OSI_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi", "osi_server.py")
+sys.path.insert(0, os.path.dirname(OSI_SERVER))
+
+from framing import recv_frame, send_frame
+
+LOOPBACK_IP = "127.0.0.1"
+DEFAULT_CONNECTIONS = [1000, 5000, 10000]
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((LOOPBACK_IP, 0))
+        return s.getsockname()[1]
+
+def process_status(pid: int) -> dict:
+    """Resident set size in MB and thread count of a process."""
+    status = {}
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            status[key] = value.strip()
+    return {"rss_mb": int(status["VmRSS"].split()[0]) / 1024, "threads": int(status["Threads"])}
+
+def wait_for_server(port: int, timeout: float = 10.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection((LOOPBACK_IP, port)).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+def connect_client(port: int, listening_port: int) -> socket.socket:
+    """A connection registered as a chat client, as chat_app.py does."""
+    conn = socket.create_connection((LOOPBACK_IP, port))
+    send_frame(conn, json.dumps({"type": "register", "port": listening_port}).encode("utf-8"))
+    if recv_frame(conn) != b"ACK":
+        raise Exception("Registration was not acknowledged")
+    return conn
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--engine", choices=("asyncio", "threaded"), default="asyncio")
+    parser.add_argument("--connections", nargs="+", type=int, default=DEFAULT_CONNECTIONS,
+                        help="idle connections open at each measurement")
+    args = parser.parse_args()
+
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    # Both ends of every connection live on this host, each with its own descriptor.
+    if hard != resource.RLIM_INFINITY and max(args.connections) + 100 > hard:
+        parser.error(f"the open-file hard limit ({hard}) is too low for {max(args.connections)} connections")
+
+    port = free_port()
+    server = subprocess.Popen([sys.executable, OSI_SERVER, "--port", str(port), "--engine", args.engine],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    clients = []
+    try:
+        wait_for_server(port)
+        time.sleep(0.5)
+        baseline = process_status(server.pid)
+        print(f"{args.engine} engine, idle: {baseline['rss_mb']:.1f} MB RSS, {baseline['threads']} threads")
+        print(f"{'conns':>7} {'connect s':>10} {'RSS MB':>8} {'KB/conn':>8} {'threads':>8}")
+        for target in sorted(args.connections):
+            start = time.perf_counter()
+            while len(clients) < target:
+                clients.append(connect_client(port, 10000 + len(clients)))
+            elapsed = time.perf_counter() - start
+            time.sleep(0.5)
+            status = process_status(server.pid)
+            per_conn = (status["rss_mb"] - baseline["rss_mb"]) * 1024 / target
+            print(f"{target:>7} {elapsed:>10.2f} {status['rss_mb']:>8.1f} {per_conn:>8.1f} {status['threads']:>8}")
+    finally:
+        for conn in clients:
+            conn.close()
+        server.kill()
+        server.wait()
+
+if __name__ == "__main__":
+    main()
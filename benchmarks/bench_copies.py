@@ -0,0 +1,103 @@
+"""
+Payload copies made while a message goes down the stack and onto a socket.
+
+Each step (every layer's encapsulation, then the send) is run under tracemalloc
+and its peak allocation is divided by the payload size; the sum over the steps
+is the number of payload copies made in Python. The copy into the kernel is
+counted separately. Four send paths are compared:
+
+  bytes chain   every layer does header + data on bytes (the original path)
+  joined cache  cached headers joined with the payload into one bytes object
+  packet chain  every layer adds its header to a PacketBuffer
+  packet cache  cached headers added to a PacketBuffer (the default path)
+
+    python benchmarks/bench_copies.py
+    python benchmarks/bench_copies.py --wire-format binary
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from framing import send_frame
+from osi_server import OSIServer
+from packet_buffer import PacketBuffer
+
+LOOPBACK_IP = "127.0.0.1"
+DEFAULT_SIZES = [16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+def build_server(wire_format: str) -> OSIServer:
+    server = OSIServer(host=LOOPBACK_IP, port=0, wire_format=wire_format, arp_listener=False)
+    server.ip = server.network_layer.src_ip = LOOPBACK_IP
+    server.data_link_layer.arp_table.learn(LOOPBACK_IP, server.data_link_layer.mac)
+    server.session_layer.store_session(LOOPBACK_IP, str(uuid.uuid4()))
+    return server
+
+def layer_steps(server: OSIServer, binary: bool) -> list:
+    """The per-layer encapsulation steps, each taking the previous step's output."""
+    if binary:
+        return [
+            lambda data: server.session_layer.encapsulate_binary(data, LOOPBACK_IP),
+            lambda data: server.transport_layer.encapsulate_binary(data, 3000),
+            lambda data: server.network_layer.encapsulate_binary(data, LOOPBACK_IP),
+            lambda data: server.data_link_layer.encapsulate_binary(data, LOOPBACK_IP),
+        ]
+    return [
+        lambda data: server.session_layer.encapsulate(data, LOOPBACK_IP),
+        lambda data: server.transport_layer.encapsulate(data, 3000),
+        lambda data: server.network_layer.encapsulate(data, LOOPBACK_IP),
+        lambda data: server.data_link_layer.encapsulate(data, LOOPBACK_IP),
+    ]
+
+def paths(server: OSIServer, binary: bool) -> dict:
+    cache = server.header_cache
+    return {
+        "bytes chain": layer_steps(server, binary),
+        "joined cache": [lambda data: cache.frame(data, LOOPBACK_IP, 3000).tobytes()],
+        "packet chain": [PacketBuffer] + layer_steps(server, binary),
+        "packet cache": [lambda data: cache.frame(data, LOOPBACK_IP, 3000)],
+    }
+
+def drain(sock: socket.socket):
+    buf = bytearray(1024 * 1024)
+    while sock.recv_into(buf):
+        pass
+
+def count_copies(steps: list, payload: bytes, sock: socket.socket) -> float:
+    """Sum of each step's peak allocation, in payload sizes."""
+    allocated = 0
+    data = payload
+    tracemalloc.start()
+    for step in steps + [lambda frame: send_frame(sock, frame)]:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        data = step(data)
+        allocated += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return allocated / len(payload)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="text")
+    args = parser.parse_args()
+
+    server = build_server(args.wire_format)
+    sender, receiver = socket.socketpair()
+    threading.Thread(target=drain, args=(receiver,), daemon=True).start()
+    print(f"{'size':>9} {'path':>13} {'python copies':>14} {'with kernel':>12}")
+    for size in args.sizes:
+        # Text frames carry base64 text, so the payload is ASCII in both formats.
+        payload = os.urandom(size // 2).hex().encode("ascii")
+        for name, steps in paths(server, args.wire_format == "binary").items():
+            copies = count_copies(steps, payload, sender)
+            print(f"{size:>9} {name:>13} {copies:>14.2f} {copies + 1:>12.2f}")
+    sender.close()
+
+if __name__ == "__main__":
+    main()
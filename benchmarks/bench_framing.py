@@ -0,0 +1,79 @@
+"""
+Receive-loop throughput: the original recv(1024)-per-message loop against the
+length-prefixed StreamBuffer used by OSIServer.handle_client.
+
+The original loop cannot delimit messages, so it is measured as raw bytes read
+per second; it is the upper bound the framed loop should stay close to.
+
+    python benchmarks/bench_framing.py --total-mb 256
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from framing import StreamBuffer, send_frame
+
+SIZES = [64, 1024, 64 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+
+def _writer(sock: socket.socket, payload: bytes, count: int, framed: bool):
+    for _ in range(count):
+        if framed:
+            send_frame(sock, payload)
+        else:
+            sock.sendall(payload)
+    sock.shutdown(socket.SHUT_WR)
+
+def original_loop(conn: socket.socket) -> int:
+    chunks = 0
+    while True:
+        data = conn.recv(1024)
+        if not data:
+            return chunks
+        chunks += 1
+
+def framed_loop(conn: socket.socket) -> int:
+    buffer = StreamBuffer()
+    messages = 0
+    while True:
+        batch = buffer.read_from(conn)
+        if batch is None:
+            return messages
+        messages += len(batch)
+
+def run(size: int, total_bytes: int, framed: bool):
+    count = max(1, total_bytes // size)
+    payload = os.urandom(size)
+    reader, writer = socket.socketpair()
+    thread = threading.Thread(target=_writer, args=(writer, payload, count, framed))
+    start = time.perf_counter()
+    thread.start()
+    received = framed_loop(reader) if framed else original_loop(reader)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    reader.close()
+    writer.close()
+    if framed and received != count:
+        raise RuntimeError(f"expected {count} messages, reassembled {received}")
+    return count, elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--total-mb", type=int, default=128, help="bytes sent per measurement")
+    args = parser.parse_args()
+    total = args.total_mb * 1024 * 1024
+
+    print(f"{'size':>10} {'loop':>10} {'msgs/s':>12} {'MB/s':>10}")
+    for size in SIZES:
+        for framed in (False, True):
+            count, elapsed = run(size, total, framed)
+            mb = count * size / (1024 * 1024)
+            label = "framed" if framed else "original"
+            print(f"{size:>10} {label:>10} {count / elapsed:>12.0f} {mb / elapsed:>10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Sending one message to many destinations: send_message once per destination
+against send_group, which encodes the message once.
+
+The physical layer is replaced by a no-op, so the time measured is the sender's
+own work: serialization, compression and encryption, then the lower-layer
+framing for each destination. Every destination has a session and ARP entry
+already, so no handshakes are timed.
+
+    python benchmarks/bench_group_send.py
+    python benchmarks/bench_group_send.py --destinations 2 8 32 --sizes 100 65536
+"""
+import argparse
+import base64
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from osi_server import OSIServer
+
+LOOPBACK_IP = "127.0.0.1"
+DEFAULT_SIZES = [100, 16 * 1024, 256 * 1024]
+DEFAULT_DESTINATIONS = [4, 16, 64]
+
+def build_server(wire_format: str, destinations: int) -> OSIServer:
+    server = OSIServer(host=LOOPBACK_IP, port=0, wire_format=wire_format, arp_listener=False, ip=LOOPBACK_IP)
+    for i in range(destinations):
+        ip = f"10.0.{i // 256}.{i % 256}"
+        server.data_link_layer.arp_table.learn(ip, server.data_link_layer.mac)
+        server.session_layer.store_session(ip, str(uuid.uuid4()))
+    server.physical_layer.transmit = lambda data, ip, port, stream=None: True
+    server.transmit_segments = lambda msg_id, frames, ip, stream=None: True
+    return server
+
+def time_per_call(fn, repeat: int) -> float:
+    """Mean milliseconds per fn()."""
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e3
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--destinations", nargs="+", type=int, default=DEFAULT_DESTINATIONS)
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="text")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    server = build_server(args.wire_format, max(args.destinations))
+    print(f"{'size':>9} {'dests':>6} {'send_message ms':>16} {'send_group ms':>14} {'speedup':>8}")
+    for size in args.sizes:
+        content = base64.b64encode(os.urandom(size * 3 // 4 + 1)).decode("ascii")[:size]
+        message = {"sender": "bench", "content": content}
+        for count in args.destinations:
+            destinations = [(f"10.0.{i // 256}.{i % 256}", 3000) for i in range(count)]
+            each_ms = time_per_call(lambda: [server.send_message(ip, port, message) for ip, port in destinations],
+                                    args.repeat)
+            group_ms = time_per_call(lambda: server.send_group(destinations, message), args.repeat)
+            print(f"{size:>9} {count:>6} {each_ms:>16.2f} {group_ms:>14.2f} {each_ms / group_ms:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
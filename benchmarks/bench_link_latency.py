@@ -0,0 +1,105 @@
+"""
+One-way latency of small chat messages over the TCP, UDP and mux link modes.
+
+A server sends messages to itself on the loopback address, one at a time, and
+each message's latency is measured from send_message to delivery. Four links
+are compared:
+
+  tcp          frames over a pooled TCP connection (the default)
+  tcp-connect  a new TCP connection for every message, as before pooling
+  udp          one datagram per frame, acknowledged by the transport layer
+  mux          frames queued on one multiplexed TCP connection, written by its thread
+
+    python benchmarks/bench_link_latency.py
+    python benchmarks/bench_link_latency.py --size 100 --messages 5000 --wire-format binary
+"""
+import argparse
+import base64
+import os
+import socket
+import sys
+import threading
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from osi_server import OSIServer
+
+LOOPBACK_IP = "127.0.0.1"
+LINKS = ("tcp", "tcp-connect", "udp", "mux")
+
+def free_port() -> int:
+    # The UDP link binds the same port number as the TCP listener.
+    with socket.socket() as s:
+        s.bind((LOOPBACK_IP, 0))
+        return s.getsockname()[1]
+
+def build_server(link: str, wire_format: str) -> OSIServer:
+    """A started server that talks to itself on the loopback address, with ARP and session pre-seeded."""
+    server = OSIServer(host=LOOPBACK_IP, port=free_port(), wire_format=wire_format, arp_listener=False,
+                       ip=LOOPBACK_IP, link_mode="tcp" if link == "tcp-connect" else link)
+    server.data_link_layer.arp_table.learn(LOOPBACK_IP, server.data_link_layer.mac)
+    server.session_layer.store_session(LOOPBACK_IP, str(uuid.uuid4()))
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.2)
+    return server
+
+class Delivery:
+    """Stands in for ApplicationLayer.process_message and signals each delivery."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.delivered_ns = 0
+
+    def __call__(self, message_obj, transport_port=None):
+        self.delivered_ns = time.perf_counter_ns()
+        self.event.set()
+
+def percentile(sorted_values, fraction: float) -> float:
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure(server: OSIServer, link: str, content: str, messages: int, warmup: int) -> list:
+    """Latencies in microseconds of messages sent one after another."""
+    delivery = Delivery()
+    server.app_layer.process_message = delivery
+    latencies = []
+    for i in range(warmup + messages):
+        delivery.event.clear()
+        start = time.perf_counter_ns()
+        server.send_message(LOOPBACK_IP, 3000, {"sender": "bench", "content": content})
+        if not delivery.event.wait(timeout=5):
+            continue  # Lost for good; counted as undelivered.
+        if i >= warmup:
+            latencies.append((delivery.delivered_ns - start) / 1000)
+        if link == "tcp-connect":
+            # Close the pooled connection so the next message connects again.
+            server.physical_layer.close()
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--links", nargs="+", choices=LINKS, default=list(LINKS))
+    parser.add_argument("--size", type=int, default=100, help="bytes of content per message")
+    parser.add_argument("--messages", type=int, default=2000)
+    parser.add_argument("--warmup", type=int, default=50)
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="text")
+    args = parser.parse_args()
+
+    content = base64.b64encode(os.urandom(args.size)).decode("ascii")[:args.size]
+    results = []
+    for link in args.links:
+        server = build_server(link, args.wire_format)
+        results.append((link, measure(server, link, content, args.messages, args.warmup)))
+    print(f"{'link':>12} {'delivered':>10} {'mean us':>9} {'p50 us':>8} {'p99 us':>8} {'p999 us':>8}")
+    for link, latencies in results:
+        latencies.sort()
+        if not latencies:
+            print(f"{link:>12} {0:>10}")
+            continue
+        print(f"{link:>12} {len(latencies):>10} {sum(latencies) / len(latencies):>9.0f} "
+              f"{percentile(latencies, 0.5):>8.0f} {percentile(latencies, 0.99):>8.0f} "
+              f"{percentile(latencies, 0.999):>8.0f}")
+
+if __name__ == "__main__":
+    main()
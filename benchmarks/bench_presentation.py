@@ -0,0 +1,70 @@
+"""
+CPU cost and wire size of each presentation profile.
+
+For every profile and payload kind, reports CPU milliseconds per MB to encode
+and decode and the bytes on the wire per message, for text frames (base64)
+and binary frames (raw).
+
+    python benchmarks/bench_presentation.py
+"""
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from cryptography.fernet import Fernet
+
+from presentation_layer import PresentationLayer, PROFILES
+
+def chat_message() -> str:
+    return json.dumps({"sender": "alice", "content": "see you at noon?", "timestamp": "2025-01-01 12:00:00"})
+
+def payloads() -> dict:
+    text = " ".join(f"word{i % 500}" for i in range(200000))
+    return {
+        "chat_100B": chat_message(),
+        "text_16KB": text[:16 * 1024],
+        "text_1MB": text[:1024 * 1024],
+        "random_1MB": base64.b64encode(os.urandom(768 * 1024)).decode("ascii"),
+    }
+
+def measure(layer: PresentationLayer, data: str, binary: bool, min_seconds: float):
+    """Return (encode CPU ms per MB, decode CPU ms per MB, wire bytes per message)."""
+    encoded = layer.encapsulate(data, binary)
+    iterations = 0
+    encode_cpu = decode_cpu = 0.0
+    while encode_cpu + decode_cpu < min_seconds:
+        start = time.process_time()
+        encoded = layer.encapsulate(data, binary)
+        middle = time.process_time()
+        layer.decapsulate(encoded, binary)
+        encode_cpu += middle - start
+        decode_cpu += time.process_time() - middle
+        iterations += 1
+    mb = iterations * len(data) / (1024 * 1024)
+    return encode_cpu * 1000 / mb, decode_cpu * 1000 / mb, len(encoded)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--seconds", type=float, default=0.5, help="minimum CPU time per measurement")
+    args = parser.parse_args()
+
+    key = Fernet.generate_key()
+    print(f"{'':>31} {'---- text frames ----':>31} {'--- binary frames ---':>31}")
+    print(f"{'payload':>11} {'profile':>9} {'input B':>9} "
+          + f"{'enc ms/MB':>10} {'dec ms/MB':>10} {'wire B':>9} " * 2)
+    for name, data in payloads().items():
+        for profile_name, profile in PROFILES.items():
+            layer = PresentationLayer(key, profile)
+            row = f"{name:>11} {profile_name:>9} {len(data):>9} "
+            for binary in (False, True):
+                enc, dec, size = measure(layer, data, binary, args.seconds)
+                row += f"{enc:>10.1f} {dec:>10.1f} {size:>9} "
+            print(row)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Throughput of presentation encode + decode for multi-MB payloads as the
+presentation pool grows.
+
+Several sender threads (standing in for connection threads) each encode and
+decode their share of the payloads. Workers 0 runs the presentation layer on
+the sender threads, as the server does without --presentation-workers. The
+speedup is relative to that row; it cannot exceed the number of CPU cores.
+
+    python benchmarks/bench_presentation_pool.py
+    python benchmarks/bench_presentation_pool.py --workers 0 1 2 4 8 --mode thread
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from cryptography.fernet import Fernet
+
+from presentation_layer import PresentationLayer, PROFILES
+from presentation_pool import PresentationPool
+
+def make_payload(size: int) -> str:
+    """Moderately compressible text, so zlib does real work."""
+    words = " ".join(f"word{i % 997}:{i * 7919 % 10007}" for i in range(size // 8))
+    return words[:size]
+
+def run(layer: PresentationLayer, pool: PresentationPool, payload: str, messages: int,
+        senders: int, binary: bool) -> float:
+    """Seconds to encode and decode messages payloads from senders threads."""
+    def send(_):
+        if pool is None:
+            layer.decapsulate(layer.encapsulate(payload, binary), binary)
+        else:
+            pool.decode(pool.encode(payload, binary), binary)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=senders) as executor:
+        list(executor.map(send, range(messages)))
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", nargs="+", type=int,
+                        default=sorted({0, 1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument("--mode", choices=("process", "thread"), default="process")
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="aesgcm")
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024, help="payload bytes")
+    parser.add_argument("--messages", type=int, default=32)
+    parser.add_argument("--senders", type=int, default=8, help="concurrent sender threads")
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="binary")
+    args = parser.parse_args()
+
+    layer = PresentationLayer(Fernet.generate_key(), PROFILES[args.profile])
+    payload = make_payload(args.size)
+    binary = args.wire_format == "binary"
+    total_mb = args.messages * args.size / (1024 * 1024)
+    print(f"{os.cpu_count()} CPUs, {args.mode} pool, {args.profile}, "
+          f"{args.messages} x {args.size} B from {args.senders} senders")
+    print(f"{'workers':>8} {'seconds':>9} {'MB/s':>9} {'speedup':>8}")
+    base = None
+    for workers in args.workers:
+        pool = PresentationPool(layer, workers, mode=args.mode) if workers else None
+        if pool is not None:
+            # Start the workers before timing.
+            for future in [pool.executor.submit(sum, [0]) for _ in range(workers)]:
+                future.result()
+        seconds = run(layer, pool, payload, args.messages, args.senders, binary)
+        if pool is not None:
+            pool.close()
+        base = base or seconds
+        print(f"{workers:>8} {seconds:>9.2f} {total_mb / seconds:>9.1f} {base / seconds:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Longest-prefix-match lookup time as the routing table grows.
+
+Each table holds random prefixes of length 8 to 32 plus a default route, and
+is queried with random addresses, half of them inside a known prefix. Lookup
+cost depends on the number of distinct prefix lengths, not on the number of
+routes, so the time per lookup should stay flat from 1k to 100k routes. A
+linear scan over the routes is shown for the smaller tables for comparison.
+
+    python benchmarks/bench_routing.py
+    python benchmarks/bench_routing.py --routes 1000 100000 1000000 --lookups 500000
+"""
+import argparse
+import os
+import random
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from network_layer import RoutingTable
+
+def random_prefixes(rng: random.Random, count: int) -> list:
+    prefixes = []
+    for _ in range(count):
+        length = rng.randint(8, 32)
+        network = rng.getrandbits(32) >> (32 - length) << (32 - length)
+        prefixes.append((network, length))
+    return prefixes
+
+def to_ip(address: int) -> str:
+    return socket.inet_ntoa(address.to_bytes(4, "big"))
+
+def linear_lookup(routes: list, address: int):
+    """The longest matching prefix by scanning every route."""
+    best, best_length = None, -1
+    for network, length, next_hop in routes:
+        if length > best_length and address >> (32 - length) == network >> (32 - length):
+            best, best_length = next_hop, length
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--routes", nargs="+", type=int, default=[1000, 10000, 100000])
+    parser.add_argument("--lookups", type=int, default=200000)
+    parser.add_argument("--linear-limit", type=int, default=10000,
+                        help="only time the linear scan for tables up to this size")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'routes':>8} {'insert s':>9} {'ns/lookup':>10} {'linear ns':>10}")
+    for count in args.routes:
+        rng = random.Random(args.seed)
+        prefixes = random_prefixes(rng, count)
+        table = RoutingTable()
+        start = time.perf_counter()
+        table.add_route("0.0.0.0/0", "192.168.0.1")
+        for index, (network, length) in enumerate(prefixes):
+            table.add_route(f"{to_ip(network)}/{length}", to_ip(index + 1))
+        insert_seconds = time.perf_counter() - start
+
+        addresses = []
+        for _ in range(args.lookups):
+            if rng.random() < 0.5:
+                network, length = rng.choice(prefixes)
+                addresses.append(network | rng.getrandbits(32 - length) if length < 32 else network)
+            else:
+                addresses.append(rng.getrandbits(32))
+        ips = [to_ip(address) for address in addresses]
+
+        lookup = table.lookup
+        start = time.perf_counter()
+        for ip in ips:
+            lookup(ip)
+        lookup_ns = (time.perf_counter() - start) / len(ips) * 1e9
+
+        linear = "-"
+        if count <= args.linear_limit:
+            routes = [(network, length, index) for index, (network, length) in enumerate(prefixes)]
+            sample = addresses[:max(1, args.lookups // 100)]
+            start = time.perf_counter()
+            for address in sample:
+                linear_lookup(routes, address)
+            linear = f"{(time.perf_counter() - start) / len(sample) * 1e9:.0f}"
+        print(f"{count:>8} {insert_seconds:>9.2f} {lookup_ns:>10.0f} {linear:>10}")
+
+if __name__ == "__main__":
+    main()
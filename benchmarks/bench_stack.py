@@ -0,0 +1,218 @@
+"""
+End-to-end benchmark of the seven-layer stack: OSIServer.send_message through
+process_received_data to delivery, for a range of payload sizes and sender
+concurrency.
+
+Two transports are measured:
+  inprocess  the physical layer hands frames straight to process_received_data
+  loopback   frames go over TCP to the server's own listening socket
+
+For every configuration the report has msgs/sec, MB/sec, p50/p99/p999
+end-to-end latency and the per-layer stage timings from the server's tracer.
+Each layer's peak allocation for one message (tracemalloc) and the process's
+peak RSS are reported per payload size. Results are written as JSON. Pass
+--baseline with an earlier result file to print the change per configuration.
+With --no-header-cache every message runs each layer's encapsulation, so the
+send side reports send.session, send.transport, send.network and
+send.datalink stages instead of only send.headers.
+
+    python benchmarks/bench_stack.py --output results.json
+    python benchmarks/bench_stack.py --baseline results.json --output new.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from osi_server import OSIServer
+from tracing import Tracer
+
+LOOPBACK_IP = "127.0.0.1"
+DEFAULT_SIZES = [64, 1024, 16 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]
+DEFAULT_CONCURRENCY = [1, 4, 16]
+# Bytes of payload sent per configuration; small payloads are capped by --max-messages.
+BYTES_PER_RUN = 64 * 1024 * 1024
+
+def make_content(size: int) -> str:
+    """Incompressible text of roughly size bytes, so compression does not flatter the numbers."""
+    return base64.b64encode(os.urandom(max(1, size * 3 // 4))).decode("ascii")[:size]
+
+def build_server(port: int, wire_format: str, cache_headers: bool = True) -> OSIServer:
+    """A server that talks to itself on the loopback address, with ARP and session pre-seeded."""
+    server = OSIServer(host=LOOPBACK_IP, port=port, wire_format=wire_format, arp_listener=False,
+                       cache_headers=cache_headers)
+    server.ip = server.network_layer.src_ip = LOOPBACK_IP
+    server.data_link_layer.arp_table.learn(LOOPBACK_IP, server.data_link_layer.mac)
+    server.session_layer.store_session(LOOPBACK_IP, str(uuid.uuid4()))
+    return server
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind((LOOPBACK_IP, 0))
+        return s.getsockname()[1]
+
+class Recorder:
+    """Stands in for ApplicationLayer.process_message and records end-to-end latency."""
+
+    def __init__(self, expected: int):
+        self.latencies = []
+        self.expected = expected
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, message_obj, transport_port=None):
+        latency = time.perf_counter_ns() - message_obj["sent_ns"]
+        with self._lock:
+            self.latencies.append(latency)
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+def percentile(sorted_values, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+def run_config(server: OSIServer, size: int, concurrency: int, count: int) -> dict:
+    content = make_content(size)
+    recorder = Recorder(count)
+    server.app_layer.process_message = recorder
+    server.tracer = Tracer()
+
+    def send(_):
+        server.send_message(LOOPBACK_IP, 3000, {"sender": "bench", "content": content,
+                                                "sent_ns": time.perf_counter_ns()})
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(count)))
+    recorder.done.wait(timeout=120)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(recorder.latencies)
+    received = len(latencies)
+    return {
+        "size": size,
+        "concurrency": concurrency,
+        "messages": count,
+        "received": received,
+        "msgs_per_sec": received / elapsed,
+        "mb_per_sec": received * size / elapsed / (1024 * 1024),
+        "latency_us": {
+            "p50": percentile(latencies, 0.50) / 1000,
+            "p99": percentile(latencies, 0.99) / 1000,
+            "p999": percentile(latencies, 0.999) / 1000,
+        },
+        "stages": server.stats()["stages"],
+    }
+
+def layer_memory(server: OSIServer, size: int) -> dict:
+    """Peak bytes allocated by each layer while one message goes down and back up the stack."""
+    frames = []
+    delivered = []
+    server.app_layer.process_message = lambda message_obj, transport_port=None: delivered.append(message_obj)
+    message_obj = {"sender": "bench", "content": make_content(size), "sent_ns": 0}
+    binary = server.wire_format == "binary"
+    steps = [
+        ("application", lambda: server.app_layer.encapsulate(message_obj)),
+        ("presentation", lambda data: server.presentation_layer.encapsulate(data, binary)),
+        ("headers", lambda data: server.encapsulate_frame(data, LOOPBACK_IP, 3000)),
+        ("receive_chain", lambda frame: frames.append(frame) or server.process_received_data(bytes(frame), None)),
+    ]
+    peaks = {}
+    data = None
+    tracemalloc.start()
+    for name, step in steps:
+        tracemalloc.reset_peak()
+        baseline = tracemalloc.get_traced_memory()[0]
+        data = step() if data is None else step(data)
+        peaks[name] = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    # Peaks of a message that failed to decode would measure an error path.
+    if delivered != [message_obj]:
+        raise Exception(f"The {size}-byte message was not delivered by the receive chain")
+    return peaks
+
+def compare(results: dict, baseline: dict):
+    old = {(r["mode"], r["size"], r["concurrency"]): r for r in baseline["runs"]}
+    print(f"\n{'mode':>10} {'size':>9} {'conc':>5} {'msgs/s':>10} {'vs base':>8} {'p99 us':>10} {'vs base':>8}")
+    for run in results["runs"]:
+        before = old.get((run["mode"], run["size"], run["concurrency"]))
+        if before is None:
+            continue
+        speed = run["msgs_per_sec"] / before["msgs_per_sec"] if before["msgs_per_sec"] else 0
+        p99 = run["latency_us"]["p99"] / before["latency_us"]["p99"] if before["latency_us"]["p99"] else 0
+        print(f"{run['mode']:>10} {run['size']:>9} {run['concurrency']:>5} {run['msgs_per_sec']:>10.0f} "
+              f"{speed:>7.2f}x {run['latency_us']['p99']:>10.0f} {p99:>7.2f}x")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", choices=("inprocess", "loopback"), default=["inprocess", "loopback"])
+    parser.add_argument("--sizes", nargs="+", type=int, default=DEFAULT_SIZES)
+    parser.add_argument("--concurrency", nargs="+", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="text")
+    parser.add_argument("--no-header-cache", action="store_true",
+                        help="build every layer's header per message, timing each layer separately")
+    parser.add_argument("--max-messages", type=int, default=2000)
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--baseline", help="earlier JSON result to compare against")
+    args = parser.parse_args()
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "wire_format": args.wire_format,
+        "header_cache": not args.no_header_cache,
+        "runs": [],
+        "memory": [],
+    }
+    for mode in args.modes:
+        server = build_server(free_port(), args.wire_format, not args.no_header_cache)
+        if mode == "inprocess":
+            # Frames are PacketBuffers; the receive side works on the bytes a socket would deliver.
+            server.physical_layer.transmit = lambda data, ip, port, stream=None: server.process_received_data(bytes(data), None) or True
+            # Segments are handed over together; without a connection there are no acks to wait for.
+            server.transmit_segments = lambda msg_id, frames, ip, stream=None: all(
+                server.process_received_data(bytes(frame), None) or True for frame in frames)
+        else:
+            threading.Thread(target=server.start, daemon=True).start()
+            time.sleep(0.2)
+        for size in args.sizes:
+            count = max(5, min(args.max_messages, BYTES_PER_RUN // size))
+            for concurrency in args.concurrency:
+                run = run_config(server, size, concurrency, count)
+                run["mode"] = mode
+                results["runs"].append(run)
+                print(f"{mode:>10} {size:>9}B x{concurrency:<3} {run['msgs_per_sec']:>10.0f} msg/s "
+                      f"{run['mb_per_sec']:>8.1f} MB/s  p50 {run['latency_us']['p50']:>9.0f}us "
+                      f"p99 {run['latency_us']['p99']:>9.0f}us p999 {run['latency_us']['p999']:>9.0f}us",
+                      file=sys.stderr)
+    memory_server = build_server(free_port(), args.wire_format)
+    memory_server.physical_layer.transmit = lambda data, ip, port, stream=None: True
+    memory_server.transmit_segments = lambda msg_id, frames, ip, stream=None: True
+    for size in args.sizes:
+        results["memory"].append({"size": size, "peak_alloc_bytes": layer_memory(memory_server, size)})
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    results["peak_rss_bytes"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(results, json.load(f))
+
+if __name__ == "__main__":
+    main()
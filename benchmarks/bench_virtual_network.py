@@ -0,0 +1,111 @@
+"""
+Load test of many OSI nodes in one process on an in-memory virtual switch.
+
+Every node is a full OSIServer attached to a VirtualSwitch instead of sockets.
+Random pairs of nodes exchange chat messages, with the link impairments given
+on the command line. By default the switch runs on a virtual clock, so a run is
+repeatable for a given --seed and is not slowed down by the simulated latency;
+--real-time delivers frames on a timer thread instead.
+
+    python benchmarks/bench_virtual_network.py --nodes 10000 --messages 50000
+    python benchmarks/bench_virtual_network.py --nodes 100 --loss 0.01 --reorder 0.1 --size 300000
+"""
+import argparse
+import base64
+import contextlib
+import io
+import os
+import random
+import resource
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from cryptography.fernet import Fernet
+
+from osi_server import OSIServer
+from tracing import Tracer
+from virtual_network import Inbox, LinkProfile, VirtualClock, VirtualSwitch
+
+APP_PORT = 3000
+
+def node_ip(index: int) -> str:
+    return f"10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=10000)
+    parser.add_argument("--messages", type=int, default=50000)
+    parser.add_argument("--size", type=int, default=200, help="bytes of content per message")
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="binary")
+    parser.add_argument("--latency", type=float, default=0.0005, help="one-way latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--bandwidth", type=float, default=None, help="bytes per second per node")
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--reorder", type=float, default=0.0)
+    parser.add_argument("--real-time", action="store_true", help="deliver frames in real time instead of on a virtual clock")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    clock = None if args.real_time else VirtualClock()
+    profile = LinkProfile(latency=args.latency, jitter=args.jitter, bandwidth=args.bandwidth,
+                          loss=args.loss, reorder=args.reorder)
+    switch = VirtualSwitch(clock=clock, profile=profile, seed=args.seed)
+    key = Fernet.generate_key()
+    tracer = Tracer()
+    rng = random.Random(args.seed)
+    content = base64.b64encode(rng.randbytes(args.size * 3 // 4 + 1)).decode("ascii")[:args.size]
+    inboxes = []
+
+    rss_before = peak_rss_bytes()
+    start = time.perf_counter()
+    # The layers print a status line per node and per new session; keep them out of the report.
+    with contextlib.redirect_stdout(io.StringIO()):
+        nodes = []
+        for index in range(1, args.nodes + 1):
+            node = OSIServer(ip=node_ip(index), switch=switch, presentation_key=key,
+                             wire_format=args.wire_format, tracer=tracer)
+            inbox = Inbox(APP_PORT, max_messages=0)
+            node.transport_layer.register_channel(APP_PORT, inbox)
+            nodes.append(node)
+            inboxes.append(inbox)
+    setup_seconds = time.perf_counter() - start
+    rss_nodes = peak_rss_bytes()
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for i in range(args.messages):
+            sender, receiver = rng.sample(nodes, 2)
+            sender.send_message(receiver.ip, APP_PORT, {"sender": sender.ip, "content": content, "n": i})
+            # Drain the network as it goes, so queued frames do not pile up.
+            if clock is not None and i % 1000 == 999:
+                clock.run()
+        if clock is not None:
+            clock.run()
+        else:
+            while sum(inbox.received for inbox in inboxes) + switch.stats["lost"] < args.messages \
+                    and time.perf_counter() - start < 60:
+                time.sleep(0.05)
+    run_seconds = time.perf_counter() - start
+
+    delivered = sum(inbox.received for inbox in inboxes)
+    print(f"nodes              {args.nodes}")
+    print(f"setup              {setup_seconds:.2f} s, "
+          f"{(rss_nodes - rss_before) / max(1, args.nodes) / 1024:.1f} KB peak RSS per node")
+    print(f"messages           {args.messages} sent, {delivered} delivered "
+          f"({delivered / max(1, args.messages):.2%})")
+    print(f"wall time          {run_seconds:.2f} s ({delivered / run_seconds:.0f} msgs/s)")
+    if clock is not None:
+        print(f"virtual time       {clock.now():.3f} s")
+    print(f"switch             {switch.stats}")
+    print(f"sessions           {sum(len(node.session_layer.sessions) for node in nodes)}")
+    print(f"peak RSS           {peak_rss_bytes() / (1024 * 1024):.0f} MB")
+
+if __name__ == "__main__":
+    main()
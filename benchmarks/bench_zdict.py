@@ -0,0 +1,97 @@
+"""
+Compression of small chat messages with and without a preset dictionary.
+
+A dictionary is built (see osi/zdict.py) from half of the messages and
+measured on the other half. Each configuration reports the mean application
+payload size, the mean presentation payload size for binary frames (profile
+byte, dictionary id, nonce, tag and body included), and the CPU microseconds
+per message to encode and decode:
+
+  none       the default aesgcm profile: payloads under 512 bytes are not compressed
+  zlib       the same, but every payload is zlib-compressed without a dictionary
+  zdict-N    payloads under 512 bytes compressed with an N-byte dictionary
+
+Messages are synthetic chat messages, or read from --capture (one JSON object
+per line, the input of zdict.py), in the application encoding given by
+--app-encoding.
+
+    python benchmarks/bench_zdict.py
+    python benchmarks/bench_zdict.py --capture messages.jsonl --dictionary-sizes 1024 4096
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
+
+from cryptography.fernet import Fernet
+
+from application_layer import ApplicationLayer
+from presentation_layer import PresentationLayer, PresentationProfile, PROFILES
+from zdict import build_dictionary, read_capture
+
+SENDERS = ["alice", "bob", "carol", "dave", "erin", "frank", "grace", "heidi"]
+WORDS = ("see you at noon ok thanks where are we meeting today tomorrow sounds good "
+         "lunch coffee meeting later running late call me back on my way done").split()
+
+def synthetic_messages(count: int, encoding: str) -> list:
+    app_layer = ApplicationLayer(encoding=encoding)
+    rng = random.Random(1)
+    start = 1735732800
+    messages = []
+    for i in range(count):
+        content = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 12)))
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(start + i * 37))
+        messages.append(app_layer.encapsulate(
+            {"sender": rng.choice(SENDERS), "content": content, "timestamp": timestamp}))
+    return messages
+
+def measure(layer: PresentationLayer, samples: list, repeat: int):
+    """Mean (wire bytes, encode us, decode us) per message."""
+    encoded = [layer.encapsulate(sample, True) for sample in samples]
+    start = time.process_time()
+    for _ in range(repeat):
+        for sample in samples:
+            layer.encapsulate(sample, True)
+    middle = time.process_time()
+    for _ in range(repeat):
+        for data in encoded:
+            layer.decapsulate(data, True)
+    end = time.process_time()
+    count = repeat * len(samples)
+    return (sum(map(len, encoded)) / len(encoded), (middle - start) / count * 1e6, (end - middle) / count * 1e6)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capture", help="chat messages to use, one JSON object per line")
+    parser.add_argument("--messages", type=int, default=4000, help="synthetic messages to generate")
+    parser.add_argument("--dictionary-sizes", nargs="+", type=int, default=[1024, 4096, 16384])
+    parser.add_argument("--app-encoding", choices=("json", "binary"), default="json")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.capture:
+        samples = read_capture(args.capture, args.app_encoding)
+    else:
+        samples = synthetic_messages(args.messages, args.app_encoding)
+    random.Random(2).shuffle(samples)
+    train, test = samples[:len(samples) // 2], samples[len(samples) // 2:]
+    key = Fernet.generate_key()
+    layers = {
+        "none": PresentationLayer(key, PROFILES["aesgcm"]),
+        "zlib": PresentationLayer(key, PresentationProfile(cipher="aesgcm", compress_threshold=0)),
+    }
+    for size in args.dictionary_sizes:
+        layers[f"zdict-{size}"] = PresentationLayer(key, PROFILES["aesgcm"], {1: build_dictionary(train, size)})
+
+    app_bytes = sum(map(len, test)) / len(test)
+    print(f"{len(train)} training and {len(test)} test messages, {app_bytes:.0f} application bytes on average")
+    print(f"{'config':>12} {'wire B':>8} {'ratio':>6} {'enc us':>7} {'dec us':>7}")
+    for name, layer in layers.items():
+        wire, encode_us, decode_us = measure(layer, test, args.repeat)
+        print(f"{name:>12} {wire:>8.1f} {wire / app_bytes:>6.2f} {encode_us:>7.1f} {decode_us:>7.1f}")
+
+if __name__ == "__main__":
+    main()
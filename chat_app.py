@@ -1,5 +1,6 @@
 import socket
 import json
+import struct
 import threading
 import os
 from datetime import datetime
@@ -23,6 +24,14 @@ def get_own_ip():
         ip = "127.0.0.1"
     return ip
 
+def send_to_osi(client_socket, message_obj):
+    """
+    Sends a JSON message to the OSI server. Messages on the OSI connection are
+    prefixed with their length as a 4-byte big-endian integer.
+    """
+    payload = json.dumps(message_obj).encode('utf-8')
+    client_socket.sendall(struct.pack("!I", len(payload)) + payload)
+
 def register_with_osi(client_socket, listening_port):
     """
     Sends a registration message to the OSI server so it knows on which port
@@ -32,14 +41,49 @@ def register_with_osi(client_socket, listening_port):
         "type": "register",
         "port": listening_port
     }
-    reg_str = json.dumps(reg_message)
-    client_socket.sendall(reg_str.encode('utf-8'))
+    send_to_osi(client_socket, reg_message)
     print(f"Registered with OSI server on port {listening_port}.")
 
+def recv_exactly(sock, size):
+    """Reads exactly size bytes from sock, or returns None if the connection closes."""
+    data = b""
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+def osi_listener(client_socket):
+    """
+    Reads length-prefixed messages that the OSI server delivers over the
+    registration connection and appends chat messages to the global inbox.
+    """
+    while True:
+        try:
+            header = recv_exactly(client_socket, 4)
+            if header is None:
+                return
+            data = recv_exactly(client_socket, struct.unpack("!I", header)[0])
+            if data is None:
+                return
+        except OSError:
+            return
+        if data == b"ACK":
+            continue
+        try:
+            message_obj = json.loads(data.decode('utf-8'))
+        except Exception as e:
+            print("Error decoding incoming message:", e)
+            continue
+        with inbox_lock:
+            inbox.append(message_obj)
+
 def inbox_listener(listening_port):
     """
     Opens a listening socket on the given port to receive incoming messages.
-    Each connection is handled in its own thread.
+    Each connection is handled in its own thread. Registered clients normally
+    receive messages over the OSI connection instead (see osi_listener).
     """
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server_socket.bind(('0.0.0.0', listening_port))
@@ -86,8 +130,7 @@ def send_message(client_socket, sender_name, listening_port):
         "destination": dest_ip,
         "dest_port": listening_port
     }
-    message_str = json.dumps(message_obj)
-    client_socket.sendall(message_str.encode('utf-8'))
+    send_to_osi(client_socket, message_obj)
     print("Message sent via OSI server.")
 
 def view_inbox():
@@ -172,6 +215,7 @@ def main():
 
     # Register with the OSI server so it knows where to send incoming messages.
     register_with_osi(client_socket, listening_port)
+    threading.Thread(target=osi_listener, args=(client_socket,), daemon=True).start()
 
     # Display the home page for user choices.
     home_page(sender_name, client_socket, osi_server_ip, osi_server_port, listening_port)
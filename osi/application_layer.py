@@ -1,34 +1,236 @@
+import codecs
+import logging
 import json
 import socket
+import struct
+import sys
+from datetime import datetime, timedelta
+
+logger = logging.getLogger("osi.application")
+
+# Binary application payloads start with APP_BINARY_MAGIC, which neither JSON
+# payloads ("APP_HEADER|...") nor bare JSON can start with, followed by a byte of
+# FIELD_* flags and then the fields that are present, in this order:
+#   sender       1-byte length + UTF-8
+#   timestamp    8-byte signed seconds since the epoch
+#   destination  4-byte IPv4 address
+#   dest_port    2 bytes
+#   content      UTF-8, the rest of the payload
+APP_BINARY_MAGIC = 0xB2
+APP_JSON_HEADER = b"APP_HEADER|"
+FIELD_SENDER = 0x01
+FIELD_TIMESTAMP = 0x02
+# The timestamp was "YYYY-MM-DD HH:MM:SS" text and is given back as text.
+FIELD_TIMESTAMP_TEXT = 0x04
+FIELD_DESTINATION = 0x08
+FIELD_DEST_PORT = 0x10
+FIELD_CONTENT = 0x20
+BINARY_FIELDS = frozenset(("sender", "content", "timestamp", "destination", "dest_port"))
+TIMESTAMP = struct.Struct("!q")
+DEST_PORT = struct.Struct("!H")
+EPOCH = datetime(1970, 1, 1)
+ONE_SECOND = timedelta(seconds=1)
+# Sender names kept already encoded (send side) and decoded (receive side).
+MAX_INTERNED_SENDERS = 4096
+# Timestamps kept already converted. Converting costs more than the rest of a
+# small message, and chat timestamps repeat; the cache is emptied when full.
+MAX_CACHED_TIMESTAMPS = 4096
+
+def parse_timestamp(text: str):
+    """Seconds since the epoch of a "YYYY-MM-DD HH:MM:SS" timestamp, or None for any other text."""
+    if len(text) != 19:
+        return None
+    try:
+        parsed = datetime.fromisoformat(text)
+    except ValueError:
+        return None
+    # fromisoformat accepts other layouts too; only exact round trips qualify.
+    if parsed.tzinfo is not None or str(parsed) != text:
+        return None
+    return (parsed - EPOCH) // ONE_SECOND
+
+def format_timestamp(seconds: int) -> str:
+    return str(EPOCH + timedelta(seconds=seconds))
 
 class ApplicationLayer:
-    def encapsulate(self, message_obj: object) -> str:
-        json_str = json.dumps(message_obj)
-        encapsulated = f"APP_HEADER|{json_str}"
-        print(f"[ApplicationLayer] Encapsulated data: {encapsulated}")
+    def __init__(self, transport_layer=None, encoding: str = "json"):
+        """
+        encoding is how outgoing messages are encoded: "json", or "binary" for the
+        compact encoding of chat messages (see APP_BINARY_MAGIC), which falls back
+        to JSON for any other message. Incoming messages may use either.
+        """
+        if encoding not in ("json", "binary"):
+            raise ValueError(f"Unknown application encoding: {encoding}")
+        # Used to deliver messages over a client's registration connection.
+        self.transport_layer = transport_layer
+        self.encoding = encoding
+        self._sender_bytes = {}  # { sender: UTF-8 bytes }
+        self._senders = {}       # { UTF-8 bytes: interned sender }
+        self._timestamp_seconds = {}  # { timestamp text: seconds }
+        self._timestamp_texts = {}    # { seconds: timestamp text }
+
+    def encapsulate(self, message_obj: object) -> bytes:
+        if self.encoding == "binary":
+            encapsulated = self.encode_binary(message_obj)
+            if encapsulated is not None:
+                logger.debug("[ApplicationLayer] Encapsulated data: %s", encapsulated)
+                return encapsulated
+        encapsulated = APP_JSON_HEADER + json.dumps(message_obj).encode('utf-8')
+        logger.debug("[ApplicationLayer] Encapsulated data: %s", encapsulated)
         return encapsulated
 
-    def decapsulate(self, data: str) -> str:
-        if data.startswith("APP_HEADER|"):
-            encapsulated = data[len("APP_HEADER|"):]
-            print(f"[ApplicationLayer] Decapsulated data: {encapsulated}")
+    def encode_binary(self, message_obj: object) -> bytes:
+        """The binary encoding of a chat message, or None if it does not fit the schema."""
+        if type(message_obj) is not dict or not message_obj.keys() <= BINARY_FIELDS:
+            return None
+        if any(value is None for value in message_obj.values()):
+            # JSON keeps a field set to null; here it would be dropped.
+            return None
+        flags = 0
+        parts = []
+        sender = message_obj.get("sender")
+        if sender is not None:
+            if type(sender) is not str:
+                return None
+            encoded = self._sender_bytes.get(sender)
+            if encoded is None:
+                encoded = sender.encode('utf-8')
+                if len(encoded) > 255:
+                    return None
+                if len(self._sender_bytes) < MAX_INTERNED_SENDERS:
+                    self._sender_bytes[sender] = encoded
+            flags |= FIELD_SENDER
+            parts += (bytes((len(encoded),)), encoded)
+        timestamp = message_obj.get("timestamp")
+        if timestamp is not None:
+            if type(timestamp) is str:
+                text = timestamp
+                timestamp = self._timestamp_seconds.get(text)
+                if timestamp is None:
+                    timestamp = parse_timestamp(text)
+                    if timestamp is None:
+                        return None
+                    if len(self._timestamp_seconds) >= MAX_CACHED_TIMESTAMPS:
+                        self._timestamp_seconds.clear()
+                    self._timestamp_seconds[text] = timestamp
+                flags |= FIELD_TIMESTAMP_TEXT
+            elif type(timestamp) is not int or not -2 ** 63 <= timestamp < 2 ** 63:
+                return None
+            flags |= FIELD_TIMESTAMP
+            parts.append(TIMESTAMP.pack(timestamp))
+        destination = message_obj.get("destination")
+        if destination is not None:
+            try:
+                packed = socket.inet_aton(destination)
+            except (OSError, TypeError):
+                return None
+            if socket.inet_ntoa(packed) != destination:
+                return None
+            flags |= FIELD_DESTINATION
+            parts.append(packed)
+        dest_port = message_obj.get("dest_port")
+        if dest_port is not None:
+            if type(dest_port) is not int or not 0 <= dest_port <= 0xFFFF:
+                return None
+            flags |= FIELD_DEST_PORT
+            parts.append(DEST_PORT.pack(dest_port))
+        content = message_obj.get("content")
+        if content is not None:
+            if type(content) is not str:
+                return None
+            flags |= FIELD_CONTENT
+            parts.append(content.encode('utf-8'))
+        return bytes((APP_BINARY_MAGIC, flags)) + b"".join(parts)
+
+    def decode(self, data) -> object:
+        """Decode an application payload (bytes, either encoding) straight to the message object."""
+        if data[:1] == bytes((APP_BINARY_MAGIC,)):
+            return self.decode_binary(data)
+        return json.loads(self.decapsulate(data))
+
+    def decode_binary(self, data) -> dict:
+        try:
+            flags = data[1]
+            offset = 2
+            message = {}
+            if flags & FIELD_SENDER:
+                end = offset + 1 + data[offset]
+                raw = data[offset + 1:end]
+                if len(raw) != end - offset - 1:
+                    raise IndexError
+                sender = self._senders.get(raw)
+                if sender is None:
+                    sender = sys.intern(raw.decode('utf-8'))
+                    if len(self._senders) < MAX_INTERNED_SENDERS:
+                        self._senders[raw] = sender
+                message["sender"] = sender
+                offset = end
+            timestamp = None
+            if flags & FIELD_TIMESTAMP:
+                timestamp, = TIMESTAMP.unpack_from(data, offset)
+                offset += TIMESTAMP.size
+                if flags & FIELD_TIMESTAMP_TEXT:
+                    text = self._timestamp_texts.get(timestamp)
+                    if text is None:
+                        text = format_timestamp(timestamp)
+                        if len(self._timestamp_texts) >= MAX_CACHED_TIMESTAMPS:
+                            self._timestamp_texts.clear()
+                        self._timestamp_texts[timestamp] = text
+                    timestamp = text
+            destination = None
+            if flags & FIELD_DESTINATION:
+                destination = socket.inet_ntoa(data[offset:offset + 4])
+                offset += 4
+            dest_port = None
+            if flags & FIELD_DEST_PORT:
+                dest_port, = DEST_PORT.unpack_from(data, offset)
+                offset += DEST_PORT.size
+        except (IndexError, OSError, struct.error):
+            raise Exception("Truncated binary application payload.")
+        if flags & FIELD_CONTENT:
+            # Decoded from a view, so the content is not sliced out first.
+            message["content"] = codecs.utf_8_decode(memoryview(data)[offset:], None, True)[0]
+        if timestamp is not None:
+            message["timestamp"] = timestamp
+        if destination is not None:
+            message["destination"] = destination
+        if dest_port is not None:
+            message["dest_port"] = dest_port
+        logger.debug("[ApplicationLayer] Decoded binary message: %s", message)
+        return message
+
+    def decapsulate(self, data):
+        """Strip the JSON payload header (from bytes or str)."""
+        header = "APP_HEADER|" if isinstance(data, str) else APP_JSON_HEADER
+        if data.startswith(header):
+            encapsulated = data[len(header):]
+            logger.debug("[ApplicationLayer] Decapsulated data: %s", encapsulated)
             return encapsulated
         return data
 
     def process_message(self, message_obj: object, transport_port: int = None):
         """
         Deliver the processed message to the chat app.
-        If a transport_port is provided, this method opens a connection to localhost on that port
-        and sends the JSON payload. Otherwise, it simply prints the message.
+        If the client registered for transport_port, the message is queued on its
+        registration connection. Otherwise, if a transport_port is provided, this method
+        opens a connection to localhost on that port and sends the JSON payload.
+        Without a port, it simply logs the message.
         """
+        if transport_port and self.transport_layer is not None \
+                and transport_port in self.transport_layer.port_registry:
+            # A registered client is only reached over its own connection; if its
+            # queue is full the message is dropped rather than blocking the caller.
+            self.transport_layer.send_via_registered(transport_port, message_obj)
+            return
         payload = json.dumps(message_obj).encode('utf-8')
         if transport_port:
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
                     s.connect(('localhost', transport_port))
                     s.sendall(payload)
-                    print(f"[ApplicationLayer] Delivered message to applicaton on port {transport_port}: {message_obj}")
+                    logger.debug("[ApplicationLayer] Delivered message to applicaton on port %s: %s",
+                                 transport_port, message_obj)
             except Exception as e:
-                print(f"[ApplicationLayer] Error delivering message on port {transport_port}: {e}")
+                logger.warning("[ApplicationLayer] Error delivering message on port %s: %s", transport_port, e)
         else:
-            print(f"[ApplicationLayer] Processed message (no transport port provided): {message_obj}")
+            logger.debug("[ApplicationLayer] Processed message (no transport port provided): %s", message_obj)
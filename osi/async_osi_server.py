@@ -0,0 +1,426 @@
+import asyncio
+import json
+import logging
+import uuid
+
+from capture import CAPTURE_IN, CAPTURE_OUT, DEFAULT_CAPTURE_SIZE
+from datalink_layer import ARP_PORT, ARP_TIMEOUT, BINARY_MAGIC_BYTE, FrameCheckError
+from framing import LENGTH_PREFIX, MAX_MESSAGE_SIZE, encode_frame, frame_buffers
+from osi_server import OSIServer
+from transport_layer import SEGMENT_SIZE, WINDOW, SegmentWindow
+
+logger = logging.getLogger("osi.server")
+
+# How long to wait for a session ACK or an outbound connection before giving up.
+RESOLVE_TIMEOUT = 5
+# Bytes a registered client may have waiting in its write buffer before new messages are dropped.
+CLIENT_BUFFER_LIMIT = 4 * 1024 * 1024
+
+class AsyncClientChannel:
+    """
+    Event-loop counterpart of transport_layer.ClientChannel: writes length-prefixed
+    messages to a registered client and drops them while its buffer is over the limit.
+    """
+
+    def __init__(self, port: int, writer: asyncio.StreamWriter):
+        self.port = port
+        self.conn = writer
+        self.dropped = 0
+
+    def send(self, payload: bytes) -> bool:
+        if self.conn.is_closing():
+            return False
+        if self.conn.transport.get_write_buffer_size() > CLIENT_BUFFER_LIMIT:
+            self.dropped += 1
+            logger.warning("[TransportLayer] Delivery buffer full on port %s; dropped message (%s so far).",
+                           self.port, self.dropped)
+            return False
+        self.conn.write(encode_frame(payload))
+        return True
+
+    def close(self):
+        pass  # The connection is closed by its stream handler.
+
+class ArpProtocol(asyncio.DatagramProtocol):
+    """
+    ARP endpoint on the event loop. Answers requests with our MAC address and
+    resolves pending lookups when a response arrives.
+    """
+
+    def __init__(self, data_link_layer):
+        self.data_link_layer = data_link_layer
+        self.transport = None
+        self.pending = {}  # { ip: Future resolving to the MAC address }
+
+    def connection_made(self, transport):
+        self.transport = transport
+        print(f"[DataLinkLayer] ARP endpoint running on port {ARP_PORT}")
+
+    def datagram_received(self, data: bytes, addr):
+        response = self.data_link_layer.arp_response(data)
+        if response is not None:
+            self.transport.sendto(response, addr)
+            return
+        remote_mac = self.data_link_layer.parse_arp_response(data)
+        future = self.pending.pop(addr[0], None)
+        if remote_mac is not None and future is not None and not future.done():
+            future.set_result(remote_mac)
+
+    async def resolve(self, ip: str) -> str:
+        """Resolve ip to a MAC address. Concurrent lookups for one IP share a request."""
+        arp_table = self.data_link_layer.arp_table
+        state, remote_mac = arp_table.lookup(ip)
+        if state == "hit":
+            return remote_mac
+        if state == "negative":
+            raise Exception(f"Failed to resolve MAC for {ip}")
+        future = self.pending.get(ip)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self.pending[ip] = future
+            logger.debug("[DataLinkLayer] Sending ARP request to %s", ip)
+            self.transport.sendto("ARP_REQUEST".encode('utf-8'), (ip, ARP_PORT))
+        try:
+            remote_mac = await asyncio.wait_for(asyncio.shield(future), ARP_TIMEOUT)
+        except asyncio.TimeoutError:
+            if self.pending.pop(ip, None) is not None:
+                arp_table.learn_failure(ip)
+            raise Exception(f"Failed to resolve MAC for {ip}")
+        arp_table.learn(ip, remote_mac)
+        return remote_mac
+
+class AsyncOSIServer(OSIServer):
+    """
+    OSIServer that runs accept, per-connection stream handling, the ARP endpoint
+    and outbound transmission on one asyncio event loop instead of a thread per
+    connection. Framing and the layer encapsulate/decapsulate logic are shared
+    with the threaded server.
+    """
+
+    def __init__(self, host="0.0.0.0", port=5000, wire_format="text", tracer=None,
+                 presentation_profile="aesgcm", presentation_workers=0, presentation_pool="process",
+                 segment_size=SEGMENT_SIZE, window=WINDOW, routes=None, presentation_dictionaries=None,
+                 app_encoding="json", presentation_key=None, capture_path=None,
+                 capture_size=DEFAULT_CAPTURE_SIZE):
+        super().__init__(host=host, port=port, wire_format=wire_format, arp_listener=False, tracer=tracer,
+                         presentation_profile=presentation_profile, presentation_workers=presentation_workers,
+                         presentation_pool=presentation_pool, segment_size=segment_size, window=window,
+                         routes=routes, presentation_dictionaries=presentation_dictionaries,
+                         app_encoding=app_encoding, presentation_key=presentation_key,
+                         capture_path=capture_path, capture_size=capture_size)
+        self.arp = ArpProtocol(self.data_link_layer)
+        self._peers = {}     # { (ip, port): (reader, writer) } outbound connections
+        self._peer_locks = {}
+        self._handshakes = {}  # { ip: Task establishing a session }
+
+    def start(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        print("OSI: [start] (asyncio engine)")
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self.arp, local_addr=('0.0.0.0', ARP_PORT))
+        # A deep backlog lets bursts of thousands of clients connect without refusals.
+        server = await asyncio.start_server(self.handle_stream, self.host, self.port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+    async def read_message(self, reader: asyncio.StreamReader) -> bytes:
+        """Read one length-prefixed message. Returns None at end of stream."""
+        try:
+            header = await reader.readexactly(LENGTH_PREFIX.size)
+        except asyncio.IncompleteReadError:
+            return None
+        (length,) = LENGTH_PREFIX.unpack(header)
+        if length > MAX_MESSAGE_SIZE:
+            raise Exception(f"Message of {length} bytes exceeds limit of {MAX_MESSAGE_SIZE}")
+        return await reader.readexactly(length)
+
+    async def handle_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        try:
+            while True:
+                data = await self.read_message(reader)
+                if data is None or not await self.handle_message_async(data, writer, addr):
+                    break
+        except Exception as e:
+            logger.warning("OSI: [connection error] %s: %s", addr, e)
+        finally:
+            writer.close()
+            key = self.client_keys.pop(writer, None)
+            client = self.registered_clients.get(key)
+            if client is not None and client["conn"] is writer:
+                del self.registered_clients[key]
+                self.transport_layer.deregister(client["listening_port"], writer)
+
+    async def handle_message_async(self, data: bytes, writer: asyncio.StreamWriter, addr) -> bool:
+        """Event-loop counterpart of OSIServer.handle_message."""
+        if data.startswith(BINARY_MAGIC_BYTE):
+            await self.process_frame_async(data, binary=True, writer=writer)
+            return True
+        try:
+            decoded = data.decode('utf-8').strip()
+        except Exception:
+            return False
+
+        if decoded.startswith('{'):
+            try:
+                message_obj = json.loads(decoded)
+            except Exception:
+                return False
+            if message_obj.get("type") == "register":
+                listening_port = message_obj.get("port")
+                if not self.transport_layer.register_channel(
+                        listening_port, AsyncClientChannel(listening_port, writer), addr[0]):
+                    writer.write(encode_frame(f"REJECTED: port {listening_port} is in use".encode('utf-8')))
+                    await writer.drain()
+                    return False
+                key = (addr[0], listening_port)
+                self.registered_clients[key] = {"conn": writer, "listening_port": listening_port}
+                self.client_keys[writer] = key
+                writer.write(encode_frame("ACK".encode('utf-8')))
+            elif "destination" in message_obj:
+                destination_ip = message_obj.pop("destination")
+                dest_port = message_obj.pop("dest_port", self.port)
+                await self.send_message_async(destination_ip, dest_port, message_obj)
+            else:
+                await self.deliver_async(message_obj, None)
+            return True
+        elif decoded.startswith("DL_HEADER("):
+            await self.process_frame_async(data, binary=False, writer=writer)
+            return True
+        else:
+            next_hop, request = self.session_layer.route_handshake(data, addr[0])
+            reply = b"ACK" if next_hop is None else await self.handshake_async(next_hop, request)
+            if reply is not None:
+                writer.write(encode_frame(reply))
+                await writer.drain()
+            logger.debug("[SessionLayer] Handled session handshake from %s. Sent %s.", addr[0], reply)
+            return False
+
+    async def process_frame_async(self, raw_data: bytes, binary: bool, writer: asyncio.StreamWriter = None):
+        if self.capture is not None:
+            self.capture.record(CAPTURE_IN, raw_data)
+        self.tracer.begin_packet("recv", len(raw_data))
+        # Transport acks for segments go back over the connection the frame came in on.
+        ack = (lambda message: writer.write(encode_frame(message))) if writer is not None else None
+        try:
+            if binary:
+                data, extracted_port = self.decapsulate_binary_frame(raw_data, ack)
+            else:
+                data, extracted_port = self.decapsulate_text_frame(raw_data, ack)
+        except FrameCheckError:
+            self.tracer.count("recv.dropped")
+            self.tracer.end_packet(outcome="corrupt")
+            return
+        except Exception as e:
+            logger.warning("OSI: [decapsulation error] %s", e)
+            self.tracer.count("recv.dropped")
+            self.tracer.end_packet(outcome="dropped")
+            return
+        if data is None:
+            self.tracer.end_packet(outcome="segment" if extracted_port is not None else "forwarded",
+                                   port=extracted_port)
+            return
+        if self.presentation_pool is None:
+            message_obj = self.decode_payload(data, binary)
+        else:
+            # The stream handler awaits each frame, so frames from one connection stay in order.
+            texts = await self.gather_async(self.presentation_pool.submit_decode([(data, binary)]))
+            message_obj = self.decode_text(texts[0])
+        # The trace record is finished before awaiting so it cannot pick up another packet's stages.
+        self.tracer.end_packet(outcome="delivered" if message_obj is not None else "dropped", port=extracted_port)
+        if message_obj is not None:
+            await self.deliver_async(message_obj, extracted_port)
+
+    def forward_packet(self, packet, dest_ip: str, binary: bool = False):
+        """Forward on the event loop: resolving the next hop's MAC must not block it."""
+        next_hop = self.network_layer.next_hop(dest_ip)
+        if next_hop == self.ip:
+            raise Exception(f"No route to {dest_ip}")
+        asyncio.ensure_future(self.forward_packet_async(packet, dest_ip, next_hop, binary))
+
+    async def forward_packet_async(self, packet, dest_ip: str, next_hop: str, binary: bool):
+        try:
+            await self.arp.resolve(next_hop)
+            if binary:
+                frame = self.data_link_layer.encapsulate_binary(packet, receiver_ip=next_hop)
+            else:
+                frame = self.data_link_layer.encapsulate(packet, receiver_ip=next_hop)
+        except Exception as e:
+            logger.warning("OSI: [forward error] %s", e)
+            self.tracer.count("recv.dropped")
+            return
+        if await self.transmit_async(frame, next_hop, self.port):
+            self.tracer.count("forwarded")
+        else:
+            logger.warning("OSI: [forward error] Failed to forward packet for %s to %s", dest_ip, next_hop)
+            self.tracer.count("recv.dropped")
+
+    async def deliver_async(self, message_obj: object, transport_port: int):
+        """
+        Deliver a message to the chat app: over its registration connection if it
+        registered for transport_port, otherwise on a new connection to that port.
+        """
+        if transport_port in self.transport_layer.port_registry:
+            self.transport_layer.send_via_registered(transport_port, message_obj)
+            return
+        if not transport_port:
+            logger.debug("[ApplicationLayer] Processed message (no transport port provided): %s", message_obj)
+            return
+        try:
+            _, writer = await asyncio.open_connection('localhost', transport_port)
+            writer.write(json.dumps(message_obj).encode('utf-8'))
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except Exception as e:
+            logger.warning("[ApplicationLayer] Error delivering message on port %s: %s", transport_port, e)
+
+    async def establish_session_async(self, receiver_ip: str):
+        """Run the session handshake with receiver_ip, through its next hop, without blocking the loop."""
+        session_id = str(uuid.uuid4())
+        next_hop = self.network_layer.next_hop(receiver_ip)
+        reply = await self.handshake_async(
+            next_hop, self.session_layer.handshake_request(session_id, receiver_ip, next_hop))
+        if reply != b"ACK":
+            raise Exception("Failed to establish session with the receiver.")
+        self.session_layer.store_session(receiver_ip, session_id)
+        logger.debug("[SessionLayer] Session established successfully.")
+
+    async def handshake_async(self, host: str, request: bytes) -> bytes:
+        """Send a session handshake to host and return its reply (see SessionLayer.request)."""
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, self.port), RESOLVE_TIMEOUT)
+        try:
+            writer.write(encode_frame(request))
+            await writer.drain()
+            return await asyncio.wait_for(self.read_message(reader), RESOLVE_TIMEOUT)
+        finally:
+            writer.close()
+
+    async def ensure_session(self, receiver_ip: str):
+        if self.session_layer.lookup_session(receiver_ip) is not None:
+            return
+        task = self._handshakes.get(receiver_ip)
+        if task is None:
+            task = asyncio.ensure_future(self.establish_session_async(receiver_ip))
+            self._handshakes[receiver_ip] = task
+            task.add_done_callback(lambda _: self._handshakes.pop(receiver_ip, None))
+        await asyncio.shield(task)
+
+    async def send_message_async(self, ip_address: str, dest_port: int, message_obj: object):
+        """
+        Resolve the next hop's MAC address and the peer's session on the event loop,
+        then reuse the synchronous layer encapsulation, which finds both already cached.
+        """
+        next_hop = self.network_layer.next_hop(ip_address)
+        try:
+            if self.presentation_pool is None:
+                pres_encapsulated = self.encode_payload(message_obj)
+            else:
+                pres_encapsulated = await self.encode_payload_async(message_obj)
+            await self.arp.resolve(next_hop)
+            await self.ensure_session(ip_address)
+            segmented = self.transport_layer.needs_segmentation(len(pres_encapsulated))
+            if segmented:
+                msg_id, frames = self.segment_frames(pres_encapsulated, ip_address, dest_port)
+            else:
+                frame = self.encapsulate_frame(pres_encapsulated, ip_address, dest_port)
+        except Exception as e:
+            logger.warning("OSI: [send error] %s", e)
+            return False
+        if segmented and next_hop == ip_address:
+            return await self.exchange_async(
+                lambda peer: self.send_segments_async(peer, msg_id, frames), ip_address, self.port)
+        if segmented:
+            # No acks come back over a routed path (see OSIServer.transmit_segments).
+            for frame in frames:
+                if not await self.transmit_async(frame, next_hop, self.port):
+                    return False
+            return True
+        return await self.transmit_async(frame, next_hop, self.port)
+
+    async def encode_payload_async(self, message_obj: object) -> bytes:
+        """encode_payload with the presentation stage awaited on the presentation pool."""
+        app_encapsulated = self.tracer.timed("send.application", self.app_layer.encapsulate, message_obj)
+        pending = self.presentation_pool.submit_encode([(app_encapsulated, self.wire_format == "binary")])
+        (encoded,) = await self.gather_async(pending)
+        if isinstance(encoded, Exception):
+            raise encoded
+        return encoded
+
+    @staticmethod
+    async def gather_async(pending: list) -> list:
+        """Event-loop counterpart of PresentationPool.gather."""
+        results = []
+        for job in pending:
+            results.extend(job if isinstance(job, list) else await asyncio.wrap_future(job))
+        return results
+
+    async def transmit_async(self, data: bytes, ip_address: str, dest_port: int) -> bool:
+        """Send a frame over one long-lived connection per peer, reconnecting once if it broke."""
+        if self.capture is not None:
+            self.capture.record(CAPTURE_OUT, data)
+
+        async def send(peer) -> bool:
+            peer[1].writelines(frame_buffers(data))
+            await peer[1].drain()
+            return True
+
+        return await self.exchange_async(send, ip_address, dest_port)
+
+    async def exchange_async(self, fn, ip_address: str, dest_port: int) -> bool:
+        """
+        Event-loop counterpart of PhysicalLayer.exchange: run await fn((reader, writer))
+        on the peer's long-lived connection, reconnecting once if it broke. The
+        connection is dropped if fn fails or returns False.
+        """
+        key = (ip_address, dest_port)
+        lock = self._peer_locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            for attempt in range(2):
+                peer = self._peers.get(key)
+                try:
+                    if peer is None or peer[1].is_closing():
+                        peer = await asyncio.wait_for(asyncio.open_connection(*key), RESOLVE_TIMEOUT)
+                        self._peers[key] = peer
+                    if await fn(peer):
+                        return True
+                    self._peers.pop(key, None)
+                    peer[1].close()
+                    return False
+                except Exception as e:
+                    self._peers.pop(key, None)
+                    if peer is not None:
+                        peer[1].close()
+                    if attempt == 1:
+                        logger.warning("[PhysicalLayer] Error transmitting data: %s", e)
+        return False
+
+    async def send_segments_async(self, peer, msg_id: int, frames: list) -> bool:
+        """
+        Event-loop counterpart of TransportLayer.send_segments. An ack timeout
+        fails the exchange: wait_for cancels the read, possibly between a length
+        prefix and its body, so the stream may be left mid-message and the
+        connection is closed instead of reused (exchange_async then resends the
+        message once over a new connection).
+        """
+        reader, writer = peer
+        transport = self.transport_layer
+        window = SegmentWindow(len(frames), transport.window)
+        while not window.done:
+            for seq in window.sendable():
+                if self.capture is not None:
+                    self.capture.record(CAPTURE_OUT, frames[seq])
+                writer.writelines(frame_buffers(frames[seq]))
+            await writer.drain()
+            try:
+                reply = await asyncio.wait_for(self.read_message(reader), transport.ack_timeout)
+            except asyncio.TimeoutError:
+                raise ConnectionResetError(f"No ack for message {msg_id} within {transport.ack_timeout} s")
+            if reply is None:
+                raise ConnectionResetError("Connection closed while waiting for acks")
+            ack = transport.parse_ack(reply)
+            if ack is not None and ack[0] == msg_id:
+                window.ack(ack[1])
+        return True
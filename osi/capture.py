@@ -0,0 +1,211 @@
+import mmap
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from datalink_layer import BINARY_MAGIC_BYTE
+
+# A capture file: a header page, a table of sessions, then the ring of records.
+# The header holds the capturing node's address and MAC, the ring size, the
+# offsets of the next record to write (head) and of the oldest record (tail),
+# the number of records in the ring, and the records written and overwritten.
+FILE_HEADER = struct.Struct("!8s4s6sxxQQQQQQ")
+CAPTURE_MAGIC = b"OSICAPT1"
+# The sessions known when frames were captured, so they can be replayed:
+# peer address, length of the session id, session id.
+SESSION_SLOT = struct.Struct("!4sB43s")
+SESSION_COUNT = struct.Struct("!I")
+SESSION_COUNT_OFFSET = 4096 - SESSION_COUNT.size
+SESSION_OFFSET = 4096
+MAX_CAPTURED_SESSIONS = 1024
+RING_OFFSET = SESSION_OFFSET + MAX_CAPTURED_SESSIONS * SESSION_SLOT.size
+# One record: frame length, wall-clock time in ns, direction, then the frame.
+# Records do not wrap around the end of the ring; a record whose length is
+# WRAP_MARKER, or too little room for a record header, sends readers back to
+# the start.
+RECORD_HEADER = struct.Struct("!IqB")
+WRAP_MARKER = 0xFFFFFFFF
+CAPTURE_IN = 0
+CAPTURE_OUT = 1
+DIRECTIONS = {CAPTURE_IN: "in", CAPTURE_OUT: "out"}
+DEFAULT_CAPTURE_SIZE = 64 * 1024 * 1024
+
+class FrameCapture:
+    """
+    Records frames as they cross the physical layer into a memory-mapped ring
+    buffer file of ring_size bytes. When the ring is full the oldest records are
+    overwritten, so the file always holds the most recent traffic. Nothing is
+    flushed explicitly: the mapping is shared, so the records reach the file
+    even if the process dies.
+
+    record() is called on every frame, so it only packs a header and copies
+    the frame into the mapping under a lock.
+    """
+
+    def __init__(self, path: str, ring_size: int = DEFAULT_CAPTURE_SIZE, ip: str = "0.0.0.0",
+                 mac: str = "00:00:00:00:00:00"):
+        self.path = path
+        self.ring_size = ring_size
+        self.head = 0
+        self.tail = 0
+        self.live = 0
+        self.written = 0
+        self.overwritten = 0
+        self.skipped = 0  # frames larger than the whole ring
+        self._ip = socket.inet_aton(ip)
+        self._mac = bytes.fromhex(mac.replace(":", ""))
+        self._sessions = OrderedDict()  # { peer_ip: slot }, least recently stored first
+        self._lock = threading.Lock()
+        with open(path, "wb") as f:
+            f.truncate(RING_OFFSET + ring_size)
+        self._file = open(path, "r+b")
+        self._data = mmap.mmap(self._file.fileno(), 0)
+        self._save_header()
+
+    def _save_header(self):
+        FILE_HEADER.pack_into(self._data, 0, CAPTURE_MAGIC, self._ip, self._mac, self.ring_size,
+                              self.head, self.tail, self.live, self.written, self.overwritten)
+
+    def _evict(self):
+        """Drop the oldest record. Caller holds the lock."""
+        length = RECORD_HEADER.unpack_from(self._data, RING_OFFSET + self.tail)[0]
+        self.live -= 1
+        self.overwritten += 1
+        if not self.live:
+            self.tail = self.head
+            return
+        self.tail = _next_offset(self._data, self.tail + RECORD_HEADER.size + length, self.ring_size)
+
+    def record(self, direction: int, frame):
+        """Append a frame (bytes-like or PacketBuffer) sent or received now."""
+        length = len(frame)
+        size = RECORD_HEADER.size + length
+        if size > self.ring_size:
+            self.skipped += 1
+            return
+        timestamp = time.time_ns()
+        data = self._data
+        with self._lock:
+            if self.head + size > self.ring_size:
+                # Wrap: the records between head and the end are the oldest.
+                while self.live and self.tail >= self.head:
+                    self._evict()
+                if self.head + RECORD_HEADER.size <= self.ring_size:
+                    RECORD_HEADER.pack_into(data, RING_OFFSET + self.head, WRAP_MARKER, 0, 0)
+                self.head = 0
+                if not self.live:
+                    self.tail = 0
+            while self.live and self.head <= self.tail < self.head + size:
+                self._evict()
+            offset = RING_OFFSET + self.head
+            RECORD_HEADER.pack_into(data, offset, length, timestamp, direction)
+            offset += RECORD_HEADER.size
+            # An outgoing PacketBuffer is copied buffer by buffer, never joined.
+            for buf in getattr(frame, "buffers", (frame,)):
+                data[offset:offset + len(buf)] = buf
+                offset += len(buf)
+            self.head += size
+            self.live += 1
+            self.written += 1
+            self._save_header()
+
+    def record_session(self, peer_ip: str, session_id: str):
+        """Keep the session stored for peer_ip in the session table."""
+        encoded = session_id.encode("utf-8")
+        try:
+            address = socket.inet_aton(peer_ip)
+        except OSError:
+            return
+        if len(encoded) > 43:
+            return
+        with self._lock:
+            slot = self._sessions.pop(peer_ip, None)
+            if slot is None:
+                if len(self._sessions) < MAX_CAPTURED_SESSIONS:
+                    slot = len(self._sessions)
+                else:
+                    # The table is full: reuse the slot of the least recently stored session.
+                    slot = self._sessions.pop(next(iter(self._sessions)))
+            self._sessions[peer_ip] = slot
+            SESSION_SLOT.pack_into(self._data, SESSION_OFFSET + slot * SESSION_SLOT.size,
+                                   address, len(encoded), encoded)
+            SESSION_COUNT.pack_into(self._data, SESSION_COUNT_OFFSET, len(self._sessions))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "written": self.written,
+                "overwritten": self.overwritten,
+                "skipped": self.skipped,
+                "records": self.live,
+            }
+
+    def close(self):
+        with self._lock:
+            self._data.close()
+            self._file.close()
+
+def _next_offset(data, offset: int, ring_size: int) -> int:
+    """The ring offset of the record after one ending at offset."""
+    if offset + RECORD_HEADER.size > ring_size \
+            or RECORD_HEADER.unpack_from(data, RING_OFFSET + offset)[0] == WRAP_MARKER:
+        return 0
+    return offset
+
+class CaptureReader:
+    """
+    A capture file written by FrameCapture: the capturing node's address and
+    MAC, its sessions, and the records from oldest to newest. A capture read
+    while its server is still running may have records overwritten under it.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, ip, mac, self.ring_size, self.head, self.tail, self.live, self.written,
+         self.overwritten) = FILE_HEADER.unpack_from(self._data)
+        if magic != CAPTURE_MAGIC:
+            raise Exception(f"Not a frame capture: {path}")
+        self.ip = socket.inet_ntoa(ip)
+        self.mac = mac.hex(":")
+        self.sessions = {}  # { peer_ip: session_id }
+        count, = SESSION_COUNT.unpack_from(self._data, SESSION_COUNT_OFFSET)
+        for slot in range(min(count, MAX_CAPTURED_SESSIONS)):
+            address, length, session_id = SESSION_SLOT.unpack_from(self._data, SESSION_OFFSET + slot * SESSION_SLOT.size)
+            self.sessions[socket.inet_ntoa(address)] = session_id[:length].decode("utf-8")
+
+    def records(self):
+        """Yield (time in ns, direction, frame) for every record, oldest first."""
+        data = self._data
+        offset = self.tail
+        for _ in range(self.live):
+            length, timestamp, direction = RECORD_HEADER.unpack_from(data, RING_OFFSET + offset)
+            start = RING_OFFSET + offset + RECORD_HEADER.size
+            yield timestamp, direction, data[start:start + length]
+            offset = _next_offset(data, offset + RECORD_HEADER.size + length, self.ring_size)
+
+    def close(self):
+        self._data.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="List the frames in a capture written by osi_server.py --capture.")
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--limit", type=int, default=0, help="list at most this many frames (0: all)")
+    args = parser.parse_args()
+    reader = CaptureReader(args.capture)
+    print(f"Node {reader.ip} ({reader.mac}): {reader.live} frames in the ring, {reader.written} written, "
+          f"{reader.overwritten} overwritten, {len(reader.sessions)} sessions")
+    start = None
+    for count, (timestamp, direction, frame) in enumerate(reader.records()):
+        if args.limit and count >= args.limit:
+            break
+        start = timestamp if start is None else start
+        kind = "binary" if frame[:1] == BINARY_MAGIC_BYTE else "text"
+        print(f"{(timestamp - start) / 1e9:>12.6f} {DIRECTIONS.get(direction, '?'):>3} {kind:>6} "
+              f"{len(frame):>9} {frame[:48]!r}")
+    reader.close()
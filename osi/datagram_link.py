@@ -0,0 +1,55 @@
+import logging
+import socket
+
+from packet_buffer import PacketBuffer
+from virtual_network import RealClock
+
+logger = logging.getLogger("osi.datagram")
+
+# Largest UDP payload over IPv4.
+MAX_DATAGRAM = 65507
+# Transport segment size on a datagram link, leaving room in the datagram for
+# the transport, network and data link headers.
+DATAGRAM_SEGMENT_SIZE = 60000
+# Socket buffers deep enough for a full window of segments.
+SOCKET_BUFFER = 4 * 1024 * 1024
+
+class DatagramLink:
+    """
+    Link backend of the PhysicalLayer that sends each data link frame as one UDP
+    datagram, from a single socket bound to the server's port, like the ARP
+    endpoint of the DataLinkLayer. There is no connection to set up per peer,
+    but datagrams may be lost, duplicated or reordered: the server sends every
+    message as acknowledged transport segments over this link, and clock
+    schedules their ack timeouts (see TransportLayer.start_segments).
+    """
+
+    def __init__(self, host: str = "0.0.0.0", port: int = 5000, clock=None):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        self.sock.bind((host, port))
+        self.clock = clock if clock is not None else RealClock()
+
+    def transmit(self, data, ip_address: str, dest_port: int, stream=None) -> bool:
+        """
+        Send a frame (bytes or a PacketBuffer) as one datagram. Returns True if it
+        was sent. stream is not used: datagrams are not queued by the link.
+        """
+        try:
+            if isinstance(data, PacketBuffer):
+                # Gathered from the frame's buffers, so the payload is not joined first.
+                self.sock.sendmsg(data.buffers, (), 0, (ip_address, dest_port))
+            else:
+                self.sock.sendto(data, (ip_address, dest_port))
+            return True
+        except OSError as e:
+            logger.warning("[PhysicalLayer] Error sending datagram to %s:%s: %s", ip_address, dest_port, e)
+            return False
+
+    def receive(self):
+        """Wait for the next datagram. Returns (frame, (ip, port))."""
+        return self.sock.recvfrom(MAX_DATAGRAM)
+
+    def close(self):
+        self.sock.close()
@@ -1,8 +1,43 @@
+import logging
 import uuid
 import socket
+import struct
 import threading
+import time
+import zlib
+
+logger = logging.getLogger("osi.datalink")
 
 ARP_PORT = 12345
+# Seconds to wait for an ARP reply.
+ARP_TIMEOUT = 5
+
+# First byte of every binary-mode frame. Text frames always start with "D"
+# (DL_HEADER), so a single byte is enough to tell the two apart.
+BINARY_MAGIC = 0xB1
+BINARY_MAGIC_BYTE = bytes([BINARY_MAGIC])
+# Binary data link header: magic, destination MAC, payload length.
+DL_BINARY_HEADER = struct.Struct("!B6sI")
+DL_TRAILER = "|DL_TRAILER".encode('utf-8')
+# Every frame ends with a frame check sequence: the CRC32 of everything before
+# it. Binary frames carry it as 4 bytes after the payload; text frames end with
+# "|DL_TRAILER:" and the CRC as 8 hex digits.
+DL_FCS = struct.Struct("!I")
+DL_TEXT_FCS_PREFIX = DL_TRAILER + b":"
+DL_TEXT_TRAILER_SIZE = len(DL_TEXT_FCS_PREFIX) + 8
+
+class FrameCheckError(Exception):
+    """A frame whose frame check sequence is missing or does not match."""
+
+def crc32(data, crc: int = 0) -> int:
+    """CRC32 of data (bytes, or a PacketBuffer's buffers), continuing from crc."""
+    for buf in getattr(data, "buffers", (data,)):
+        crc = zlib.crc32(buf, crc)
+    return crc
+
+def text_trailer(crc: int) -> bytes:
+    """The text frame trailer carrying crc."""
+    return DL_TEXT_FCS_PREFIX + b"%08x" % crc
 
 def get_mac_address() -> str:
     """
@@ -12,13 +47,166 @@ def get_mac_address() -> str:
                    for elements in range(0, 48, 8)[::-1])
     return mac
 
-class DataLinkLayer:
+class _Resolution:
+    """An in-flight ARP request that concurrent callers wait on."""
+
     def __init__(self):
-        self.mac = get_mac_address()
-        print(f"[DataLinkLayer] Using real MAC address: {self.mac}")
-        self.arp_table = {}  # Maps IP addresses to MAC addresses.
-        # Start the ARP responder in a background thread.
-        threading.Thread(target=self.arp_listener, daemon=True).start()
+        self.done = threading.Event()
+        self.mac = None
+
+class ArpCache:
+    """
+    IP to MAC neighbour cache.
+
+    Entries expire after ttl seconds; hosts that did not answer are cached as
+    negative entries for negative_ttl seconds. Only one request per IP is in
+    flight at a time and other callers wait for its answer. An entry used
+    within refresh_margin seconds of expiring is refreshed in the background.
+    """
+
+    def __init__(self, resolver, ttl: float = 300.0, negative_ttl: float = 30.0,
+                 refresh_margin: float = 30.0):
+        self.resolver = resolver  # callable(ip) -> MAC address or None
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_margin = refresh_margin
+        self._entries = {}   # { ip: (mac or None, expires_at) }
+        self._inflight = {}  # { ip: _Resolution }
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+        self.coalesced = 0
+        self.refreshes = 0
+        self.resolves = 0
+        self.failures = 0
+        self.resolve_time_ns = 0
+
+    def get(self, ip: str, default=None) -> str:
+        """Return the unexpired MAC address for ip without resolving or counting."""
+        entry = self._entries.get(ip)
+        if entry is None or entry[0] is None or entry[1] <= time.monotonic():
+            return default
+        return entry[0]
+
+    def __contains__(self, ip: str) -> bool:
+        return self.get(ip) is not None
+
+    def __getitem__(self, ip: str) -> str:
+        mac = self.get(ip)
+        if mac is None:
+            raise KeyError(ip)
+        return mac
+
+    def __setitem__(self, ip: str, mac: str):
+        self.learn(ip, mac)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def learn(self, ip: str, mac: str):
+        """Store a positive entry, e.g. from an ARP response."""
+        with self._lock:
+            self._entries[ip] = (mac, time.monotonic() + self.ttl)
+
+    def learn_failure(self, ip: str):
+        """Store a negative entry for a host that did not answer."""
+        with self._lock:
+            self._entries[ip] = (None, time.monotonic() + self.negative_ttl)
+
+    def lookup(self, ip: str):
+        """
+        Check the cache without blocking. Returns ("hit", mac), ("negative", None)
+        or ("miss", None) and updates the counters.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(ip)
+        if entry is not None and entry[1] > now:
+            mac, expires_at = entry
+            if mac is None:
+                self.negative_hits += 1
+                return "negative", None
+            self.hits += 1
+            if expires_at - now < self.refresh_margin and ip not in self._inflight:
+                self.refreshes += 1
+                threading.Thread(target=self._resolve, args=(ip,), daemon=True).start()
+            return "hit", mac
+        self.misses += 1
+        return "miss", None
+
+    def resolve(self, ip: str) -> str:
+        """Return the MAC address for ip, sending at most one ARP request per IP at a time."""
+        state, mac = self.lookup(ip)
+        if state != "miss":
+            return mac
+        return self._resolve(ip)
+
+    def _resolve(self, ip: str) -> str:
+        with self._lock:
+            resolution = self._inflight.get(ip)
+            leader = resolution is None
+            if leader:
+                resolution = self._inflight[ip] = _Resolution()
+            else:
+                self.coalesced += 1
+        if not leader:
+            resolution.done.wait()
+            return resolution.mac
+
+        start = time.perf_counter_ns()
+        try:
+            mac = self.resolver(ip)
+        except Exception:
+            mac = None
+        elapsed = time.perf_counter_ns() - start
+        with self._lock:
+            self.resolves += 1
+            self.resolve_time_ns += elapsed
+            now = time.monotonic()
+            if mac is None:
+                self.failures += 1
+                # A failed refresh keeps the existing entry until it expires.
+                current = self._entries.get(ip)
+                if current is None or current[0] is None or current[1] <= now:
+                    self._entries[ip] = (None, now + self.negative_ttl)
+            else:
+                self._entries[ip] = (mac, now + self.ttl)
+            del self._inflight[ip]
+        resolution.mac = mac if mac is not None else self.get(ip)
+        resolution.done.set()
+        return resolution.mac
+
+    def stats(self) -> dict:
+        """Counters for monitoring: lookups by outcome and time spent resolving."""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "coalesced": self.coalesced,
+            "refreshes": self.refreshes,
+            "resolves": self.resolves,
+            "failures": self.failures,
+            "avg_resolve_ms": self.resolve_time_ns / self.resolves / 1e6 if self.resolves else 0.0,
+        }
+
+class DataLinkLayer:
+    def __init__(self, start_arp_listener: bool = True, link=None, mac: str = None):
+        # With a link (see virtual_network.VirtualLink), ARP requests go over it
+        # instead of UDP and the link's MAC address is used.
+        self.link = link
+        if mac is None:
+            mac = get_mac_address()
+            print(f"[DataLinkLayer] Using real MAC address: {mac}")
+        self.mac = mac
+        self.mac_bytes = bytes.fromhex(self.mac.replace(':', ''))
+        # Received frames dropped because their frame check sequence did not match.
+        self.fcs_errors = 0
+        self.arp_table = ArpCache(self.send_arp_request)  # Maps IP addresses to MAC addresses.
+        # Start the ARP responder in a background thread, unless the caller serves
+        # ARP itself (the asyncio engine answers requests on its event loop).
+        if start_arp_listener:
+            threading.Thread(target=self.arp_listener, daemon=True).start()
 
     def arp_listener(self):
         """
@@ -29,63 +217,154 @@ class DataLinkLayer:
         print(f"[DataLinkLayer] ARP listener running on port {ARP_PORT} ", end="\n")
         while True:
             data, addr = sock.recvfrom(1024)
-            message = data.decode('utf-8').strip()
-            if message == "ARP_REQUEST":
-                response = f"ARP_RESPONSE:{self.mac}"
-                sock.sendto(response.encode('utf-8'), addr)
-                print(f"[DataLinkLayer] Responded to ARP request from {addr} with MAC {self.mac} ", end="\n")
+            response = self.arp_response(data)
+            if response is not None:
+                sock.sendto(response, addr)
+                logger.debug("[DataLinkLayer] Responded to ARP request from %s with MAC %s", addr, self.mac)
+
+    def arp_response(self, data: bytes) -> bytes:
+        """Return the reply to an ARP datagram, or None if it is not a request."""
+        if data.decode('utf-8', 'replace').strip() == "ARP_REQUEST":
+            return f"ARP_RESPONSE:{self.mac}".encode('utf-8')
+        return None
+
+    @staticmethod
+    def parse_arp_response(data: bytes) -> str:
+        """Return the MAC address carried by an ARP response, or None."""
+        response = data.decode('utf-8', 'replace').strip()
+        if response.startswith("ARP_RESPONSE:"):
+            return response.split("ARP_RESPONSE:")[1]
+        return None
 
     def request_mac(self, receiver_ip: str) -> str:
         """
-        Request the MAC address of the receiver via ARP.
+        Request the MAC address of the receiver via ARP, answering from the cache
+        when possible.
+        """
+        return self.arp_table.resolve(receiver_ip)
+
+    def send_arp_request(self, receiver_ip: str) -> str:
+        """
+        Send one ARP request and wait for the reply. Returns the MAC address, or None.
         """
-        if receiver_ip in self.arp_table:
-            print(f"[DataLinkLayer] Using cached MAC {self.arp_table[receiver_ip]} for IP {receiver_ip}")
-            return self.arp_table[receiver_ip]
+        if self.link is not None:
+            return self.link.arp_request(receiver_ip)
         try:
-            print(f"[DataLinkLayer] Sending ARP request to {receiver_ip}")
-            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            sock.settimeout(5)
-            sock.sendto("ARP_REQUEST".encode('utf-8'), (receiver_ip, ARP_PORT))
-            data, _ = sock.recvfrom(1024)
-            response = data.decode('utf-8').strip()
-            if response.startswith("ARP_RESPONSE:"):
-                remote_mac = response.split("ARP_RESPONSE:")[1]
-                self.arp_table[receiver_ip] = remote_mac
-                print(f"[DataLinkLayer] Learned MAC {remote_mac} for IP {receiver_ip}")
+            logger.debug("[DataLinkLayer] Sending ARP request to %s", receiver_ip)
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(ARP_TIMEOUT)
+                sock.sendto("ARP_REQUEST".encode('utf-8'), (receiver_ip, ARP_PORT))
+                data, _ = sock.recvfrom(1024)
+            remote_mac = self.parse_arp_response(data)
+            if remote_mac is not None:
+                logger.debug("[DataLinkLayer] Learned MAC %s for IP %s", remote_mac, receiver_ip)
                 return remote_mac
         except Exception as e:
-            print(f"[DataLinkLayer] Error requesting MAC from {receiver_ip}: {e}")
+            logger.warning("[DataLinkLayer] Error requesting MAC from %s: %s", receiver_ip, e)
         return None
 
+    def resolve_mac(self, receiver_ip: str) -> str:
+        """Like request_mac, but raise if the address cannot be resolved."""
+        remote_mac = self.request_mac(receiver_ip)
+        if remote_mac is None:
+            raise Exception(f"Failed to resolve MAC for {receiver_ip}")
+        return remote_mac
+
+    def header(self, receiver_ip: str) -> bytes:
+        """The text data link header for receiver_ip."""
+        return f"DL_HEADER({self.resolve_mac(receiver_ip)})|".encode('utf-8')
+
     def encapsulate(self, data: bytes, receiver_ip: str) -> bytes:
         """
         Simulate Data Link Layer encapsulation by adding a header and trailer.
-        The header contains the receiver's MAC address obtained via ARP.
+        The header contains the receiver's MAC address obtained via ARP; the
+        trailer carries the frame check sequence.
         """
-        remote_mac = self.request_mac(receiver_ip)
-        if remote_mac is None:
-            raise Exception(f"Failed to resolve MAC for {receiver_ip}")
-        header = f"DL_HEADER({remote_mac})|".encode('utf-8')
-        trailer = "|DL_TRAILER".encode('utf-8')
-        framed = header + data + trailer
-        print(f"[DataLinkLayer] Framed data: {framed}")
+        framed = self.header(receiver_ip) + data
+        framed = framed + text_trailer(crc32(framed))
+        logger.debug("[DataLinkLayer] Framed data: %s", framed)
         return framed
 
-    def decapsulate(self, data: bytes) -> bytes:
-        decoded = data.decode('utf-8')
+    def check_fcs(self, frame) -> bool:
+        """
+        Whether a received frame, text or binary, ends with a frame check sequence
+        that matches its contents. Only the end of the frame is looked at, so this
+        runs before any header is parsed. Failures are counted in fcs_errors.
+        """
+        view = memoryview(frame)
+        if view[:1] == BINARY_MAGIC_BYTE:
+            end = len(view) - DL_FCS.size
+            ok = end >= 0 and zlib.crc32(view[:end]) == DL_FCS.unpack_from(view, end)[0]
+        else:
+            end = len(view) - DL_TEXT_TRAILER_SIZE
+            try:
+                ok = (end >= 0 and view[end:end + len(DL_TEXT_FCS_PREFIX)] == DL_TEXT_FCS_PREFIX
+                      and zlib.crc32(view[:end]) == int(bytes(view[-8:]), 16))
+            except ValueError:
+                ok = False
+        if not ok:
+            self.fcs_errors += 1
+        return ok
+
+    def verify_frames(self, frames: list) -> list:
+        """
+        Check the frame check sequences of a batch of frames, such as the frames of
+        one read from a connection. Returns the frames that passed, in order.
+        """
+        return [frame for frame in frames if self.check_fcs(frame)]
+
+    def decapsulate(self, data: bytes, check: bool = True) -> bytes:
+        """
+        Strip the data link header and trailer from a text frame. The frame check
+        sequence is verified first, unless check is False because the frame was
+        already verified (see verify_frames); a bad frame raises FrameCheckError.
+        """
         # Remove the header and trailer if present.
-        if decoded.startswith("DL_HEADER(") and "|DL_TRAILER" in decoded:
-            header_end = decoded.find("|")
-            trailer_start = decoded.rfind("|DL_TRAILER")
+        if data.startswith(b"DL_HEADER("):
+            if check and not self.check_fcs(data):
+                raise FrameCheckError("Frame check sequence mismatch")
+            header_end = data.find(b"|")
             # Extract the MAC address from the header, subtracting 1 to remove the closing ')'
-            header = decoded[10:header_end-1]
+            header = data[10:header_end-1].decode('utf-8')
             if header == self.mac:
-                print(f"[DataLinkLayer] MAC address matched: {header}")
-                inner = decoded[header_end+1:trailer_start]
-                print(f"[DataLinkLayer] Decapsulated data: {inner}")
-                return inner.encode('utf-8')
+                logger.debug("[DataLinkLayer] MAC address matched: %s", header)
+                inner = data[header_end+1:len(data) - DL_TEXT_TRAILER_SIZE]
+                logger.debug("[DataLinkLayer] Decapsulated data: %s", inner)
+                return inner
             else:
                 raise Exception(f"MAC address mismatch: expected {self.mac}, got {header}")
         return data
 
+    def encapsulate_binary(self, data: bytes, receiver_ip: str) -> bytes:
+        """
+        Binary counterpart of encapsulate: a fixed-size header carrying the magic byte,
+        the receiver's MAC address and the payload length, and a 4-byte frame check
+        sequence after the payload.
+        """
+        remote_mac = self.resolve_mac(receiver_ip)
+        header = DL_BINARY_HEADER.pack(BINARY_MAGIC, bytes.fromhex(remote_mac.replace(':', '')), len(data))
+        framed = header + data
+        framed = framed + DL_FCS.pack(crc32(framed))
+        logger.debug("[DataLinkLayer] Framed %s bytes (binary)", len(framed))
+        return framed
+
+    def decapsulate_binary(self, data: memoryview, check: bool = True) -> memoryview:
+        """
+        Parse a binary frame and return a view of its payload without copying it.
+        The frame check sequence is verified first, as in decapsulate.
+        """
+        if check and not self.check_fcs(data):
+            raise FrameCheckError("Frame check sequence mismatch")
+        if len(data) < DL_BINARY_HEADER.size + DL_FCS.size:
+            raise Exception("Truncated binary frame header.")
+        magic, dest_mac, length = DL_BINARY_HEADER.unpack_from(data)
+        if magic != BINARY_MAGIC:
+            raise Exception(f"Invalid binary frame magic: {magic:#x}")
+        if dest_mac != self.mac_bytes:
+            raise Exception(f"MAC address mismatch: expected {self.mac}, got {dest_mac.hex(':')}")
+        end = DL_BINARY_HEADER.size + length
+        if len(data) != end + DL_FCS.size:
+            raise Exception(f"Binary frame length mismatch: header says {length} payload bytes, "
+                            f"got {len(data) - DL_BINARY_HEADER.size - DL_FCS.size}")
+        logger.debug("[DataLinkLayer] MAC address matched: %s", self.mac)
+        return data[DL_BINARY_HEADER.size:end]
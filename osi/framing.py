@@ -0,0 +1,130 @@
+import socket
+import struct
+
+from packet_buffer import PacketBuffer
+
+# Every message on an OSI TCP connection is preceded by its length.
+LENGTH_PREFIX = struct.Struct("!I")
+# Upper bound on a single message; a larger length prefix is treated as a corrupt stream.
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Read size used when draining a connection.
+RECV_SIZE = 65536
+# Payloads above this size are sent after the prefix rather than copied behind it.
+COALESCE_LIMIT = 64 * 1024
+# Most buffers passed to one sendmsg call (the usual IOV_MAX).
+MAX_IOV = 1024
+
+def encode_frame(payload: bytes) -> bytes:
+    """Prefix payload with its length."""
+    return LENGTH_PREFIX.pack(len(payload)) + payload
+
+def frame_buffers(payload) -> list:
+    """The length prefix followed by the buffers of payload (bytes or a PacketBuffer)."""
+    buffers = payload.buffers if isinstance(payload, PacketBuffer) else [payload]
+    return [LENGTH_PREFIX.pack(len(payload))] + buffers
+
+def send_frame(sock: socket.socket, payload: bytes):
+    """
+    Send one length-prefixed message on sock. A PacketBuffer is sent with
+    sendmsg, straight from its buffers.
+    """
+    if isinstance(payload, PacketBuffer):
+        send_buffers(sock, frame_buffers(payload))
+    elif len(payload) <= COALESCE_LIMIT:
+        sock.sendall(LENGTH_PREFIX.pack(len(payload)) + payload)
+    else:
+        sock.sendall(LENGTH_PREFIX.pack(len(payload)))
+        sock.sendall(payload)
+
+def send_buffers(sock: socket.socket, buffers: list):
+    """Send buffers back to back, gathering them into as few sendmsg calls as possible."""
+    if not hasattr(sock, "sendmsg"):
+        for buf in buffers:
+            sock.sendall(buf)
+        return
+    views = [memoryview(buf) for buf in buffers]
+    while views:
+        sent = sock.sendmsg(views[:MAX_IOV])
+        # Drop what was sent; a partially sent buffer is resumed from where it stopped.
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+def recv_frame(sock: socket.socket, max_message_size: int = MAX_MESSAGE_SIZE) -> bytes:
+    """
+    Read exactly one length-prefixed message from sock. Used for request/response
+    exchanges (such as the session handshake) where nothing follows the reply.
+    Returns None if the connection closes first.
+    """
+    header = _recv_exactly(sock, LENGTH_PREFIX.size)
+    if header is None:
+        return None
+    (length,) = LENGTH_PREFIX.unpack(header)
+    if length > max_message_size:
+        raise Exception(f"Message of {length} bytes exceeds limit of {max_message_size}")
+    return _recv_exactly(sock, length)
+
+def _recv_exactly(sock: socket.socket, size: int) -> bytes:
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return None
+        received += n
+    return bytes(buf)
+
+class StreamBuffer:
+    """
+    Reassemble length-prefixed messages from a TCP byte stream.
+
+    Chunks from recv are appended with feed(), which returns every message that
+    is now complete (as bytearrays). Only the unfinished tail of the stream is
+    kept, so memory is bounded by max_message_size plus one read.
+    """
+
+    def __init__(self, max_message_size: int = MAX_MESSAGE_SIZE):
+        self.max_message_size = max_message_size
+        self._buf = bytearray()
+        # Length of the message currently being assembled, once its prefix has arrived.
+        self._expected = None
+
+    def __len__(self) -> int:
+        return len(self._buf)
+
+    def feed(self, data: bytes) -> list:
+        self._buf += data
+        messages = []
+        offset = 0
+        buffered = len(self._buf)
+        while True:
+            if self._expected is None:
+                if buffered - offset < LENGTH_PREFIX.size:
+                    break
+                (length,) = LENGTH_PREFIX.unpack_from(self._buf, offset)
+                if length > self.max_message_size:
+                    raise Exception(f"Message of {length} bytes exceeds limit of {self.max_message_size}")
+                offset += LENGTH_PREFIX.size
+                self._expected = length
+            if buffered - offset < self._expected:
+                break
+            end = offset + self._expected
+            # Slicing a bytearray copies once; the result is a bytearray.
+            messages.append(self._buf[offset:end])
+            offset = end
+            self._expected = None
+        if offset:
+            del self._buf[:offset]
+        return messages
+
+    def read_from(self, sock: socket.socket) -> list:
+        """
+        Receive once from sock and return the completed messages.
+        Returns None when the peer has closed the connection.
+        """
+        data = sock.recv(RECV_SIZE)
+        if not data:
+            return None
+        return self.feed(data)
@@ -0,0 +1,106 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+from datalink_layer import BINARY_MAGIC, DL_BINARY_HEADER, DL_FCS, crc32, text_trailer
+from packet_buffer import PacketBuffer
+
+class HeaderTemplate:
+    """
+    The precomputed lower-layer headers for one (dest_ip, dest_port), together
+    with the session id and MAC address they were built from.
+    """
+
+    def __init__(self, session_id: str, mac: str, prefix: bytes, binary: bool):
+        self.session_id = session_id
+        self.mac = mac
+        self.prefix = prefix
+        self.binary = binary
+        if binary:
+            self.mac_bytes = bytes.fromhex(mac.replace(':', ''))
+        else:
+            # The frame check sequence covers the prefix, so its CRC is computed once.
+            self.prefix_crc = zlib.crc32(prefix)
+
+    def frame(self, payload: bytes) -> PacketBuffer:
+        """Wrap payload in the cached headers without copying it."""
+        packet = PacketBuffer(payload)
+        if self.binary:
+            # Only the data link length field and the frame check sequence depend on the payload.
+            dl_header = DL_BINARY_HEADER.pack(BINARY_MAGIC, self.mac_bytes, len(self.prefix) + len(payload))
+            crc = crc32(payload, zlib.crc32(self.prefix, zlib.crc32(dl_header)))
+            return packet.prepend(self.prefix).prepend(dl_header).append(DL_FCS.pack(crc))
+        return packet.prepend(self.prefix).append(text_trailer(crc32(payload, self.prefix_crc)))
+
+class HeaderCache:
+    """
+    Per-destination cache of the session, transport, network and data link
+    headers. An entry is rebuilt when the session id or the ARP entry of the
+    next hop it was built from changes (including a route change to a different
+    next hop), so steady-state sends skip the per-layer encapsulation.
+    Looking up the session and ARP entry also marks them as used, which keeps
+    the session from being evicted as idle and refreshes the ARP entry before
+    it expires.
+    """
+
+    def __init__(self, session_layer, transport_layer, network_layer, data_link_layer,
+                 binary: bool = False, max_entries: int = 4096):
+        self.session_layer = session_layer
+        self.transport_layer = transport_layer
+        self.network_layer = network_layer
+        self.data_link_layer = data_link_layer
+        self.binary = binary
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # { (dest_ip, dest_port): HeaderTemplate }
+        # Senders on many threads share the cache. The lock covers only the
+        # OrderedDict; building a template, which may run a session handshake or an
+        # ARP request, happens outside it.
+        self._lock = threading.Lock()
+
+    def lookup(self, dest_ip: str, dest_port: int) -> HeaderTemplate:
+        """Return a valid template for the destination, building it if needed."""
+        key = (dest_ip, dest_port)
+        template = self._entries.get(key)
+        if (template is not None
+                and template.session_id == self.session_layer.lookup_session(dest_ip)
+                and template.mac == self.data_link_layer.arp_table.lookup(self.network_layer.next_hop(dest_ip))[1]):
+            with self._lock:
+                if key in self._entries:
+                    self._entries.move_to_end(key)
+            return template
+        template = self._build(dest_ip, dest_port)
+        with self._lock:
+            self._entries[key] = template
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return template
+
+    def frame(self, payload: bytes, dest_ip: str, dest_port: int) -> PacketBuffer:
+        return self.lookup(dest_ip, dest_port).frame(payload)
+
+    def invalidate(self, dest_ip: str = None):
+        """Drop the entries for dest_ip, or every entry."""
+        with self._lock:
+            if dest_ip is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == dest_ip]:
+                del self._entries[key]
+
+    def _build(self, dest_ip: str, dest_port: int) -> HeaderTemplate:
+        # Resolving the session and MAC first may run a handshake or an ARP request.
+        session_id = self.session_layer.ensure_session(dest_ip)
+        # The data link header addresses the next hop, not the destination.
+        next_hop = self.network_layer.next_hop(dest_ip)
+        mac = self.data_link_layer.resolve_mac(next_hop)
+        if self.binary:
+            prefix = (self.network_layer.binary_header(dest_ip)
+                      + self.transport_layer.binary_header(dest_port)
+                      + self.session_layer.binary_header(dest_ip))
+            return HeaderTemplate(session_id, mac, prefix, binary=True)
+        prefix = (self.data_link_layer.header(next_hop)
+                  + self.network_layer.header(dest_ip)
+                  + self.transport_layer.header(dest_port)
+                  + self.session_layer.header(dest_ip))
+        return HeaderTemplate(session_id, mac, prefix, binary=False)
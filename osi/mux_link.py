@@ -0,0 +1,218 @@
+import collections
+import logging
+import socket
+import threading
+
+from framing import StreamBuffer, frame_buffers, send_buffers
+from virtual_network import RealClock
+
+logger = logging.getLogger("osi.mux")
+
+# Seconds to wait when connecting to a peer server.
+CONNECT_TIMEOUT = 5.0
+
+class MuxStream:
+    """The frames of one stream waiting to be written, and its counters."""
+
+    def __init__(self):
+        self.frames = collections.deque()
+        self.queued_bytes = 0
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0  # queued, then discarded when the connection closed
+
+    def stats(self) -> dict:
+        return {
+            "queued_frames": len(self.frames),
+            "queued_bytes": self.queued_bytes,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+            "dropped_frames": self.dropped_frames,
+        }
+
+class MuxConnection:
+    """
+    One long-lived TCP connection to a peer server carrying the frames of many
+    streams. Each stream has its own queue, and the writer thread takes one frame
+    from every stream with frames waiting, in turn, so a frame never waits behind
+    more than one frame of each other stream. The frames taken in one turn are
+    written with one gathered sendmsg. A reader thread passes what the peer sends
+    back (transport acks) to the link's node.
+
+    Frames are reported sent once they are queued. If the connection fails, the
+    frames of the turn being written and those still queued are discarded and
+    counted in dropped_frames, not sent again: delivery is at most once.
+    """
+
+    def __init__(self, link, ip: str, port: int, sock: socket.socket):
+        self.link = link
+        self.ip = ip
+        self.port = port
+        self.sock = sock
+        self.closed = False
+        self.streams = {}                    # { stream id: MuxStream }
+        self._ready = collections.deque()    # ids of streams with frames waiting, in turn order
+        self._cond = threading.Condition()
+        threading.Thread(target=self._write_loop, daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def send(self, frame, stream_id) -> bool:
+        """Queue frame on the stream. Returns False if the connection is closed."""
+        with self._cond:
+            if self.closed:
+                return False
+            stream = self.streams.get(stream_id)
+            if stream is None:
+                stream = self.streams[stream_id] = MuxStream()
+            if not stream.frames:
+                self._ready.append(stream_id)
+                self._cond.notify()
+            stream.frames.append(frame)
+            stream.queued_bytes += len(frame)
+        return True
+
+    def _next_turn(self) -> list:
+        """One (stream, frame) from every stream with frames waiting. Caller holds the lock."""
+        turn = []
+        for _ in range(len(self._ready)):
+            stream_id = self._ready.popleft()
+            stream = self.streams[stream_id]
+            frame = stream.frames.popleft()
+            stream.queued_bytes -= len(frame)
+            turn.append((stream, frame))
+            if stream.frames:
+                self._ready.append(stream_id)
+        return turn
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._ready and not self.closed:
+                    self._cond.wait()
+                if self.closed:
+                    return
+                turn = self._next_turn()
+            try:
+                send_buffers(self.sock, [buf for _, frame in turn for buf in frame_buffers(frame)])
+            except OSError as e:
+                logger.warning("[MuxLink] Error writing to %s:%s: %s", self.ip, self.port, e)
+                with self._cond:
+                    for stream, _ in turn:
+                        stream.dropped_frames += 1
+                self.close()
+                return
+            with self._cond:
+                for stream, frame in turn:
+                    stream.sent_frames += 1
+                    stream.sent_bytes += len(frame)
+
+    def _read_loop(self):
+        buffer = StreamBuffer()
+        try:
+            while True:
+                messages = buffer.read_from(self.sock)
+                if messages is None:
+                    break
+                for message in messages:
+                    self.link.node.handle_link_frame(bytes(message), self.ip)
+        except Exception as e:
+            if not self.closed:
+                logger.warning("[MuxLink] Error reading from %s:%s: %s", self.ip, self.port, e)
+        finally:
+            self.close()
+
+    def close(self):
+        """Close the connection; frames still queued on it are discarded."""
+        with self._cond:
+            if self.closed:
+                return
+            self.closed = True
+            for stream in self.streams.values():
+                stream.dropped_frames += len(stream.frames)
+                stream.frames.clear()
+                stream.queued_bytes = 0
+            self._ready.clear()
+            self._cond.notify_all()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.link.forget(self)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {f"{src}->{dest}": stream.stats() for (src, dest), stream in self.streams.items()}
+
+class MuxLink:
+    """
+    Link backend of the PhysicalLayer that keeps one connection per peer server
+    (see MuxConnection) and multiplexes every stream to that peer over it. A
+    stream is identified by (source port, destination port): the listening port
+    of the chat client that sent the message and the port it is addressed to.
+
+    Flow control is per stream. Large messages are sent as transport segments with
+    their own window of acks (see TransportLayer.start_segments, timed on clock),
+    so a large transfer keeps at most one window of segments queued, and the
+    writer's turns keep it from delaying other streams' frames by more than one
+    segment each.
+
+    Delivery is at most once: transmit returns True once a frame is queued, and
+    frames queued on a connection that then fails are dropped (see
+    MuxConnection), so the outbox cannot be used with this link.
+    """
+
+    def __init__(self, node, clock=None):
+        self.node = node
+        self.clock = clock if clock is not None else RealClock()
+        self._connections = {}  # { (ip, port): MuxConnection }
+        self._lock = threading.Lock()
+
+    def transmit(self, data, ip_address: str, dest_port: int, stream=None) -> bool:
+        """
+        Queue a frame for the peer server at ip_address:dest_port on stream (default
+        (0, 0)). Returns False if there is no connection; True does not mean the
+        frame will be written (see MuxConnection).
+        """
+        connection = self._connection(ip_address, dest_port)
+        if connection is None:
+            return False
+        return connection.send(data, stream if stream is not None else (0, 0))
+
+    def _connection(self, ip_address: str, dest_port: int) -> MuxConnection:
+        key = (ip_address, dest_port)
+        connection = self._connections.get(key)
+        if connection is not None and not connection.closed:
+            return connection
+        try:
+            logger.debug("[MuxLink] Connecting to %s:%s", ip_address, dest_port)
+            sock = socket.create_connection(key, timeout=CONNECT_TIMEOUT)
+            sock.settimeout(None)
+        except OSError as e:
+            logger.warning("[MuxLink] Error connecting to %s:%s: %s", ip_address, dest_port, e)
+            return None
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is not None and not connection.closed:
+                # Another thread connected first; use its connection.
+                sock.close()
+                return connection
+            connection = self._connections[key] = MuxConnection(self, ip_address, dest_port, sock)
+        return connection
+
+    def forget(self, connection: MuxConnection):
+        with self._lock:
+            if self._connections.get((connection.ip, connection.port)) is connection:
+                del self._connections[(connection.ip, connection.port)]
+
+    def stats(self) -> dict:
+        """Queued and sent frames and bytes per stream, per peer."""
+        with self._lock:
+            connections = list(self._connections.values())
+        return {f"{c.ip}:{c.port}": c.stats() for c in connections}
+
+    def close(self):
+        with self._lock:
+            connections = list(self._connections.values())
+        for connection in connections:
+            connection.close()
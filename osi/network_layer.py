@@ -1,44 +1,172 @@
+import logging
+import socket
+import struct
 from typing import Tuple
 
+from packet_buffer import PacketBuffer
+
+logger = logging.getLogger("osi.network")
+
+# Binary network header: version, source and destination IPv4 addresses and the TTL.
+IP_BINARY_VERSION = 1
+IP_BINARY_HEADER = struct.Struct("!B4s4sB")
+# Hops a packet may take before it is dropped.
+DEFAULT_TTL = 64
+
+class RoutingTable:
+    """
+    IPv4 routes with longest-prefix-match lookup. Routes are indexed by prefix
+    length, one dict per length, so a lookup costs at most one dict probe per
+    distinct prefix length (33 at most) however many routes there are.
+    """
+
+    def __init__(self):
+        self._by_length = {}  # { prefix length: { network >> (32 - length): next_hop } }
+        self._lengths = []    # prefix lengths in use, longest first
+
+    @staticmethod
+    def _parse(prefix: str) -> Tuple[int, int]:
+        address, _, length = prefix.partition("/")
+        length = int(length) if length else 32
+        if not 0 <= length <= 32:
+            raise ValueError(f"Invalid prefix length in {prefix}")
+        return int.from_bytes(socket.inet_aton(address), "big") >> (32 - length), length
+
+    def add_route(self, prefix: str, next_hop: str = None):
+        """
+        Route prefix ("10.1.0.0/16") via next_hop. Without a next hop the prefix
+        is directly connected: packets go straight to their destination.
+        """
+        network, length = self._parse(prefix)
+        if length not in self._by_length:
+            self._by_length[length] = {}
+            self._lengths = sorted(self._by_length, reverse=True)
+        self._by_length[length][network] = next_hop
+
+    def remove_route(self, prefix: str):
+        network, length = self._parse(prefix)
+        routes = self._by_length.get(length)
+        if routes is not None and routes.pop(network, False) is not False and not routes:
+            del self._by_length[length]
+            self._lengths = sorted(self._by_length, reverse=True)
+
+    def lookup(self, ip: str) -> str:
+        """
+        The next hop toward ip by longest prefix match: the route's next hop, ip
+        itself for a directly connected route, or None if no route matches.
+        """
+        address = int.from_bytes(socket.inet_aton(ip), "big")
+        for length in self._lengths:
+            routes = self._by_length[length]
+            network = address >> (32 - length)
+            if network in routes:
+                next_hop = routes[network]
+                return next_hop if next_hop is not None else ip
+        return None
+
+    def __len__(self) -> int:
+        return sum(len(routes) for routes in self._by_length.values())
+
 class NetworkLayer:
-    def __init__(self, src_ip: str):
+    def __init__(self, src_ip: str, ttl: int = DEFAULT_TTL):
         """
-        Initialize the NetworkLayer with a source IP address.
+        Initialize the NetworkLayer with a source IP address. Packets for
+        destinations without a matching route are sent to the destination directly.
         """
         self.src_ip = src_ip
+        self.ttl = ttl
+        self.routes = RoutingTable()
+
+    def next_hop(self, dest_ip: str) -> str:
+        """The host a packet for dest_ip is handed to next."""
+        next_hop = self.routes.lookup(dest_ip)
+        return next_hop if next_hop is not None else dest_ip
+
+    def header(self, dest_ip: str, ttl: int = None, src_ip: str = None) -> bytes:
+        """The text network header for dest_ip."""
+        ttl = self.ttl if ttl is None else ttl
+        return f"IP_HEADER:{src_ip or self.src_ip},{dest_ip},{ttl}|".encode('utf-8')
+
+    def binary_header(self, dest_ip: str) -> bytes:
+        """The binary network header for dest_ip."""
+        return IP_BINARY_HEADER.pack(IP_BINARY_VERSION, socket.inet_aton(self.src_ip), socket.inet_aton(dest_ip),
+                                     self.ttl)
 
     def encapsulate(self, data: bytes, dest_ip: str) -> bytes:
         """
         Encapsulate the data (from the transport layer) with a network (IP) header.
         The header includes the source and destination IP addresses.
-        Format: "IP_HEADER:<src_ip>,<dest_ip>|" followed by the transport segment.
+        Format: "IP_HEADER:<src_ip>,<dest_ip>,<ttl>|" followed by the transport segment.
         """
-        header_str = f"IP_HEADER:{self.src_ip},{dest_ip}|"
-        header_bytes = header_str.encode('utf-8')
-        encapsulated_data = header_bytes + data
-        print(f"[NetworkLayer] Encapsulated data: {encapsulated_data}")
+        encapsulated_data = self.header(dest_ip) + data
+        logger.debug("[NetworkLayer] Encapsulated data: %s", encapsulated_data)
         return encapsulated_data
 
-    def decapsulate(self, data: bytes) -> Tuple[bytes, str]:
+    def decapsulate(self, data: bytes, forward=None) -> Tuple[bytes, str]:
         """
         Decapsulate the network (IP) header from the data.
         Verify that the destination IP in the header matches our own IP (self.src_ip).
         Returns a tuple: (inner_data as bytes, sender_ip as str).
+        A packet for another host is passed, with its TTL decremented, to
+        forward(packet, dest_ip) and the inner data returned is None; without
+        forward it is an error.
         """
         decoded = data.decode('utf-8')
         if decoded.startswith("IP_HEADER:") and "|" in decoded:
             header_end = decoded.find("|")
             # Remove the "IP_HEADER:" prefix.
             header = decoded[len("IP_HEADER:"):header_end]
-            # The header should be in the format "<sender_ip>,<dest_ip>"
+            # The header should be in the format "<sender_ip>,<dest_ip>,<ttl>"; older
+            # peers leave out the TTL.
             parts = header.split(",")
-            if len(parts) != 2:
+            if len(parts) not in (2, 3):
                 raise Exception("Invalid IP header format.")
-            sender_ip, dest_ip = parts
+            sender_ip, dest_ip = parts[:2]
+            inner = decoded[header_end+1:]
             # Verify that the destination IP matches our own.
             if dest_ip != self.src_ip:
-                raise Exception(f"Packet not addressed to us: expected {self.src_ip}, got {dest_ip}")
-            inner = decoded[header_end+1:]
-            print(f"[NetworkLayer] Decapsulated data: {inner}")
+                if forward is None:
+                    raise Exception(f"Packet not addressed to us: expected {self.src_ip}, got {dest_ip}")
+                ttl = self._next_ttl(int(parts[2]) if len(parts) == 3 else self.ttl, sender_ip, dest_ip)
+                forward(self.header(dest_ip, ttl, sender_ip) + inner.encode('utf-8'), dest_ip)
+                return None, sender_ip
+            logger.debug("[NetworkLayer] Decapsulated data: %s", inner)
             return inner.encode('utf-8'), sender_ip
         return data, None
+
+    def encapsulate_binary(self, data: bytes, dest_ip: str) -> bytes:
+        """
+        Binary counterpart of encapsulate: the header version, the source and
+        destination addresses as packed 4-byte IPv4 addresses, and the TTL.
+        """
+        header = self.binary_header(dest_ip)
+        logger.debug("[NetworkLayer] Encapsulated %s bytes (binary)", len(data))
+        return header + data
+
+    def decapsulate_binary(self, data: memoryview, forward=None) -> Tuple[memoryview, str]:
+        """
+        Parse the binary network header and return (payload view, sender_ip).
+        Packets for other hosts are handled as in decapsulate. Headers of another
+        version are rejected.
+        """
+        if len(data) < IP_BINARY_HEADER.size:
+            raise Exception("Truncated binary IP header.")
+        version, src, dest, ttl = IP_BINARY_HEADER.unpack_from(data)
+        if version != IP_BINARY_VERSION:
+            raise Exception(f"Unsupported binary IP header version {version}, expected {IP_BINARY_VERSION}")
+        sender_ip, dest_ip = socket.inet_ntoa(src), socket.inet_ntoa(dest)
+        if dest_ip != self.src_ip:
+            if forward is None:
+                raise Exception(f"Packet not addressed to us: expected {self.src_ip}, got {dest_ip}")
+            # Only the header is rebuilt; the rest of the packet is passed on as a view.
+            header = IP_BINARY_HEADER.pack(version, src, dest, self._next_ttl(ttl, sender_ip, dest_ip))
+            forward(PacketBuffer(data[IP_BINARY_HEADER.size:]).prepend(header), dest_ip)
+            return None, sender_ip
+        return data[IP_BINARY_HEADER.size:], sender_ip
+
+    @staticmethod
+    def _next_ttl(ttl: int, sender_ip: str, dest_ip: str) -> int:
+        """The TTL of a packet after this hop; raises if the packet must be dropped."""
+        if ttl <= 1:
+            raise Exception(f"TTL expired for packet from {sender_ip} to {dest_ip}")
+        return ttl - 1
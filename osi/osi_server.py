@@ -1,16 +1,38 @@
+import contextlib
+import logging
 import socket
 import threading
 import json
+from concurrent.futures import ThreadPoolExecutor
 
 from cryptography.fernet import Fernet
 
 from application_layer import ApplicationLayer
-from datalink_layer import DataLinkLayer
-from presentation_layer import PresentationLayer
+from capture import FrameCapture, CAPTURE_IN, DEFAULT_CAPTURE_SIZE
+from datalink_layer import DataLinkLayer, FrameCheckError, BINARY_MAGIC_BYTE
+from presentation_layer import PresentationLayer, PROFILES
+from presentation_pool import PresentationPool
 from session_layer import SessionLayer
-from transport_layer import TransportLayer
+from transport_layer import TransportLayer, SEGMENT_SIZE, WINDOW
 from network_layer import NetworkLayer
 from physical_layer import PhysicalLayer
+from datagram_link import DatagramLink, DATAGRAM_SEGMENT_SIZE
+from mux_link import MuxLink
+from outbound_queue import OutboundQueues, QUEUE_POLICIES, BLOCK_TIMEOUT
+from outbox import Outbox
+from framing import StreamBuffer, send_frame
+from header_cache import HeaderCache
+from packet_buffer import PacketBuffer
+from tracing import Tracer
+from zdict import load_dictionary
+
+logger = logging.getLogger("osi.server")
+
+# send_group hands the per-destination sends to the fan-out threads only when a
+# send is long enough to overlap with others: a large payload, or many peers.
+# Below both, the thread handoff costs more than the framing it spreads out.
+FANOUT_MIN_BYTES = 16 * 1024
+FANOUT_MIN_DESTINATIONS = 32
 
 def get_own_ip():
     """
@@ -25,157 +47,935 @@ def get_own_ip():
         ip = "127.0.0.1"
     return ip
 
+def load_presentation_key(path: str) -> bytes:
+    """The presentation key kept in path, which is created with a new key if it does not exist."""
+    try:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        key = Fernet.generate_key()
+        with open(path, "xb") as f:
+            f.write(key)
+        return key
+
 class OSIServer:
-    def __init__(self, host="0.0.0.0", port=5000):
+    def __init__(self, host="0.0.0.0", port=5000, wire_format="text", arp_listener=True,
+                 cache_headers=True, tracer=None, presentation_profile="aesgcm",
+                 presentation_workers=0, presentation_pool="process", segment_size=SEGMENT_SIZE,
+                 window=WINDOW, ip=None, switch=None, presentation_key=None, routes=None, link_mode="tcp",
+                 outbound_queue_size=1024, outbound_policy="block", outbound_block_timeout=BLOCK_TIMEOUT,
+                 outbox_dir=None,
+                 outbox_max_bytes=256 * 1024 * 1024, fanout_workers=8, presentation_dictionaries=None,
+                 app_encoding="json", mac=None, capture_path=None, capture_size=DEFAULT_CAPTURE_SIZE):
         self.host = host
         self.port = port
-        self.ip = get_own_ip()
-        self.app_layer = ApplicationLayer()
-        self.presentation_layer = PresentationLayer(key=Fernet.generate_key())
-        self.session_layer = SessionLayer(port=port)
-        self.transport_layer = TransportLayer()
+        # "text" keeps the original human-readable headers; "binary" sends fixed-size
+        # struct headers. Incoming frames are accepted in either format.
+        if wire_format not in ("text", "binary"):
+            raise ValueError(f"Unknown wire format: {wire_format}")
+        self.wire_format = wire_format
+        self.ip = ip if ip is not None else get_own_ip()
+        # On a virtual_network.VirtualSwitch the node sends frames, ARP requests and
+        # session handshakes over its switch port; it opens no sockets.
+        self.link = switch.attach(self.ip, self) if switch is not None else None
+        # In "udp" link mode frames to other servers are sent as datagrams from one
+        # socket instead of over pooled TCP connections; sessions and client
+        # registrations still use TCP. In "mux" link mode they share one TCP
+        # connection per peer server, scheduled per stream (see mux_link.MuxLink).
+        if link_mode not in ("tcp", "udp", "mux"):
+            raise ValueError(f"Unknown link mode: {link_mode}")
+        self.datagram_link = None
+        if link_mode == "udp" and self.link is None:
+            self.datagram_link = DatagramLink(host, port)
+            segment_size = min(segment_size, DATAGRAM_SEGMENT_SIZE)
+        self.mux_link = MuxLink(self) if link_mode == "mux" and self.link is None else None
+        # Payloads over segment_size are sent as segments with a sliding window of acks.
+        self.transport_layer = TransportLayer(segment_size=segment_size, window=window)
+        # "binary" sends chat messages in the compact application encoding; incoming
+        # messages are accepted in either encoding.
+        self.app_layer = ApplicationLayer(transport_layer=self.transport_layer, encoding=app_encoding)
+        # Nodes that exchange messages must share presentation_key, and the
+        # compression dictionaries ({id: bytes}, see zdict.py) they send with.
+        self.presentation_layer = PresentationLayer(key=presentation_key or Fernet.generate_key(),
+                                                    profile=PROFILES[presentation_profile],
+                                                    dictionaries=presentation_dictionaries)
+        # With presentation_workers > 0, compression and encryption run on a pool of
+        # worker processes (or threads) instead of the connection threads.
+        self.presentation_pool = PresentationPool(self.presentation_layer, presentation_workers,
+                                                  mode=presentation_pool) if presentation_workers else None
+        # routes maps prefixes ("10.1.0.0/16") to next hops; frames for other hosts
+        # that reach this node are forwarded along them.
         self.network_layer = NetworkLayer(src_ip=self.ip)
-        self.data_link_layer = DataLinkLayer()
-        self.physical_layer = PhysicalLayer()
+        for prefix, next_hop in (routes or {}).items():
+            self.network_layer.routes.add_route(prefix, next_hop)
+        # Session handshakes follow the same routes as frames.
+        self.session_layer = SessionLayer(port=port, link=self.link, ip=self.ip, next_hop=self.network_layer.next_hop)
+        if self.link is not None:
+            self.data_link_layer = DataLinkLayer(start_arp_listener=False, link=self.link, mac=self.link.mac)
+        else:
+            self.data_link_layer = DataLinkLayer(start_arp_listener=arp_listener, mac=mac)
+        # With capture_path, frames sent and received (before any header is parsed)
+        # and the sessions they belong to are recorded in a ring buffer file of
+        # capture_size bytes, for replay.py.
+        self.capture = FrameCapture(capture_path, capture_size, self.ip, self.data_link_layer.mac) \
+            if capture_path is not None else None
+        if self.capture is not None:
+            self.session_layer.on_store = self.capture.record_session
+        self.physical_layer = PhysicalLayer(link=self.link or self.datagram_link or self.mux_link,
+                                            capture=self.capture)
+        # Per-destination lower-layer headers; None runs every layer's encapsulate per message.
+        self.header_cache = HeaderCache(
+            self.session_layer, self.transport_layer, self.network_layer, self.data_link_layer,
+            binary=(wire_format == "binary")) if cache_headers else None
+        # Messages from chat clients wait in a bounded queue per destination, sent
+        # by that destination's writer thread (see queue_message).
+        self.outbound = OutboundQueues(self.send_messages, max_depth=outbound_queue_size,
+                                       policy=outbound_policy, block_timeout=outbound_block_timeout)
+        # With outbox_dir, messages that cannot be delivered are kept on disk and
+        # retried with backoff (see outbox.Outbox); messages stored there by an
+        # earlier run are retried too. A mux link reports a frame sent once it is
+        # queued and may still lose it, so the outbox would count it delivered.
+        if outbox_dir is not None and self.mux_link is not None:
+            raise ValueError("The outbox cannot be used with the mux link, which delivers at most once")
+        self.outbox = Outbox(outbox_dir, self.deliver_stored, max_bytes=outbox_max_bytes) \
+            if outbox_dir is not None else None
+        # Named destination lists and the threads that send to them (see send_group).
+        self.groups = {}
+        self.fanout = ThreadPoolExecutor(max_workers=fanout_workers, thread_name_prefix="fanout")
+        # Per-stage latency histograms and packet counters (see stats()).
+        self.tracer = tracer if tracer is not None else Tracer()
         self.server_socket = None
+        # Chat clients by (ip, listening port), and the key of each client's connection.
         self.registered_clients = {}
+        self.client_keys = {}
 
     def start(self):
         print("OSI: [start]")
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(5)
+        if self.datagram_link is not None:
+            threading.Thread(target=self.receive_datagrams, daemon=True).start()
         while True:
             conn, addr = self.server_socket.accept()
             threading.Thread(target=self.handle_client, args=(conn, addr), daemon=True).start()
 
     def handle_client(self, conn: socket.socket, addr):
-        print("OSI: [handle_client]")
-        # Receive initial data
-        initial_data = conn.recv(1024)
-        if not initial_data:
+        """
+        Serve one accepted connection. Peer OSI servers keep their pooled connections
+        open, so every message on the connection goes through the same dispatch.
+        Messages are length-prefixed and reassembled from the byte stream.
+        """
+        logger.debug("OSI: [handle_client]")
+        buffer = StreamBuffer()
+        try:
+            while True:
+                messages = buffer.read_from(conn)
+                if messages is None or not self.handle_messages(messages, conn, addr):
+                    break
+        except Exception as e:
+            logger.warning("OSI: [connection error] %s: %s", addr, e)
+        finally:
             conn.close()
+            key = self.client_keys.pop(conn, None)
+            client = self.registered_clients.get(key)
+            if client is not None and client["conn"] is conn:
+                del self.registered_clients[key]
+                self.transport_layer.deregister(client["listening_port"], conn)
+
+    def receive_datagrams(self):
+        """The receive loop of the udp link mode: each datagram is one frame or transport ack."""
+        print(f"OSI: [receive_datagrams] on UDP port {self.port}")
+        while True:
+            try:
+                data, addr = self.datagram_link.receive()
+            except OSError:
+                break  # The socket was closed.
+            try:
+                self.handle_link_frame(data, addr[0], addr[1])
+            except Exception as e:
+                logger.warning("OSI: [datagram error] %s: %s", addr, e)
+
+    def handle_link_frame(self, data: bytes, sender_ip: str, sender_port: int = None):
+        """
+        Receive one frame, or a transport ack, from a virtual switch port, a
+        datagram or a multiplexed connection.
+        """
+        if data.startswith(b"TRANS_ACK:"):
+            self.transport_layer.handle_ack(data)
             return
+        link = self.physical_layer.link
+        ack = lambda message: link.transmit(message, sender_ip, sender_port or self.port)
+        if data.startswith(BINARY_MAGIC_BYTE):
+            self.receive_frame(data, self.decapsulate_binary_frame, binary=True, ack=ack)
+        else:
+            self.receive_frame(data, self.decapsulate_text_frame, binary=False, ack=ack)
+
+    def handle_link_request(self, data: bytes, sender_ip: str) -> bytes:
+        """Answer a session handshake from a virtual switch port."""
+        try:
+            return self.session_layer.answer_handshake(data, sender_ip)
+        except Exception as e:
+            logger.warning("[SessionLayer] Error during incoming session handshake: %s", e)
+            return None
+
+    def handle_messages(self, messages: list, conn: socket.socket, addr) -> bool:
+        """
+        Dispatch the messages of one read from conn, in order. Returns False when
+        the connection should be closed. With a presentation pool, each run of
+        consecutive frames is decoded as one batch.
+        """
+        if self.presentation_pool is None:
+            # all() stops at the first message that asks for the connection to close.
+            return all(self.handle_message(data, conn, addr) for data in messages)
+        frames = []
+        for data in messages:
+            if data.startswith(BINARY_MAGIC_BYTE) or data.startswith(b"DL_HEADER("):
+                frames.append(data)
+                continue
+            if frames:
+                self.receive_batch(frames, conn)
+                frames = []
+            if not self.handle_message(data, conn, addr):
+                return False
+        if frames:
+            self.receive_batch(frames, conn)
+        return True
+
+    def handle_message(self, data: bytes, conn: socket.socket, addr) -> bool:
+        """
+        Dispatch one message received on conn. Returns False when the connection
+        should be closed.
+        """
+        # Binary frames are not valid UTF-8, and text frames are checked before they
+        # are decoded, so route frames first.
+        if data.startswith(BINARY_MAGIC_BYTE) or data.startswith(b"DL_HEADER("):
+            self.process_received_data(data, conn)
+            return True
         try:
-            decoded = initial_data.decode('utf-8').strip()
+            decoded = data.decode('utf-8').strip()
         except Exception:
-            conn.close()
-            return
+            return False
 
-        # If data starts with '{', assume it's a registration message
+        # If data starts with '{', it is either a registration or a chat app message.
         if decoded.startswith('{'):
             try:
                 reg_msg = json.loads(decoded)
             except Exception:
-                conn.close()
-                return
-
-            if reg_msg.get("type") != "register":
-                conn.close()
-                return
+                return False
 
-            listening_port = reg_msg.get("port")
-            self.registered_clients[addr[0]] = {"conn": conn, "listening_port": listening_port}
-            conn.sendall("ACK".encode('utf-8'))
-        elif decoded.startswith("DL_HEADER("):
-            # This is a fully encapsulated message coming from another OSI server.
-            self.process_received_data(initial_data, conn)
+            if reg_msg.get("type") == "register":
+                listening_port = reg_msg.get("port")
+                # Incoming messages for this client are delivered back over this connection.
+                if not self.transport_layer.register(listening_port, conn, addr[0]):
+                    send_frame(conn, f"REJECTED: port {listening_port} is in use".encode('utf-8'))
+                    return False
+                key = (addr[0], listening_port)
+                self.registered_clients[key] = {"conn": conn, "listening_port": listening_port}
+                self.client_keys[conn] = key
+                send_frame(conn, "ACK".encode('utf-8'))
+            else:
+                self.process_received_data(data, conn)
+            return True
         else:
             # Otherwise, treat it as a session handshake request.
             sender_ip = addr[0]
-            self.session_layer.handle_incoming_session(conn, sender_ip, initial_data)
-            conn.close()
-            return
-
-        # Now process further incoming messages on this registration connection.
-        while True:
-            data = conn.recv(1024)
-            if not data:
-                break
-            self.process_received_data(data, conn)
-        conn.close()
-        self.registered_clients.pop(addr[0], None)
+            self.session_layer.handle_incoming_session(conn, sender_ip, data)
+            return False
 
     def process_received_data(self, raw_data: bytes, conn: socket.socket):
-        print("OSI: [process_received_data]")
-        try:
-            decoded_str = raw_data.decode('utf-8')
-        except Exception as e:
-            print(f"OSI: [decode error] {e}")
+        logger.debug("OSI: [process_received_data]")
+        if raw_data.startswith(BINARY_MAGIC_BYTE):
+            logger.debug("OSI: [process_received_data] - Starting binary decapsulation chain")
+            self.receive_frame(raw_data, self.decapsulate_binary_frame, binary=True, ack=self.ack_sender(conn))
             return
 
         # If the raw data starts with the Data Link header, assume it is fully encapsulated.
-        if decoded_str.startswith("DL_HEADER("):
-            print("OSI: [process_received_data] - Starting decapsulation chain")
-            # Step 1: Data Link Layer decapsulation.
-            data = self.data_link_layer.decapsulate(raw_data)
-
-            # Step 2: Network Layer decapsulation.
-            data, sender_ip = self.network_layer.decapsulate(data)
-
-            # Step 3: Transport Layer decapsulation.
-            data, extracted_port = self.transport_layer.decapsulate(data)
-            
-            # Step 4: Session Layer decapsulation.
-            data = self.session_layer.decapsulate(data, sender_ip)
-
-            # Step 5: Presentation Layer decapsulation.
-            data = self.presentation_layer.decapsulate(data)
-
-            # Step 6: Application Layer decapsulation.
-            data = self.app_layer.decapsulate(data)
-
+        # The frame is not decoded here: its frame check sequence is verified first.
+        if raw_data.startswith(b"DL_HEADER("):
+            logger.debug("OSI: [process_received_data] - Starting decapsulation chain")
+            self.receive_frame(raw_data, self.decapsulate_text_frame, binary=False, ack=self.ack_sender(conn))
+        else:
             try:
-                message_obj = json.loads(data)
+                decoded_str = raw_data.decode('utf-8')
             except Exception as e:
-                print(f"OSI: [JSON decode error] {e}")
+                logger.warning("OSI: [decode error] %s", e)
                 return
 
-            self.app_layer.process_message(message_obj, extracted_port)
-        else:
             # Otherwise, assume data is already decapsulated (e.g., from a direct chat app message).
             try:
                 message_obj = json.loads(decoded_str)
             except Exception as e:
-                print(f"OSI: [JSON decode error] {e}")
+                logger.warning("OSI: [JSON decode error] %s", e)
                 return
 
             if "destination" in message_obj:
-                print("OSI: [sending message]")
+                logger.debug("OSI: [sending message]")
                 destination_ip = message_obj.pop("destination")
                 dest_port = message_obj.pop("dest_port", self.port)
-                self.send_message(destination_ip, dest_port, message_obj)
+                key = self.client_keys.get(conn)
+                self.queue_message(destination_ip, dest_port, message_obj, src_port=key[1] if key else 0)
             else:
-                print("OSI: [received message] - Delivering to chat app")
-                print("     ", message_obj)
+                logger.debug("OSI: [received message] - Delivering to chat app: %s", message_obj)
                 self.app_layer.process_message(message_obj)
 
+    @staticmethod
+    def ack_sender(conn: socket.socket):
+        """A function that sends transport acks back over conn, or None without a connection."""
+        if conn is None:
+            return None
+        return lambda message: send_frame(conn, message)
+
+    def receive_frame(self, raw_data: bytes, decapsulate, binary: bool, ack=None):
+        """
+        Decapsulate one frame with the given chain and deliver it, tracing each stage.
+        Segments are buffered by the transport layer until their message is complete.
+        """
+        tracer = self.tracer
+        if self.capture is not None:
+            self.capture.record(CAPTURE_IN, raw_data)
+        tracer.begin_packet("recv", len(raw_data))
+        try:
+            data, extracted_port = decapsulate(raw_data, ack)
+        except FrameCheckError:
+            # Corrupt frames are counted (see stats()), not logged one by one.
+            tracer.count("recv.dropped")
+            tracer.end_packet(outcome="corrupt")
+            return
+        except Exception as e:
+            logger.warning("OSI: [decapsulation error] %s", e)
+            tracer.count("recv.dropped")
+            tracer.end_packet(outcome="dropped")
+            return
+        if data is None:
+            # A forwarded packet has no port; a buffered segment has one.
+            tracer.end_packet(outcome="segment" if extracted_port is not None else "forwarded",
+                              port=extracted_port)
+            return
+        delivered = self.deliver_frame(data, extracted_port, binary)
+        tracer.end_packet(outcome="delivered" if delivered else "dropped", port=extracted_port)
+
+    def receive_batch(self, frames: list, conn: socket.socket = None):
+        """
+        Decapsulate frames up through the session layer, decode all their payloads
+        on the presentation pool at once, then deliver them in arrival order.
+        The recv.presentation stage is recorded once per batch. Frame check
+        sequences are verified for the whole batch first.
+        """
+        tracer = self.tracer
+        payloads = []  # [ (presentation payload, destination port, binary) ]
+        ack = self.ack_sender(conn)
+        if self.capture is not None:
+            for raw_data in frames:
+                self.capture.record(CAPTURE_IN, raw_data)
+        verified = self.data_link_layer.verify_frames(frames)
+        if len(verified) < len(frames):
+            tracer.count("recv", len(frames) - len(verified))
+            tracer.count("recv.dropped", len(frames) - len(verified))
+        for raw_data in verified:
+            binary = raw_data.startswith(BINARY_MAGIC_BYTE)
+            decapsulate = self.decapsulate_binary_frame if binary else self.decapsulate_text_frame
+            try:
+                data, extracted_port = decapsulate(raw_data, ack, True)
+            except Exception as e:
+                logger.warning("OSI: [decapsulation error] %s", e)
+                tracer.count("recv")
+                tracer.count("recv.dropped")
+                continue
+            if data is None:
+                continue  # Forwarded, or a segment of a message that is not complete yet.
+            payloads.append((data, extracted_port, binary))
+        texts = tracer.timed("recv.presentation", self.presentation_pool.decode_many,
+                             [(data, binary) for data, _, binary in payloads])
+        for (data, extracted_port, _), text in zip(payloads, texts):
+            tracer.begin_packet("recv", len(data))
+            message_obj = self.decode_text(text)
+            if message_obj is not None:
+                tracer.timed("recv.deliver", self.app_layer.process_message, message_obj, extracted_port)
+            tracer.end_packet(outcome="delivered" if message_obj is not None else "dropped",
+                              port=extracted_port, batch=len(frames))
 
-    def send_message(self, ip_address: str, dest_port: int, message_obj: object):
-        print("OSI: [send message] - Start sending message")
-        
+    def decapsulate_text_frame(self, raw_data: bytes, ack=None, checked: bool = False):
+        """
+        Run a text-mode frame up through the session layer.
+        Returns (presentation payload, destination port); the payload is None for a
+        segment of a message that is not complete yet, and both are None for a packet
+        forwarded to another host. ack sends transport acks back. checked says the
+        frame check sequence was already verified; a bad one raises FrameCheckError.
+        """
+        timed = self.tracer.timed
+        # Step 1: Data Link Layer decapsulation.
+        data = timed("recv.datalink", self.data_link_layer.decapsulate, raw_data, not checked)
+
+        # Step 2: Network Layer decapsulation.
+        data, sender_ip = timed("recv.network", self.network_layer.decapsulate, data, self.forward_text_packet)
+        if data is None:
+            return None, None
+        ack = self.route_ack(ack, sender_ip)
+
+        # Step 3: Transport Layer decapsulation.
+        data, extracted_port = timed("recv.transport", self.transport_layer.decapsulate, data, sender_ip, ack)
+        if data is None:
+            return None, extracted_port
+
+        # Step 4: Session Layer decapsulation.
+        data = timed("recv.session", self.session_layer.decapsulate, data, sender_ip)
+        return data, extracted_port
+
+    def decapsulate_binary_frame(self, raw_data: bytes, ack=None, checked: bool = False):
+        """
+        Run a binary-mode frame up through the session layer. Every step slices the
+        same memoryview, so the payload is not copied until the presentation layer
+        (or until segments are reassembled). Returns as decapsulate_text_frame.
+        """
+        timed = self.tracer.timed
+        view = memoryview(raw_data)
+        data = timed("recv.datalink", self.data_link_layer.decapsulate_binary, view, not checked)
+        data, sender_ip = timed("recv.network", self.network_layer.decapsulate_binary, data,
+                                self.forward_binary_packet)
+        if data is None:
+            return None, None
+        ack = self.route_ack(ack, sender_ip)
+        data, extracted_port = timed("recv.transport", self.transport_layer.decapsulate_binary, data, sender_ip, ack)
+        if data is None:
+            return None, extracted_port
+        data = timed("recv.session", self.session_layer.decapsulate_binary, data, sender_ip)
+        return data, extracted_port
+
+    def route_ack(self, ack, sender_ip: str):
+        """
+        Transport acks go back over the link a segment arrived on, which only
+        reaches the sender when it is directly connected. Segments from further
+        away are not acked; the sender does not wait for acks on such routes.
+        """
+        return ack if self.network_layer.next_hop(sender_ip) == sender_ip else None
+
+    def forward_text_packet(self, packet: bytes, dest_ip: str):
+        self.forward_packet(packet, dest_ip, binary=False)
+
+    def forward_binary_packet(self, packet: PacketBuffer, dest_ip: str):
+        self.forward_packet(packet, dest_ip, binary=True)
+
+    def forward_packet(self, packet, dest_ip: str, binary: bool = False):
+        """
+        Pass a network packet addressed to another host on to the next hop toward
+        dest_ip, in a new data link frame. The transport and upper layers of the
+        packet are not looked at. Raises if the packet cannot be forwarded.
+        """
+        next_hop = self.network_layer.next_hop(dest_ip)
+        if next_hop == self.ip:
+            raise Exception(f"No route to {dest_ip}")
+        if binary:
+            frame = self.data_link_layer.encapsulate_binary(packet, receiver_ip=next_hop)
+        else:
+            frame = self.data_link_layer.encapsulate(packet, receiver_ip=next_hop)
+        if not self.physical_layer.transmit(frame, next_hop, self.port):
+            raise Exception(f"Failed to forward packet for {dest_ip} to {next_hop}")
+        self.tracer.count("forwarded")
+
+    def deliver_frame(self, data, extracted_port, binary: bool = False) -> bool:
+        """
+        Finish decapsulation (presentation and application) and deliver the message.
+        Returns False if the payload could not be decoded.
+        """
+        message_obj = self.decode_payload(data, binary)
+        if message_obj is None:
+            return False
+        self.tracer.timed("recv.deliver", self.app_layer.process_message, message_obj, extracted_port)
+        return True
+
+    def decode_payload(self, data, binary: bool = False):
+        """
+        Presentation and application decapsulation. binary says whether the payload
+        came in a binary frame (and so is not base64-encoded). Returns the message
+        object, or None.
+        """
+        # Step 5: Presentation Layer decapsulation.
+        try:
+            data = self.tracer.timed("recv.presentation", self.presentation_layer.decapsulate, data, binary)
+        except Exception as e:
+            data = e
+        return self.decode_text(data)
+
+    def decode_text(self, data):
+        """
+        Application decapsulation of a presentation result, which is the exception
+        raised if the presentation layer failed. Returns the message object, or None.
+        """
+        if isinstance(data, Exception):
+            logger.warning("OSI: [presentation error] %s", data)
+            self.tracer.count("recv.dropped")
+            return None
+
+        # Step 6: Application Layer decapsulation.
+        try:
+            return self.tracer.timed("recv.application", self._decode_application, data)
+        except Exception as e:
+            logger.warning("OSI: [application decode error] %s", e)
+            self.tracer.count("recv.dropped")
+            return None
+
+    def _decode_application(self, data: bytes) -> object:
+        return self.app_layer.decode(data)
+
+    def queue_message(self, ip_address: str, dest_port: int, message_obj: object, src_port: int = 0) -> bool:
+        """
+        Queue a message for ip_address without waiting for it to be sent; the
+        destination's writer thread sends it. src_port is the listening port of
+        the chat client that sent it. Returns False if the full-queue policy
+        refused it.
+        """
+        if self.outbound.put(ip_address, (dest_port, message_obj, src_port)):
+            return True
+        logger.warning("OSI: [send rejected] Outbound queue for %s is full", ip_address)
+        self.tracer.count("send.rejected")
+        return False
+
+    def send_message(self, ip_address: str, dest_port: int, message_obj: object, src_port: int = 0):
+        """
+        Send one message and return whether it was sent. With an outbox, a message
+        that cannot be delivered (the peer is down, or ARP or the session handshake
+        fails) is stored for a later retry instead of raising.
+        """
+        logger.debug("OSI: [send message] - Start sending message")
+        tracer = self.tracer
+        tracer.begin_packet("send", 0)
+        outcome = "failed"
+        size = 0
+        try:
+            pres_encapsulated = self.encode_payload(message_obj)
+            outcome, size = self.deliver_payload(pres_encapsulated, ip_address, dest_port, src_port)
+        finally:
+            if outcome == "failed":
+                tracer.count("send.failed")
+            tracer.end_packet(outcome=outcome, dest=ip_address, port=dest_port, size=size)
+        return outcome == "sent"
+
+    def add_group(self, name: str, destinations: list):
+        """Name a list of destinations [(ip, port), ...] for send_group."""
+        self.groups[name] = [tuple(destination) for destination in destinations]
+
+    def send_group(self, destinations, message_obj: object, src_port: int = 0) -> dict:
+        """
+        Send one message to many destinations: a list of (ip, port) pairs, or the
+        name of a group (see add_group). The application and presentation stages
+        run once, since every node shares the presentation key; only the session,
+        transport, network and data link framing is done per destination.
+        Large payloads and long destination lists are sent to in parallel on the
+        fan-out threads; otherwise the destinations are sent to one after another
+        on the calling thread (see FANOUT_MIN_BYTES).
+        Returns { (ip, port): "sent", "stored" or "failed" }.
+        """
+        if isinstance(destinations, str):
+            if destinations not in self.groups:
+                raise Exception(f"Unknown group: {destinations}")
+            destinations = self.groups[destinations]
+        # A destination listed twice gets the message once.
+        destinations = list(dict.fromkeys(tuple(destination) for destination in destinations))
+        pres_encapsulated = self.encode_payload(message_obj)
+        if len(destinations) < FANOUT_MIN_DESTINATIONS and len(pres_encapsulated) < FANOUT_MIN_BYTES \
+                or len(destinations) == 1:
+            return {(ip_address, dest_port): self.send_group_member(pres_encapsulated, ip_address, dest_port, src_port)
+                    for ip_address, dest_port in destinations}
+        pending = {(ip_address, dest_port): self.fanout.submit(
+            self.send_group_member, pres_encapsulated, ip_address, dest_port, src_port)
+            for ip_address, dest_port in destinations}
+        return {destination: future.result() for destination, future in pending.items()}
+
+    def send_group_member(self, pres_encapsulated: bytes, ip_address: str, dest_port: int, src_port: int) -> str:
+        """Send a group message's encoded payload to one destination. Returns the outcome."""
+        tracer = self.tracer
+        tracer.begin_packet("send", 0)
+        outcome = "failed"
+        size = 0
+        try:
+            outcome, size = self.deliver_payload(pres_encapsulated, ip_address, dest_port, src_port)
+        except Exception as e:
+            logger.warning("OSI: [send error] %s:%s: %s", ip_address, dest_port, e)
+        finally:
+            if outcome == "failed":
+                tracer.count("send.failed")
+            tracer.end_packet(outcome=outcome, dest=ip_address, port=dest_port, size=size)
+        return outcome
+
+    def deliver_payload(self, pres_encapsulated: bytes, ip_address: str, dest_port: int, src_port: int = 0):
+        """
+        Frame and send an encoded payload, or store it in the outbox if it cannot
+        be sent. Returns (outcome, frame bytes), the outcome being "sent", "stored"
+        or "failed". Without an outbox, send errors are raised.
+        """
+        with self.send_lock(ip_address):
+            if self.outbox is not None and self.outbox.pending(ip_address):
+                # Queue behind the messages already waiting, to keep the order.
+                return self.store_undelivered(ip_address, dest_port, src_port, pres_encapsulated), 0
+            try:
+                sent, size = self.send_payload(pres_encapsulated, ip_address, dest_port, (src_port, dest_port))
+            except Exception as e:
+                if self.outbox is None:
+                    raise
+                logger.warning("OSI: [send error] %s", e)
+                sent, size = False, 0
+            if sent:
+                return "sent", size
+            return self.store_undelivered(ip_address, dest_port, src_port, pres_encapsulated), size
+
+    def send_lock(self, ip_address: str):
+        """
+        Held while deciding whether a message for ip_address is sent or stored in
+        the outbox, and until that is done, to keep messages in order (see
+        Outbox.send_lock). Without an outbox there is nothing to hold.
+        """
+        return self.outbox.send_lock(ip_address) if self.outbox is not None else contextlib.nullcontext()
+
+    def store_undelivered(self, ip_address: str, dest_port: int, src_port: int, pres_encapsulated: bytes) -> str:
+        """
+        Keep a presentation payload that could not be sent in the outbox, to be
+        retried later. Returns the packet outcome: "stored", or "failed" without an
+        outbox or when the destination's outbox is full.
+        """
+        if self.outbox is None or not self.outbox.store(ip_address, dest_port, src_port, pres_encapsulated):
+            return "failed"
+        self.tracer.count("send.stored")
+        return "stored"
+
+    def send_payload(self, pres_encapsulated: bytes, ip_address: str, dest_port: int, stream=None):
+        """
+        Send one presentation payload, in segments if needed, on stream (source
+        port, destination port). Returns (sent, frame bytes).
+        """
+        tracer = self.tracer
+        # Datagrams can be lost, so over a datagram link every message is sent as
+        # acknowledged segments.
+        if self.datagram_link is not None or self.transport_layer.needs_segmentation(len(pres_encapsulated)):
+            msg_id, frames = tracer.timed("send.headers", self.segment_frames,
+                                          pres_encapsulated, ip_address, dest_port)
+            size = sum(len(frame) for frame in frames)
+            return tracer.timed("send.physical", self.transmit_segments, msg_id, frames, ip_address, stream), size
+        frame = tracer.timed("send.headers", self.encapsulate_frame, pres_encapsulated, ip_address, dest_port)
+
+        # Step 7: Physical Layer, send the data to the next hop
+        next_hop = self.network_layer.next_hop(ip_address)
+        return tracer.timed("send.physical", self.physical_layer.transmit,
+                            frame, next_hop, self.port, stream), len(frame)
+
+    def send_messages(self, ip_address: str, messages: list) -> int:
+        """
+        Send messages [(dest_port, message_obj, src_port), ...] to ip_address in
+        order; the outbound queue writers call this with each batch. Frames that need no
+        segmentation are collected and written together over one connection.
+        With an outbox, messages that cannot be delivered are stored for a later
+        retry; the whole batch is sent under the destination's send_lock. Returns
+        the number of messages sent or stored.
+        """
+        with self.send_lock(ip_address):
+            tracer = self.tracer
+            sent = 0
+            batch = []  # [(frame, dest_port, src_port, presentation payload), ...]
+            for dest_port, message_obj, src_port in messages:
+                tracer.begin_packet("send", 0)
+                outcome = "failed"
+                size = 0
+                pres_encapsulated = None
+                try:
+                    pres_encapsulated = self.encode_payload(message_obj)
+                    if self.outbox is not None and self.outbox.pending(ip_address):
+                        # Queue behind the messages already waiting, to keep the order.
+                        sent += self.flush_batch(batch, ip_address)
+                        batch = []
+                        outcome = self.store_undelivered(ip_address, dest_port, src_port, pres_encapsulated)
+                    elif self.datagram_link is None and \
+                            not self.transport_layer.needs_segmentation(len(pres_encapsulated)):
+                        frame = tracer.timed("send.headers", self.encapsulate_frame,
+                                             pres_encapsulated, ip_address, dest_port)
+                        batch.append((frame, dest_port, src_port, pres_encapsulated))
+                        outcome, size = "batched", len(frame)
+                    else:
+                        # Frames collected so far go first, to keep the order.
+                        sent += self.flush_batch(batch, ip_address)
+                        batch = []
+                        ok, size = self.send_payload(pres_encapsulated, ip_address, dest_port, (src_port, dest_port))
+                        outcome = "sent" if ok else \
+                            self.store_undelivered(ip_address, dest_port, src_port, pres_encapsulated)
+                except Exception as e:
+                    logger.warning("OSI: [send error] %s", e)
+                    if pres_encapsulated is not None:
+                        sent += self.flush_batch(batch, ip_address)
+                        batch = []
+                        outcome = self.store_undelivered(ip_address, dest_port, src_port, pres_encapsulated)
+                finally:
+                    if outcome == "failed":
+                        tracer.count("send.failed")
+                    elif outcome != "batched":
+                        sent += 1
+                    tracer.end_packet(outcome=outcome, dest=ip_address, port=dest_port, size=size)
+            return sent + self.flush_batch(batch, ip_address)
+
+    def flush_batch(self, batch: list, ip_address: str) -> int:
+        """
+        Write the collected frames of send_messages; if that fails, store their
+        payloads in the outbox. Returns how many were sent or stored.
+        """
+        if not batch:
+            return 0
+        frames = [frame for frame, _, _, _ in batch]
+        streams = [(src_port, dest_port) for _, dest_port, src_port, _ in batch]
+        if self.flush_frames(frames, streams, ip_address):
+            return len(batch)
+        return sum(self.store_undelivered(ip_address, dest_port, src_port, pres_encapsulated) == "stored"
+                   for _, dest_port, src_port, pres_encapsulated in batch)
+
+    def flush_frames(self, frames: list, streams: list, ip_address: str) -> int:
+        """
+        Write frames for ip_address, each on its stream, to the next hop together.
+        Returns how many were sent.
+        """
+        if not frames:
+            return 0
+        next_hop = self.network_layer.next_hop(ip_address)
+        if self.tracer.timed("send.physical", self.physical_layer.transmit_many, frames, next_hop, self.port, streams):
+            return len(frames)
+        self.tracer.count("send.failed", len(frames))
+        return 0
+
+    def deliver_stored(self, ip_address: str, records: list) -> int:
+        """
+        Retry messages from the outbox, [(dest_port, src_port, presentation
+        payload), ...], in order: frames that need no segmentation are written
+        together over one connection. Stops at the first failure. Returns how many
+        of the leading messages were sent.
+        """
+        delivered = 0
+        frames = []
+        streams = []
+        for dest_port, src_port, pres_encapsulated in records:
+            try:
+                if self.datagram_link is None and \
+                        not self.transport_layer.needs_segmentation(len(pres_encapsulated)):
+                    frames.append(self.encapsulate_frame(pres_encapsulated, ip_address, dest_port))
+                    streams.append((src_port, dest_port))
+                    continue
+                if frames:
+                    if not self.flush_frames(frames, streams, ip_address):
+                        return delivered
+                    delivered += len(frames)
+                    frames = []
+                    streams = []
+                if not self.send_payload(pres_encapsulated, ip_address, dest_port, (src_port, dest_port))[0]:
+                    return delivered
+                delivered += 1
+            except Exception as e:
+                logger.warning("OSI: [outbox retry error] %s: %s", ip_address, e)
+                break
+        return delivered + self.flush_frames(frames, streams, ip_address)
+
+    def segment_frames(self, data: bytes, ip_address: str, dest_port: int):
+        """
+        Add the session header to a large presentation payload, split it into
+        transport segments and wrap each in the network and data link headers.
+        Returns (message id, [frame, ...]).
+        """
+        timed = self.tracer.timed
+        next_hop = self.network_layer.next_hop(ip_address)
+        data = PacketBuffer(data)
+        if self.wire_format == "binary":
+            data = timed("send.session", self.session_layer.encapsulate_binary, data, ip_address)
+            msg_id, segments = timed("send.transport", self.transport_layer.segment, data, dest_port, True)
+            return msg_id, [timed("send.datalink", self.data_link_layer.encapsulate_binary,
+                                  timed("send.network", self.network_layer.encapsulate_binary, segment, ip_address),
+                                  next_hop)
+                            for segment in segments]
+        data = timed("send.session", self.session_layer.encapsulate, data, ip_address)
+        msg_id, segments = timed("send.transport", self.transport_layer.segment, data, dest_port)
+        return msg_id, [timed("send.datalink", self.data_link_layer.encapsulate,
+                              timed("send.network", self.network_layer.encapsulate, segment, ip_address),
+                              next_hop)
+                        for segment in segments]
+
+    def transmit_segments(self, msg_id: int, frames: list, ip_address: str, stream=None) -> bool:
+        """
+        Send the frames of a segmented message over one pooled connection, windowed
+        by acks. On a virtual switch, a datagram link or a multiplexed link the send
+        continues in the background, driven by acks arriving through
+        handle_link_frame, and this returns once it has started. On a multiplexed
+        link the window is the stream's flow control: a large message has at most
+        one window of segments queued on the shared connection.
+
+        Acks only come back from a directly connected receiver: when the route goes
+        through other nodes the frames are sent back to back, relying on every hop's
+        link to deliver them.
+        """
+        next_hop = self.network_layer.next_hop(ip_address)
+        if next_hop != ip_address:
+            return all(self.physical_layer.transmit(frame, next_hop, self.port, stream) for frame in frames)
+        link = self.physical_layer.link
+        if link is not None:
+            self.transport_layer.start_segments(
+                msg_id, frames, lambda frame: self.physical_layer.transmit(frame, ip_address, self.port, stream),
+                link.clock)
+            return True
+        # Segments resent after an ack timeout are not captured again.
+        self.physical_layer.record(frames)
+        return self.physical_layer.exchange(
+            lambda sock: self.transport_layer.send_segments(sock, msg_id, frames), ip_address, self.port)
+
+    def encode_payload(self, message_obj: object) -> bytes:
+        """Application and presentation encapsulation."""
         # Step 1: Application Layer encapsulation
-        app_encapsulated = self.app_layer.encapsulate(message_obj)
-        
+        app_encapsulated = self.tracer.timed("send.application", self.app_layer.encapsulate, message_obj)
+
         # Step 2: Presentation Layer encoding
-        pres_encapsulated = self.presentation_layer.encapsulate(app_encapsulated)
-        
+        encapsulate = self.presentation_layer.encapsulate if self.presentation_pool is None \
+            else self.presentation_pool.encode
+        return self.tracer.timed("send.presentation", encapsulate, app_encapsulated, self.wire_format == "binary")
+
+    def stats(self) -> dict:
+        """
+        Per-stage latency histograms, packet counters, ARP cache counters, frames
+        dropped for a bad frame check sequence, the depth, counters and wait
+        times of the outbound queues, the outbox's stored and pending messages and,
+        in mux link mode, the frames queued, sent and dropped per stream and, with a
+        capture, the frames recorded in it.
+        """
+        stats = self.tracer.stats()
+        stats["arp"] = self.data_link_layer.arp_table.stats()
+        stats["datalink"] = {"fcs_errors": self.data_link_layer.fcs_errors}
+        stats["outbound"] = self.outbound.stats()
+        if self.outbox is not None:
+            stats["outbox"] = self.outbox.stats()
+        if self.mux_link is not None:
+            stats["mux"] = self.mux_link.stats()
+        if self.capture is not None:
+            stats["capture"] = self.capture.stats()
+        return stats
+
+    def encapsulate_frame(self, data: bytes, ip_address: str, dest_port: int) -> PacketBuffer:
+        """
+        Wrap a presentation payload in the lower-layer headers of the configured wire
+        format. The frame is a PacketBuffer, so the payload itself is not copied.
+        Callers time this as send.headers. Without the header cache each layer is
+        also timed on its own (send.session, send.transport, send.network and
+        send.datalink); with it the headers come from one cached template, so
+        there are no separate layer steps to time.
+        """
+        if self.header_cache is not None:
+            return self.header_cache.frame(data, ip_address, dest_port)
+        if self.wire_format == "binary":
+            return self.encapsulate_binary_frame(PacketBuffer(data), ip_address, dest_port)
+        return self.encapsulate_text_frame(PacketBuffer(data), ip_address, dest_port)
+
+    def encapsulate_text_frame(self, data: bytes, ip_address: str, dest_port: int) -> bytes:
+        """Wrap a presentation payload in the text session/transport/network/data link headers."""
+        timed = self.tracer.timed
         # Step 3: Session Layer encapsulation (establish session if needed)
-        session_encapsulated = self.session_layer.encapsulate(pres_encapsulated, receiver_ip=ip_address)
+        session_encapsulated = timed("send.session", self.session_layer.encapsulate, data, ip_address)
 
         # Step 4: Transport Layer encapsulation, encapsulate it with the transport header
-        transport_encapsulated = self.transport_layer.encapsulate(session_encapsulated, dest_port)
+        transport_encapsulated = timed("send.transport", self.transport_layer.encapsulate,
+                                       session_encapsulated, dest_port)
 
         # Step 5: Network Layer encapsulation, encapsulate it with the network header
-        network_encapsulated = self.network_layer.encapsulate(transport_encapsulated, ip_address)
+        network_encapsulated = timed("send.network", self.network_layer.encapsulate,
+                                     transport_encapsulated, ip_address)
 
         # Step 6: Data Link Layer encapsulation, encapsulate it with the data link header
-        data_link_encapsulated = self.data_link_layer.encapsulate(network_encapsulated, receiver_ip=ip_address)
+        # addressed to the next hop
+        next_hop = self.network_layer.next_hop(ip_address)
+        return timed("send.datalink", self.data_link_layer.encapsulate, network_encapsulated, next_hop)
 
-        # Step 7: Physical Layer, send the data
-        self.physical_layer.transmit(data_link_encapsulated, ip_address, self.port)        
+    def encapsulate_binary_frame(self, data: bytes, ip_address: str, dest_port: int) -> bytes:
+        """Wrap a presentation payload in the binary session/transport/network/data link headers."""
+        timed = self.tracer.timed
+        data = timed("send.session", self.session_layer.encapsulate_binary, data, ip_address)
+        data = timed("send.transport", self.transport_layer.encapsulate_binary, data, dest_port)
+        data = timed("send.network", self.network_layer.encapsulate_binary, data, ip_address)
+        return timed("send.datalink", self.data_link_layer.encapsulate_binary, data,
+                     self.network_layer.next_hop(ip_address))
 
 
 if __name__ == "__main__":
-    server = OSIServer()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Run the OSI model simulation server.")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--wire-format", choices=("text", "binary"), default="text",
+                        help="header format used for outgoing frames (incoming frames may use either)")
+    parser.add_argument("--app-encoding", choices=("json", "binary"), default="json",
+                        help="encoding of outgoing chat messages (incoming messages may use either)")
+    parser.add_argument("--engine", choices=("threaded", "asyncio"), default="threaded",
+                        help="one thread per connection, or a single asyncio event loop")
+    parser.add_argument("--presentation-profile", choices=sorted(PROFILES), default="aesgcm",
+                        help="cipher and compression policy for outgoing payloads")
+    parser.add_argument("--presentation-workers", type=int, default=0,
+                        help="run compression and encryption on this many workers (0: on the connection threads)")
+    parser.add_argument("--presentation-pool", choices=("process", "thread"), default="process",
+                        help="whether presentation workers are processes or threads")
+    parser.add_argument("--zdict", action="append", default=[], metavar="PATH",
+                        help="compression dictionary for small payloads, built by zdict.py; may be repeated "
+                             "(the highest id is used for sending, all for receiving)")
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_SIZE,
+                        help="split payloads larger than this many bytes into transport segments")
+    parser.add_argument("--window", type=int, default=WINDOW,
+                        help="transport segments in flight before waiting for an ack")
+    parser.add_argument("--outbound-queue", type=int, default=1024,
+                        help="messages from chat clients that may wait per destination")
+    parser.add_argument("--queue-policy", choices=QUEUE_POLICIES, default="block",
+                        help="when a destination's queue is full: wait, drop its oldest message, or reject the new one")
+    parser.add_argument("--queue-timeout", type=float, default=BLOCK_TIMEOUT,
+                        help="seconds the block policy waits for room before rejecting the message")
+    parser.add_argument("--link", choices=("tcp", "udp", "mux"), default="tcp",
+                        help="send frames to other servers over pooled TCP connections, as UDP datagrams, "
+                             "or multiplexed over one TCP connection per server")
+    parser.add_argument("--outbox", metavar="DIR",
+                        help="keep messages that cannot be delivered in DIR and retry them, also after a restart")
+    parser.add_argument("--outbox-max-mb", type=int, default=256,
+                        help="disk space the outbox may use per destination")
+    parser.add_argument("--route", action="append", default=[], metavar="PREFIX=NEXT_HOP",
+                        help="forward packets for PREFIX (e.g. 10.1.0.0/16) via NEXT_HOP; may be repeated")
+    parser.add_argument("--presentation-key-file", metavar="PATH",
+                        help="file holding the presentation key, created with a new key if missing; servers "
+                             "that exchange messages, and replay.py, must use the same key")
+    parser.add_argument("--capture", metavar="FILE",
+                        help="record frames sent and received in a memory-mapped ring buffer FILE (see replay.py)")
+    parser.add_argument("--capture-mb", type=int, default=DEFAULT_CAPTURE_SIZE // (1024 * 1024),
+                        help="size of the capture ring; the oldest frames are overwritten when it is full")
+    parser.add_argument("--debug", action="store_true",
+                        help="log every layer's payload as it is encapsulated and decapsulated")
+    parser.add_argument("--trace-file", help="append sampled per-packet trace records (JSON lines) to this file")
+    parser.add_argument("--trace-sample", type=int, default=1000, help="trace one packet in every N")
+    args = parser.parse_args()
+    if args.queue_timeout <= 0:
+        parser.error("--queue-timeout must be positive")
+    if args.link != "tcp" and args.engine == "asyncio":
+        parser.error(f"--link {args.link} requires the threaded engine")
+    if args.outbox and args.engine == "asyncio":
+        parser.error("--outbox requires the threaded engine")
+    if args.outbox and args.link == "mux":
+        parser.error("--outbox cannot be used with --link mux, which delivers at most once")
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING, format="%(message)s")
+    tracer = Tracer(trace_path=args.trace_file, sample_every=args.trace_sample)
+    routes = dict(route.split("=", 1) for route in args.route)
+    dictionaries = {dictionary.id: dictionary.data for dictionary in map(load_dictionary, args.zdict)}
+    presentation_key = load_presentation_key(args.presentation_key_file) if args.presentation_key_file else None
+    capture = {"capture_path": args.capture, "capture_size": args.capture_mb * 1024 * 1024}
+    if args.engine == "asyncio":
+        from async_osi_server import AsyncOSIServer
+        server = AsyncOSIServer(port=args.port, wire_format=args.wire_format, tracer=tracer,
+                                presentation_profile=args.presentation_profile,
+                                presentation_workers=args.presentation_workers,
+                                presentation_pool=args.presentation_pool,
+                                segment_size=args.segment_size, window=args.window, routes=routes,
+                                presentation_dictionaries=dictionaries, app_encoding=args.app_encoding,
+                                presentation_key=presentation_key, **capture)
+    else:
+        server = OSIServer(port=args.port, wire_format=args.wire_format, tracer=tracer,
+                           presentation_profile=args.presentation_profile,
+                           presentation_workers=args.presentation_workers,
+                           presentation_pool=args.presentation_pool,
+                           segment_size=args.segment_size, window=args.window, routes=routes,
+                           link_mode=args.link, outbound_queue_size=args.outbound_queue,
+                           outbound_policy=args.queue_policy, outbound_block_timeout=args.queue_timeout,
+                           outbox_dir=args.outbox,
+                           outbox_max_bytes=args.outbox_max_mb * 1024 * 1024,
+                           presentation_dictionaries=dictionaries, app_encoding=args.app_encoding,
+                           presentation_key=presentation_key, **capture)
     server.start()
@@ -0,0 +1,156 @@
+import collections
+import logging
+import threading
+import time
+
+from tracing import Histogram
+
+logger = logging.getLogger("osi.outbound")
+
+# What put does when a destination's queue is full: wait for room, discard the
+# oldest queued message to make room, or refuse the new message.
+QUEUE_POLICIES = ("block", "drop-oldest", "reject")
+# Seconds "block" waits for room before refusing the message, so a full queue
+# for an unreachable destination never holds the client's thread for long.
+BLOCK_TIMEOUT = 1.0
+
+class OutboundQueue:
+    """The messages waiting for one destination, and its counters."""
+
+    def __init__(self, dest_ip: str, lock: threading.Lock):
+        self.dest_ip = dest_ip
+        self.items = collections.deque()  # (enqueued at, in perf_counter ns, message)
+        self.ready = threading.Condition(lock)  # signalled when a message is queued
+        self.space = threading.Condition(lock)  # signalled when the writer takes messages
+        self.writer = None
+        self.max_depth = 0
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.wait = Histogram()
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self.items),
+            "max_depth": self.max_depth,
+            "queued": self.queued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "wait": self.wait.to_dict(),
+        }
+
+class OutboundQueues:
+    """
+    Bounded per-destination queues of outgoing messages. Each destination with
+    queued messages has its own writer thread, which takes up to max_batch
+    messages at a time and passes them to send_batch(dest_ip, messages) -> number
+    sent. A slow or unreachable destination therefore only holds up its own
+    queue, never the thread that queued the message. Messages to one destination
+    are sent in the order they were queued. A writer exits after idle_timeout
+    seconds with nothing to send, and its destination's queue and counters are
+    removed with it, so destinations no longer sent to take no memory.
+
+    When a queue already holds max_depth messages, policy decides what put does
+    (see QUEUE_POLICIES); "block" waits at most block_timeout seconds (None for
+    no limit) and then refuses the message, as "reject" would.
+    """
+
+    def __init__(self, send_batch, max_depth: int = 1024, policy: str = "block", max_batch: int = 64,
+                 block_timeout: float = BLOCK_TIMEOUT, idle_timeout: float = 5.0):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError(f"Unknown queue policy: {policy}")
+        self.send_batch = send_batch
+        self.max_depth = max_depth
+        self.policy = policy
+        self.max_batch = max_batch
+        self.block_timeout = block_timeout
+        self.idle_timeout = idle_timeout
+        self.closed = False
+        self._queues = {}  # { dest_ip: OutboundQueue }
+        self._lock = threading.Lock()
+
+    def put(self, dest_ip: str, message) -> bool:
+        """Queue message for dest_ip. Returns False if it was refused."""
+        with self._lock:
+            queue = self._queues.get(dest_ip)
+            if queue is None:
+                queue = self._queues[dest_ip] = OutboundQueue(dest_ip, self._lock)
+            if len(queue.items) >= self.max_depth and not self._make_room(queue):
+                queue.rejected += 1
+                return False
+            if self.closed:
+                return False
+            queue.items.append((time.perf_counter_ns(), message))
+            queue.queued += 1
+            queue.max_depth = max(queue.max_depth, len(queue.items))
+            if queue.writer is None:
+                queue.writer = threading.Thread(target=self._run, args=(queue,), daemon=True)
+                queue.writer.start()
+            else:
+                queue.ready.notify()
+        return True
+
+    def _make_room(self, queue: OutboundQueue) -> bool:
+        """Apply the full-queue policy. Caller holds the lock."""
+        if self.policy == "reject":
+            return False
+        if self.policy == "drop-oldest":
+            queue.items.popleft()
+            queue.dropped += 1
+            return True
+        deadline = None if self.block_timeout is None else time.monotonic() + self.block_timeout
+        while len(queue.items) >= self.max_depth and not self.closed:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            queue.space.wait(remaining)
+        return not self.closed
+
+    def _run(self, queue: OutboundQueue):
+        while True:
+            with self._lock:
+                while not queue.items and not self.closed:
+                    if not queue.ready.wait(self.idle_timeout):
+                        break
+                if not queue.items:
+                    # Nothing queued and nothing in flight: the next put starts afresh.
+                    queue.writer = None
+                    del self._queues[queue.dest_ip]
+                    return
+                batch = [queue.items.popleft() for _ in range(min(len(queue.items), self.max_batch))]
+                queue.space.notify_all()
+            now = time.perf_counter_ns()
+            for enqueued, _ in batch:
+                queue.wait.record(now - enqueued)
+            try:
+                sent = self.send_batch(queue.dest_ip, [message for _, message in batch])
+            except Exception as e:
+                logger.warning("[OutboundQueues] Error sending to %s: %s", queue.dest_ip, e)
+                sent = 0
+            with self._lock:
+                queue.sent += sent
+                queue.failed += len(batch) - sent
+
+    def depth(self, dest_ip: str = None) -> int:
+        """Messages waiting for dest_ip, or for every destination."""
+        if dest_ip is not None:
+            queue = self._queues.get(dest_ip)
+            return len(queue.items) if queue is not None else 0
+        return sum(len(queue.items) for queue in list(self._queues.values()))
+
+    def stats(self) -> dict:
+        """Queue depth, counters and queue wait time (ns) per destination with a queue."""
+        with self._lock:
+            return {dest_ip: queue.stats() for dest_ip, queue in self._queues.items()}
+
+    def close(self):
+        """Refuse new messages; writers send what is already queued and exit."""
+        with self._lock:
+            self.closed = True
+            for queue in self._queues.values():
+                queue.ready.notify_all()
+                queue.space.notify_all()
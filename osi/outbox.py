@@ -0,0 +1,319 @@
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger("osi.outbox")
+
+# Header of one outbox record: payload length, CRC32 of the ports and payload,
+# destination port and source port. A zero length marks the end of the records
+# written to a segment (segments are preallocated and zero-filled).
+RECORD_HEADER = struct.Struct("!IIHH")
+# The per-destination cursor: segment number and offset of the first record not
+# yet delivered.
+CURSOR = struct.Struct("!QQ")
+SEGMENT_SUFFIX = ".log"
+
+class OutboxLog:
+    """
+    The append-only log of undelivered messages for one destination: numbered
+    segment files of segment_size bytes in directory, each memory-mapped. Records
+    are appended to the last segment and read from the cursor, which is saved to
+    a small file after every delivered batch. Segments behind the cursor hold
+    only delivered records and are deleted.
+    """
+
+    def __init__(self, directory: str, segment_size: int, max_bytes: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.cursor = self._load_cursor()
+        self._maps = {}  # { segment number: (file, mmap) }
+        # Segments left behind the cursor by a crash during compaction.
+        self._remove([segment for segment in self.segments if segment < self.cursor[0]])
+        # Only the last segment is scanned, to find where the next record goes.
+        self.tail_offset = self._scan_end(self.segments[-1]) if self.segments else 0
+        self.stored = 0
+        self.delivered = 0
+        self.rejected = 0
+        # Retry state: consecutive failed attempts and when to try next (monotonic).
+        self.failures = 0
+        self.next_attempt = 0.0
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:016d}{SEGMENT_SUFFIX}")
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, "cursor"), "rb") as f:
+                cursor = CURSOR.unpack(f.read(CURSOR.size))
+        except (OSError, struct.error):
+            return (self.segments[0], 0) if self.segments else (0, 0)
+        if self.segments and cursor[0] < self.segments[0]:
+            # The cursor's segment was already compacted away.
+            return (self.segments[0], 0)
+        return cursor
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, "cursor")
+        with open(path + ".tmp", "wb") as f:
+            f.write(CURSOR.pack(*self.cursor))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+    def _map(self, segment: int) -> mmap.mmap:
+        entry = self._maps.get(segment)
+        if entry is None:
+            f = open(self._path(segment), "r+b")
+            entry = self._maps[segment] = (f, mmap.mmap(f.fileno(), 0))
+        return entry[1]
+
+    def _scan_end(self, segment: int) -> int:
+        """Offset just past the last intact record of segment."""
+        data = self._map(segment)
+        offset = self.cursor[1] if self.cursor[0] == segment else 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc, dest_port, src_port = RECORD_HEADER.unpack_from(data, offset)
+            end = offset + RECORD_HEADER.size + length
+            if length == 0 or end > len(data) or zlib.crc32(data[offset + 8:end]) != crc:
+                # A torn write at the end is discarded.
+                break
+            offset = end
+        return offset
+
+    def _segment_bytes(self) -> int:
+        return sum(len(self._map(segment)) for segment in self.segments)
+
+    def pending(self) -> bool:
+        """Whether any stored record has not been delivered yet."""
+        return bool(self.segments) and self.cursor != (self.segments[-1], self.tail_offset)
+
+    def append(self, dest_port: int, src_port: int, payload: bytes) -> bool:
+        """Append a record. Returns False if it would take the log over max_bytes."""
+        size = RECORD_HEADER.size + len(payload)
+        if not self.segments or self.tail_offset + size > len(self._map(self.segments[-1])):
+            segment_size = max(self.segment_size, size + RECORD_HEADER.size)
+            if self._segment_bytes() + segment_size > self.max_bytes:
+                self.rejected += 1
+                return False
+            if self.segments:
+                # End the old tail here, over any torn record left by a crash.
+                tail = self._map(self.segments[-1])
+                if self.tail_offset + 4 <= len(tail):
+                    tail[self.tail_offset:self.tail_offset + 4] = bytes(4)
+            segment = self.segments[-1] + 1 if self.segments else self.cursor[0] + 1
+            with open(self._path(segment), "wb") as f:
+                f.truncate(segment_size)
+            if not self.pending():
+                self.cursor = (segment, 0)
+                self._save_cursor()
+            self.segments.append(segment)
+            self.tail_offset = 0
+        data = self._map(self.segments[-1])
+        offset = self.tail_offset
+        body = struct.pack("!HH", dest_port, src_port)
+        # The payload goes in before the header, so a crash mid-write leaves a zero
+        # length (or a CRC mismatch) rather than a record pointing at garbage.
+        data[offset + RECORD_HEADER.size:offset + size] = payload
+        RECORD_HEADER.pack_into(data, offset, len(payload), zlib.crc32(payload, zlib.crc32(body)),
+                                dest_port, src_port)
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        data.flush(start, offset + size - start)
+        self.tail_offset = offset + size
+        self.stored += 1
+        return True
+
+    def read(self, limit: int) -> list:
+        """Up to limit undelivered records from the cursor: [(dest_port, src_port, payload), ...]."""
+        records = []
+        if not self.pending():
+            return records
+        segment, offset = self.cursor
+        while len(records) < limit and (segment, offset) != (self.segments[-1], self.tail_offset):
+            data = self._map(segment)
+            if offset + RECORD_HEADER.size > len(data) or RECORD_HEADER.unpack_from(data, offset)[0] == 0:
+                segment, offset = self.segments[self.segments.index(segment) + 1], 0
+                continue
+            length, _, dest_port, src_port = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            records.append((dest_port, src_port, data[start:start + length]))
+            offset = start + length
+        return records
+
+    def advance(self, count: int):
+        """Mark the first count undelivered records as delivered and compact."""
+        segment, offset = self.cursor
+        for _ in range(count):
+            data = self._map(segment)
+            if offset + RECORD_HEADER.size > len(data) or RECORD_HEADER.unpack_from(data, offset)[0] == 0:
+                segment, offset = self.segments[self.segments.index(segment) + 1], 0
+                data = self._map(segment)
+            offset += RECORD_HEADER.size + RECORD_HEADER.unpack_from(data, offset)[0]
+        self.cursor = (segment, offset)
+        self.delivered += count
+        self._save_cursor()
+        if not self.pending():
+            # Everything was delivered: the next record starts a new segment.
+            self._remove(self.segments)
+            self.tail_offset = 0
+        else:
+            self._remove([s for s in self.segments if s < segment])
+
+    def _remove(self, segments: list):
+        for segment in list(segments):
+            entry = self._maps.pop(segment, None)
+            if entry is not None:
+                entry[1].close()
+                entry[0].close()
+            os.remove(self._path(segment))
+            self.segments.remove(segment)
+
+    def stats(self) -> dict:
+        pending = 0
+        if self.pending():
+            head, offset = self.cursor
+            pending = sum(len(self._map(s)) for s in self.segments[:-1] if s >= head) + self.tail_offset - offset
+        return {
+            "stored": self.stored,
+            "delivered": self.delivered,
+            "rejected": self.rejected,
+            "pending_bytes": pending,
+            "disk_bytes": self._segment_bytes(),
+            "failures": self.failures,
+        }
+
+    def close(self):
+        for f, data in self._maps.values():
+            data.close()
+            f.close()
+        self._maps.clear()
+
+class Outbox:
+    """
+    Durable store-and-forward queue for messages that could not be delivered:
+    one OutboxLog per destination under directory, so stored messages survive
+    a restart. Recovery reads each destination's cursor and scans only its last
+    segment, not the whole log.
+
+    A retry thread drains each destination with exponential backoff (initial_delay
+    doubling up to max_delay): it reads up to max_batch records and passes them to
+    deliver(dest_ip, [(dest_port, src_port, payload), ...]) -> number delivered,
+    which sends them in order. Delivered records are removed from the front.
+    Each destination's log is limited to max_bytes of segment files.
+    """
+
+    def __init__(self, directory: str, deliver, segment_size: int = 4 * 1024 * 1024,
+                 max_bytes: int = 256 * 1024 * 1024, max_batch: int = 64,
+                 initial_delay: float = 0.5, max_delay: float = 60.0):
+        self.directory = directory
+        self.deliver = deliver
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.max_batch = max_batch
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.closed = False
+        self._logs = {}  # { dest_ip: OutboxLog }
+        self._send_locks = {}  # { dest_ip: Lock } (see send_lock)
+        self._cond = threading.Condition()
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if not os.path.isdir(os.path.join(directory, name)):
+                continue
+            log = self._log(name)
+            if log.pending():
+                print(f"[Outbox] Recovered undelivered messages for {name}")
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _log(self, dest_ip: str) -> OutboxLog:
+        log = self._logs.get(dest_ip)
+        if log is None:
+            log = self._logs[dest_ip] = OutboxLog(os.path.join(self.directory, dest_ip),
+                                                  self.segment_size, self.max_bytes)
+        return log
+
+    def send_lock(self, dest_ip: str) -> threading.Lock:
+        """
+        The lock senders hold from checking pending(dest_ip) until the message is
+        sent or stored, so that a message sent directly never overtakes an earlier
+        one that failed and is being stored.
+        """
+        with self._cond:
+            lock = self._send_locks.get(dest_ip)
+            if lock is None:
+                lock = self._send_locks[dest_ip] = threading.Lock()
+            return lock
+
+    def pending(self, dest_ip: str) -> bool:
+        """Whether messages for dest_ip are waiting; new ones must queue behind them."""
+        with self._cond:
+            log = self._logs.get(dest_ip)
+            return log is not None and log.pending()
+
+    def store(self, dest_ip: str, dest_port: int, src_port: int, payload: bytes) -> bool:
+        """Store a message for a later retry. Returns False if the destination's log is full."""
+        with self._cond:
+            if self.closed:
+                return False
+            log = self._log(dest_ip)
+            if not log.pending():
+                log.failures = 0
+                log.next_attempt = time.monotonic() + self.initial_delay
+                self._cond.notify()
+            return log.append(dest_port, src_port, payload)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self.closed:
+                        return
+                    now = time.monotonic()
+                    due = [(ip, log) for ip, log in self._logs.items() if log.pending() and log.next_attempt <= now]
+                    if due:
+                        break
+                    waits = [log.next_attempt - now for log in self._logs.values() if log.pending()]
+                    self._cond.wait(min(waits) if waits else None)
+            for dest_ip, log in due:
+                self._drain(dest_ip, log)
+
+    def _drain(self, dest_ip: str, log: OutboxLog):
+        """Send a destination's records in batches until it is empty or a batch fails."""
+        while True:
+            with self._cond:
+                records = log.read(self.max_batch)
+            if not records:
+                return
+            try:
+                delivered = self.deliver(dest_ip, records)
+            except Exception as e:
+                logger.warning("[Outbox] Error retrying %s: %s", dest_ip, e)
+                delivered = 0
+            with self._cond:
+                if delivered:
+                    log.advance(delivered)
+                if delivered < len(records):
+                    delay = min(self.max_delay, self.initial_delay * 2 ** log.failures)
+                    log.failures += 1
+                    log.next_attempt = time.monotonic() + delay
+                    return
+                log.failures = 0
+
+    def stats(self) -> dict:
+        """Stored, delivered and rejected counts, pending and disk bytes per destination."""
+        with self._cond:
+            return {dest_ip: log.stats() for dest_ip, log in self._logs.items()}
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+            for log in self._logs.values():
+                log.close()
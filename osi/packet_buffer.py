@@ -0,0 +1,66 @@
+class PacketBuffer:
+    """
+    A frame kept as a list of buffers instead of one contiguous bytes object.
+
+    Layers wrap the payload in headers and trailers without copying it: every
+    layer's encapsulate does header + data (and the data link layer then adds
+    + trailer), and on a PacketBuffer those operators prepend or append a
+    buffer in place and return the same PacketBuffer. The physical layer hands
+    the buffers to socket.sendmsg, so the payload is copied once, into the kernel.
+    """
+
+    def __init__(self, payload=b""):
+        self.buffers = [payload] if len(payload) else []
+        self.length = len(payload)
+
+    def prepend(self, header) -> "PacketBuffer":
+        if len(header):
+            self.buffers.insert(0, header)
+            self.length += len(header)
+        return self
+
+    def append(self, trailer) -> "PacketBuffer":
+        if len(trailer):
+            self.buffers.append(trailer)
+            self.length += len(trailer)
+        return self
+
+    def __radd__(self, header) -> "PacketBuffer":
+        # header + packet: bytes has no numeric add, so Python falls through to this.
+        return self.prepend(header)
+
+    def __add__(self, trailer) -> "PacketBuffer":
+        return self.append(trailer)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def split(self, size: int) -> list:
+        """
+        Split into PacketBuffers of at most size bytes each. The pieces are
+        memoryview slices of the original buffers, so nothing is copied.
+        """
+        pieces = []
+        piece = PacketBuffer()
+        for buf in self.buffers:
+            view = memoryview(buf)
+            while len(view):
+                take = min(size - len(piece), len(view))
+                piece.append(view[:take])
+                view = view[take:]
+                if len(piece) == size:
+                    pieces.append(piece)
+                    piece = PacketBuffer()
+        if len(piece) or not pieces:
+            pieces.append(piece)
+        return pieces
+
+    def tobytes(self) -> bytes:
+        """The frame as one bytes object. This copies; the send path does not need it."""
+        return b"".join(self.buffers)
+
+    def __bytes__(self) -> bytes:
+        return self.tobytes()
+
+    def __repr__(self) -> str:
+        return f"PacketBuffer({self.length} bytes in {len(self.buffers)} buffers)"
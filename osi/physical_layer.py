@@ -1,20 +1,199 @@
+import logging
 import socket
+import threading
+import time
+
+from capture import CAPTURE_OUT
+from framing import frame_buffers, send_buffers, send_frame
+
+logger = logging.getLogger("osi.physical")
 
 class PhysicalLayer:
-    def __init__(self):
-        pass
+    def __init__(self, max_connections_per_peer: int = 4, idle_timeout: float = 30.0, link=None,
+                 capture=None):
+        """
+        Keep a pool of long-lived TCP connections keyed by (ip, port) so that
+        consecutive frames to the same peer reuse an established connection.
+        With a link (see virtual_network.VirtualLink, datagram_link.DatagramLink
+        and mux_link.MuxLink), frames are handed to it instead and no sockets are
+        used. With a capture (see capture.FrameCapture), every frame sent is
+        recorded in it. Connections idle longer than idle_timeout are closed,
+        by a sweeper thread that runs while any are pooled.
+        """
+        self.link = link
+        self.capture = capture
+        self.max_connections_per_peer = max_connections_per_peer
+        self.idle_timeout = idle_timeout
+        self._idle = {}     # { (ip, port): [(sock, last_used), ...] }
+        self._in_use = {}   # { (ip, port): number of sockets currently lent out }
+        self._sweeper = None
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def _is_alive(sock: socket.socket) -> bool:
+        """
+        Check whether the peer has closed an idle pooled socket. A readable socket
+        with no data means EOF; a socket with nothing to read is still usable.
+        """
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) != b""
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+
+    def _evict_idle(self, now: float):
+        """Close pooled sockets that have been idle longer than idle_timeout. Caller holds the lock."""
+        for key in list(self._idle):
+            fresh = []
+            for sock, last_used in self._idle[key]:
+                if now - last_used > self.idle_timeout:
+                    sock.close()
+                else:
+                    fresh.append((sock, last_used))
+            if fresh:
+                self._idle[key] = fresh
+            else:
+                del self._idle[key]
 
-    def transmit(self, data: bytes, ip_address: str, dest_port: int):
+    def _sweep(self):
         """
-        Transmit the data to the destination IP and port.
+        Close idle sockets every half idle_timeout, so that connections to peers
+        that are not contacted again do not stay open. Exits once none are pooled.
+        """
+        while True:
+            time.sleep(self.idle_timeout / 2)
+            with self._cond:
+                self._evict_idle(time.monotonic())
+                if not self._idle:
+                    self._sweeper = None
+                    return
+
+    def _acquire(self, key):
         """
-        print("[PhysicalLayer] Transmitting data: ", data)
+        Lend out a connection to key. Returns (sock, reused). Blocks while the
+        per-peer cap is reached and no idle connection is available.
+        """
+        with self._cond:
+            while True:
+                self._evict_idle(time.monotonic())
+                idle = self._idle.get(key)
+                while idle:
+                    sock, _ = idle.pop()
+                    if self._is_alive(sock):
+                        self._in_use[key] = self._in_use.get(key, 0) + 1
+                        return sock, True
+                    sock.close()
+                if self._in_use.get(key, 0) < self.max_connections_per_peer:
+                    self._in_use[key] = self._in_use.get(key, 0) + 1
+                    break
+                self._cond.wait()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                print("[PhysicalLayer] Connecting to {}:{}".format(ip_address, dest_port))
-                print()
-                s.connect((ip_address, dest_port))
-                s.sendall(data)
-                print("[PhysicalLayer] Data transmitted successfully.", end="\n\n")
-        except Exception as e:
-            print("[PhysicalLayer] Error transmitting data:", e)
+            logger.debug("[PhysicalLayer] Connecting to %s:%s", *key)
+            sock = socket.create_connection(key)
+        except Exception:
+            self._release(key, None)
+            raise
+        return sock, False
+
+    def _release(self, key, sock: socket.socket, broken: bool = False):
+        """Return a lent connection to the pool, or drop it if it is broken."""
+        with self._cond:
+            self._in_use[key] -= 1
+            if not self._in_use[key]:
+                del self._in_use[key]
+            if sock is not None:
+                if broken:
+                    sock.close()
+                else:
+                    self._idle.setdefault(key, []).append((sock, time.monotonic()))
+                    if self._sweeper is None:
+                        self._sweeper = threading.Thread(target=self._sweep, daemon=True)
+                        self._sweeper.start()
+            self._cond.notify()
+
+    def transmit(self, data: bytes, ip_address: str, dest_port: int, stream=None) -> bool:
+        """
+        Transmit the data to the destination IP and port over a pooled connection,
+        as one length-prefixed message.
+        A reused connection that turns out to be broken is replaced once.
+        stream, a (source port, destination port) pair, is passed on to a link that
+        schedules frames per stream. Returns True if the data was sent.
+        """
+        logger.debug("[PhysicalLayer] Transmitting data: %s", data)
+        if self.capture is not None:
+            self.capture.record(CAPTURE_OUT, data)
+        if self.link is not None:
+            return self.link.transmit(data, ip_address, dest_port, stream)
+
+        def send(sock: socket.socket) -> bool:
+            send_frame(sock, data)
+            return True
+
+        return self.exchange(send, ip_address, dest_port)
+
+    def transmit_many(self, frames: list, ip_address: str, dest_port: int, streams: list = None) -> bool:
+        """
+        Transmit several frames back to back over one pooled connection, gathered
+        into as few sendmsg calls as possible. streams holds each frame's stream
+        (see transmit). Returns True if they were all sent.
+        """
+        self.record(frames)
+        if self.link is not None:
+            streams = streams or [None] * len(frames)
+            return all([self.link.transmit(frame, ip_address, dest_port, stream)
+                        for frame, stream in zip(frames, streams)])
+        buffers = [buf for frame in frames for buf in frame_buffers(frame)]
+
+        def send(sock: socket.socket) -> bool:
+            send_buffers(sock, buffers)
+            return True
+
+        return self.exchange(send, ip_address, dest_port)
+
+    def record(self, frames: list):
+        """Record frames sent by other means than transmit, such as windowed segments."""
+        if self.capture is not None:
+            for frame in frames:
+                self.capture.record(CAPTURE_OUT, frame)
+
+    def exchange(self, fn, ip_address: str, dest_port: int) -> bool:
+        """
+        Lend a pooled connection to fn(sock) -> bool, which may send several frames
+        and read replies (such as transport acks). If fn fails or returns False the
+        connection is closed rather than pooled. A reused connection that turns out
+        to be broken is replaced once. Returns fn's result.
+        """
+        key = (ip_address, dest_port)
+        for attempt in range(2):
+            try:
+                sock, reused = self._acquire(key)
+            except Exception as e:
+                logger.warning("[PhysicalLayer] Error transmitting data: %s", e)
+                return False
+            try:
+                ok = fn(sock)
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError) as e:
+                self._release(key, sock, broken=True)
+                if reused and attempt == 0:
+                    logger.warning("[PhysicalLayer] Pooled connection broken, reconnecting: %s", e)
+                    continue
+                logger.warning("[PhysicalLayer] Error transmitting data: %s", e)
+                return False
+            except Exception as e:
+                self._release(key, sock, broken=True)
+                logger.warning("[PhysicalLayer] Error transmitting data: %s", e)
+                return False
+            self._release(key, sock, broken=not ok)
+            if ok:
+                logger.debug("[PhysicalLayer] Data transmitted successfully.")
+            return ok
+        return False
+
+    def close(self):
+        """Close every pooled connection."""
+        with self._cond:
+            for conns in self._idle.values():
+                for sock, _ in conns:
+                    sock.close()
+            self._idle.clear()
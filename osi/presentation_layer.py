@@ -1,31 +1,178 @@
+import logging
+import os
 import zlib
 import base64
+import binascii
+import struct
 from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM, ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from zdict import CompressionDictionary
+
+logger = logging.getLogger("osi.presentation")
+
+# Every payload produced by a profile starts with one byte: PROFILE_MARKER in the
+# high nibble, FLAG_DICTIONARY in bit 3, the cipher id in bits 1-2 and
+# FLAG_COMPRESSED in bit 0. With FLAG_DICTIONARY, the id of the compression
+# dictionary follows as two bytes. Legacy payloads are bare Fernet tokens, which
+# always start with "g", so the two are told apart by the first byte.
+# The profile byte and dictionary id are authenticated along with the payload:
+# as associated data by the AEAD ciphers, inside the token by Fernet.
+PROFILE_MARKER = 0xA0
+FLAG_COMPRESSED = 0x01
+FLAG_DICTIONARY = 0x08
+DICTIONARY_ID = struct.Struct("!H")
+CIPHER_IDS = {"fernet": 1, "aesgcm": 2, "chacha20": 3}
+CIPHER_NAMES = {cipher_id: name for name, cipher_id in CIPHER_IDS.items()}
+NONCE_SIZE = 12
+# Each AEAD cipher gets its own key, derived from the shared Fernet key with HKDF.
+KEY_INFO = {"aesgcm": b"osi presentation aesgcm", "chacha20": b"osi presentation chacha20"}
+
+def derive_key(key: bytes, cipher: str) -> bytes:
+    """The 32-byte key for cipher, derived from a Fernet key."""
+    return HKDF(algorithm=hashes.SHA256(), length=32, salt=None,
+                info=KEY_INFO[cipher]).derive(base64.urlsafe_b64decode(key))
+
+class PresentationProfile:
+    """
+    How the presentation layer encodes outgoing payloads.
+
+    Payloads shorter than compress_threshold are not compressed, and a
+    compressed payload is only used if it is smaller than the original.
+    cipher is "fernet", "aesgcm" or "chacha20"; legacy=True reproduces the
+    original format (always compress, Fernet, no profile byte). Incoming
+    payloads carry their own profile byte, so peers may use different profiles.
+    """
+
+    def __init__(self, cipher: str = "aesgcm", compress_threshold: int = 512,
+                 compression_level: int = 6, legacy: bool = False):
+        if cipher not in CIPHER_IDS:
+            raise ValueError(f"Unknown cipher: {cipher}")
+        self.cipher = cipher
+        self.compress_threshold = compress_threshold
+        self.compression_level = compression_level
+        self.legacy = legacy
+
+PROFILES = {
+    "legacy": PresentationProfile(cipher="fernet", compress_threshold=0, compression_level=-1, legacy=True),
+    "fernet": PresentationProfile(cipher="fernet"),
+    "aesgcm": PresentationProfile(cipher="aesgcm"),
+    "chacha20": PresentationProfile(cipher="chacha20"),
+}
 
 class PresentationLayer:
-    def __init__(self, key: bytes):
+    def __init__(self, key: bytes, profile: PresentationProfile = None, dictionaries: dict = None):
+        """
+        dictionaries maps ids to zlib preset dictionaries (see zdict.py). Payloads
+        under the profile's compress_threshold, otherwise sent uncompressed, are
+        compressed with the highest-numbered one when that makes them smaller;
+        incoming payloads name the dictionary they need.
+        """
+        self.key = key
+        self.profile = profile if profile is not None else PROFILES["aesgcm"]
+        self.dictionaries = {dict_id: CompressionDictionary(dict_id, data)
+                             for dict_id, data in (dictionaries or {}).items()}
+        self.dictionary = self.dictionaries[max(self.dictionaries)] if self.dictionaries else None
         self.cipher = Fernet(key)
+        self.aeads = {"aesgcm": AESGCM(derive_key(key, "aesgcm")),
+                      "chacha20": ChaCha20Poly1305(derive_key(key, "chacha20"))}
 
-    def encapsulate(self, data: str) -> bytes:
-        compressed = zlib.compress(data.encode('utf-8'))
-        print(f"[PresentationLayer] Compressed data: {compressed}")
-
-        encrypted = self.cipher.encrypt(compressed)
-        print(f"[PresentationLayer] Encrypted data: {encrypted}")
+    def encapsulate(self, data, binary: bool = False) -> bytes:
+        """
+        Compress (when worthwhile) and encrypt data (bytes, or text to encode as
+        UTF-8). Binary frames carry the result as is; text frames need it
+        base64-encoded.
+        """
+        profile = self.profile
+        raw = data.encode('utf-8') if isinstance(data, str) else data
+        if profile.legacy:
+            compressed = zlib.compress(raw)
+            logger.debug("[PresentationLayer] Compressed data: %s", compressed)
+            encrypted = self.cipher.encrypt(compressed)
+        else:
+            flags = PROFILE_MARKER | (CIPHER_IDS[profile.cipher] << 1)
+            header = b""
+            body = raw
+            if len(raw) >= profile.compress_threshold:
+                compressed = zlib.compress(raw, profile.compression_level)
+                if len(compressed) < len(raw):
+                    flags |= FLAG_COMPRESSED
+                    body = compressed
+                    logger.debug("[PresentationLayer] Compressed data: %s", compressed)
+            elif self.dictionary is not None:
+                compressed = self.dictionary.compress(raw)
+                if len(compressed) + DICTIONARY_ID.size < len(raw):
+                    flags |= FLAG_COMPRESSED | FLAG_DICTIONARY
+                    header = DICTIONARY_ID.pack(self.dictionary.id)
+                    body = compressed
+                    logger.debug("[PresentationLayer] Compressed data with dictionary %s: %s",
+                                 self.dictionary.id, compressed)
+            header = bytes([flags]) + header
+            encrypted = header + self._encrypt(profile.cipher, header, body)
+        logger.debug("[PresentationLayer] Encrypted data: %s", encrypted)
+        if binary:
+            return encrypted
 
         encoded = base64.b64encode(encrypted)
-        print(f"[PresentationLayer] Encoded data: {encoded}")
+        logger.debug("[PresentationLayer] Encoded data: %s", encoded)
 
         return encoded
 
-    def decapsulate(self, data: bytes) -> str:
-        decoded = base64.b64decode(data)
-        print(f"[PresentationLayer] Decoded data: {decoded}")
+    def _encrypt(self, cipher: str, header: bytes, body: bytes) -> bytes:
+        """Encrypt body, authenticating the header that goes in front of it."""
+        if cipher == "fernet":
+            return self.cipher.encrypt(header + body)
+        nonce = os.urandom(NONCE_SIZE)
+        return nonce + self.aeads[cipher].encrypt(nonce, body, header)
+
+    def decapsulate(self, data: bytes, binary: bool = False) -> bytes:
+        """Decrypt and decompress a payload. Returns the application payload bytes."""
+        if binary:
+            decoded = data
+        else:
+            # a2b_base64 reads any bytes-like object directly, so a memoryview from the
+            # binary decapsulation chain is decoded without an intermediate copy.
+            decoded = binascii.a2b_base64(data)
+            logger.debug("[PresentationLayer] Decoded data: %s", decoded)
+
+        flags = decoded[0] if len(decoded) else 0
+        dictionary = None
+        if flags & 0xF0 != PROFILE_MARKER:
+            # Legacy payload: a bare Fernet token over zlib-compressed data.
+            decrypted = self.cipher.decrypt(bytes(decoded))
+            compressed = True
+        else:
+            cipher = CIPHER_NAMES.get((flags >> 1) & 0x03)
+            if cipher is None:
+                raise Exception(f"Unknown presentation profile byte: {flags:#x}")
+            offset = 1
+            if flags & FLAG_DICTIONARY:
+                dict_id, = DICTIONARY_ID.unpack_from(decoded, offset)
+                dictionary = self.dictionaries.get(dict_id)
+                if dictionary is None:
+                    raise Exception(f"Unknown compression dictionary: {dict_id}")
+                offset += DICTIONARY_ID.size
+            view = memoryview(decoded)
+            decrypted = self._decrypt(cipher, view[:offset], view[offset:])
+            compressed = bool(flags & FLAG_COMPRESSED)
+        logger.debug("[PresentationLayer] Decrypted data: %s", decrypted)
 
-        decrypted = self.cipher.decrypt(decoded)
-        print(f"[PresentationLayer] Decrypted data: {decrypted}")
+        if dictionary is not None:
+            decrypted = dictionary.decompress(decrypted)
+            logger.debug("[PresentationLayer] Decompressed data with dictionary %s: %s", dictionary.id, decrypted)
+        elif compressed:
+            decrypted = zlib.decompress(decrypted)
+            logger.debug("[PresentationLayer] Decompressed data: %s", decrypted)
 
-        decompressed = zlib.decompress(decrypted)
-        print(f"[PresentationLayer] Decompressed data: {decompressed}")
+        return decrypted
 
-        return decompressed.decode('utf-8')
\ No newline at end of file
+    def _decrypt(self, cipher: str, header: memoryview, body: memoryview) -> bytes:
+        """Decrypt body, failing if the header in front of it was not the one encrypted with it."""
+        if cipher == "fernet":
+            decrypted = self.cipher.decrypt(bytes(body))
+            if decrypted[:len(header)] != header:
+                raise Exception("Presentation header does not match the encrypted payload.")
+            return decrypted[len(header):]
+        return self.aeads[cipher].decrypt(body[:NONCE_SIZE], body[NONCE_SIZE:], bytes(header))
@@ -0,0 +1,142 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from presentation_layer import PresentationLayer
+
+# Jobs whose payloads add up to less than this run on the calling thread: handing
+# them to a worker would cost more than the compression and encryption itself.
+MIN_OFFLOAD_BYTES = 64 * 1024
+# Small payloads are grouped into one worker job of up to this many bytes.
+BATCH_BYTES = 256 * 1024
+
+# The presentation layer of a worker process, set up once by _init_worker.
+_worker_layer = None
+
+def _init_worker(key: bytes, profile, dictionaries: dict):
+    global _worker_layer
+    _worker_layer = PresentationLayer(key, profile, dictionaries)
+
+def _encode_batch(items: list) -> list:
+    return _run_batch(_worker_layer.encapsulate, items)
+
+def _decode_batch(items: list) -> list:
+    return _run_batch(_worker_layer.decapsulate, items)
+
+def _run_batch(fn, items: list) -> list:
+    """Apply fn(data, binary) to every item. A failed item yields its exception instead of a result."""
+    results = []
+    for data, binary in items:
+        try:
+            results.append(fn(data, binary))
+        except Exception as e:
+            results.append(e)
+    return results
+
+class PresentationPool:
+    """
+    Runs presentation encapsulation and decapsulation on a pool of workers so a
+    burst of large messages does not hold up every connection thread.
+
+    mode "process" uses worker processes, each with its own PresentationLayer
+    built from the same key, profile and dictionaries; "thread" uses threads,
+    which only helps where zlib and the cipher release the GIL. Payloads handed over together are
+    split into jobs: large payloads get a job each so they spread across workers,
+    and runs of small payloads share one job to keep the IPC overhead down. Results
+    always come back in the order the payloads were given, so a connection that
+    hands over its messages in arrival order delivers them in that order.
+    """
+
+    def __init__(self, presentation_layer: PresentationLayer, workers: int, mode: str = "process",
+                 min_offload_bytes: int = MIN_OFFLOAD_BYTES, batch_bytes: int = BATCH_BYTES):
+        if mode not in ("process", "thread"):
+            raise ValueError(f"Unknown presentation pool mode: {mode}")
+        self.presentation_layer = presentation_layer
+        self.mode = mode
+        self.min_offload_bytes = min_offload_bytes
+        self.batch_bytes = batch_bytes
+        if mode == "process":
+            # spawn rather than fork: the server already runs threads (ARP listener,
+            # connection handlers) whose locks a forked child would inherit.
+            self.executor = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker, initargs=(
+                    presentation_layer.key, presentation_layer.profile,
+                    {dict_id: dictionary.data for dict_id, dictionary in presentation_layer.dictionaries.items()}))
+            self._encode, self._decode = _encode_batch, _decode_batch
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="presentation")
+            layer = presentation_layer
+            self._encode = lambda items: _run_batch(layer.encapsulate, items)
+            self._decode = lambda items: _run_batch(layer.decapsulate, items)
+
+    def encode(self, data: bytes, binary: bool = False) -> bytes:
+        """PresentationLayer.encapsulate on the pool."""
+        return self._unwrap(self.encode_many([(data, binary)])[0])
+
+    def decode(self, data, binary: bool = False) -> bytes:
+        """PresentationLayer.decapsulate on the pool."""
+        return self._unwrap(self.decode_many([(data, binary)])[0])
+
+    def encode_many(self, items: list) -> list:
+        """
+        Encapsulate [(data, binary), ...]. Returns one result per item, in order;
+        an item that failed yields its exception.
+        """
+        return self.gather(self.submit(self._encode, items, self.presentation_layer.encapsulate))
+
+    def decode_many(self, items: list) -> list:
+        """Decapsulate [(data, binary), ...]; results as for encode_many."""
+        return self.gather(self.submit(self._decode, items, self.presentation_layer.decapsulate))
+
+    def submit_encode(self, items: list) -> list:
+        """Start encode_many without waiting. Returns the futures to pass to gather."""
+        return self.submit(self._encode, items, self.presentation_layer.encapsulate)
+
+    def submit_decode(self, items: list) -> list:
+        """Start decode_many without waiting. Returns the futures to pass to gather."""
+        return self.submit(self._decode, items, self.presentation_layer.decapsulate)
+
+    def submit(self, job, items: list, inline_fn) -> list:
+        """
+        Split items into jobs and submit them. Returns a list with one entry per
+        job: a Future, or the finished results of a job that was run inline.
+        """
+        if self.mode == "process":
+            # memoryview slices from the binary receive chain cannot be pickled.
+            items = [(bytes(data) if isinstance(data, memoryview) else data, binary) for data, binary in items]
+        pending = []
+        for batch in self._batches(items):
+            if sum(len(data) for data, _ in batch) < self.min_offload_bytes:
+                pending.append(_run_batch(inline_fn, batch))
+            else:
+                pending.append(self.executor.submit(job, batch))
+        return pending
+
+    def _batches(self, items: list):
+        batch, size = [], 0
+        for item in items:
+            length = len(item[0])
+            if batch and size + length > self.batch_bytes:
+                yield batch
+                batch, size = [], 0
+            batch.append(item)
+            size += length
+        if batch:
+            yield batch
+
+    @staticmethod
+    def gather(pending: list) -> list:
+        """Wait for the jobs returned by submit and flatten their results in order."""
+        results = []
+        for job in pending:
+            results.extend(job if isinstance(job, list) else job.result())
+        return results
+
+    @staticmethod
+    def _unwrap(result):
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,131 @@
+import json
+import time
+
+from capture import CaptureReader, CAPTURE_IN
+from osi_server import OSIServer, load_presentation_key
+from zdict import load_dictionary
+
+class Replay:
+    """
+    Feeds frames from a capture (see capture.FrameCapture) back into a server's
+    process_received_data, as if they had just arrived: at the captured pace
+    divided by speed, or as fast as possible with speed 0.
+
+    The server stands in for the node that captured the frames, so it should
+    have that node's address, MAC, sessions and presentation key (see
+    replay_server). Messages it would deliver to chat clients and packets it
+    would forward are counted instead of sent, so a replay only exercises the
+    receive path and sends nothing.
+
+    Each loop starts with the transport layer's reassembly state cleared, so
+    segmented messages are delivered again rather than taken for resent
+    segments of messages already completed.
+    """
+
+    def __init__(self, server: OSIServer, frames: list):
+        self.server = server
+        self.frames = frames  # [(capture time in ns, frame), ...], oldest first
+        self.delivered = {}   # { port: messages delivered }
+        self.forwarded = 0
+        server.app_layer.process_message = self.count_delivery
+        server.forward_packet = self.count_forward
+
+    def count_delivery(self, message_obj: object, transport_port: int = None):
+        self.delivered[transport_port] = self.delivered.get(transport_port, 0) + 1
+
+    def count_forward(self, packet, dest_ip: str, binary: bool = False):
+        self.forwarded += 1
+
+    def run(self, speed: float = 1.0, loops: int = 1) -> dict:
+        """
+        Replay the frames loops times over. Returns the frames and bytes replayed,
+        how long that took, how far behind the captured pace it fell at most, and
+        the messages delivered in all and in each loop.
+        """
+        receive = self.server.process_received_data
+        reassembler = self.server.transport_layer.reassembler
+        first = self.frames[0][0] if self.frames else 0
+        max_lag = 0.0
+        per_loop = []
+        start = time.perf_counter()
+        for _ in range(loops):
+            reassembler.reset()
+            delivered = sum(self.delivered.values())
+            loop_start = time.perf_counter()
+            for timestamp, frame in self.frames:
+                if speed:
+                    wait = loop_start + (timestamp - first) / 1e9 / speed - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                    elif -wait > max_lag:
+                        max_lag = -wait
+                receive(frame, None)
+            per_loop.append(sum(self.delivered.values()) - delivered)
+        elapsed = time.perf_counter() - start
+        return {
+            "frames": len(self.frames) * loops,
+            "bytes": sum(len(frame) for _, frame in self.frames) * loops,
+            "captured_seconds": (self.frames[-1][0] - first) / 1e9 if self.frames else 0.0,
+            "seconds": elapsed,
+            "max_lag_ms": max_lag * 1e3,
+            "delivered": sum(self.delivered.values()),
+            "delivered_per_loop": per_loop,
+            "forwarded": self.forwarded,
+        }
+
+def load_frames(reader: CaptureReader) -> list:
+    """The frames the capturing node received: [(capture time in ns, frame), ...]."""
+    return [(timestamp, frame) for timestamp, direction, frame in reader.records() if direction == CAPTURE_IN]
+
+def replay_server(reader: CaptureReader, presentation_key: bytes, **kwargs) -> OSIServer:
+    """A server with the capturing node's address, MAC and sessions, which opens no sockets."""
+    server = OSIServer(port=0, ip=reader.ip, mac=reader.mac, arp_listener=False,
+                       presentation_key=presentation_key, **kwargs)
+    for peer_ip, session_id in reader.sessions.items():
+        server.session_layer.store_session(peer_ip, session_id)
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Replay the frames a server received, from a capture written by osi_server.py --capture.")
+    parser.add_argument("capture", help="capture file")
+    parser.add_argument("--presentation-key-file", metavar="PATH", required=True,
+                        help="the presentation key the capturing server used (osi_server.py --presentation-key-file)")
+    parser.add_argument("--zdict", action="append", default=[], metavar="PATH",
+                        help="compression dictionary the capturing server used; may be repeated")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay at this multiple of the captured pace; 0 replays as fast as possible")
+    parser.add_argument("--loops", type=int, default=1, help="replay the capture this many times over")
+    parser.add_argument("--output", help="write the results and the server's stats() to this JSON file")
+    args = parser.parse_args()
+    if args.speed < 0:
+        parser.error("--speed must not be negative")
+
+    reader = CaptureReader(args.capture)
+    frames = load_frames(reader)
+    dictionaries = {dictionary.id: dictionary.data for dictionary in map(load_dictionary, args.zdict)}
+    server = replay_server(reader, load_presentation_key(args.presentation_key_file),
+                           presentation_dictionaries=dictionaries)
+    reader.close()
+    print(f"Replaying {len(frames)} frames received by {reader.ip}"
+          f"{' as fast as possible' if not args.speed else f' at {args.speed:g}x'}")
+    results = Replay(server, frames).run(args.speed, args.loops)
+    stats = server.stats()
+    seconds = results["seconds"] or 1e-9
+    print(f"{results['frames']} frames, {results['bytes'] / 1e6:.1f} MB in {results['seconds']:.3f} s: "
+          f"{results['frames'] / seconds:.0f} frames/s, {results['bytes'] / 1e6 / seconds:.1f} MB/s, "
+          f"{results['delivered']} messages delivered, {results['forwarded']} forwarded, "
+          f"{stats['counters'].get('recv.dropped', 0)} dropped")
+    if args.loops > 1:
+        print(f"Messages delivered per loop: {', '.join(map(str, results['delivered_per_loop']))}")
+    if args.speed:
+        print(f"Fell behind the captured pace by at most {results['max_lag_ms']:.1f} ms")
+    for stage, histogram in stats["stages"].items():
+        if stage.startswith("recv."):
+            print(f"{stage:>20} p50 {histogram['p50_ns'] / 1e3:>9.1f} us  p99 {histogram['p99_ns'] / 1e3:>9.1f} us")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"replay": results, "stats": stats}, f, indent=2)
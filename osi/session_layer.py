@@ -1,55 +1,227 @@
+import logging
 import uuid
 import socket
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from framing import send_frame, recv_frame
+from network_layer import DEFAULT_TTL
+
+logger = logging.getLogger("osi.session")
+
+# Binary session header: the session id as raw UUID bytes.
+SESSION_BINARY_HEADER = struct.Struct("!16s")
+# A handshake for a receiver behind a router names both ends and carries a TTL,
+# so that routers can pass it on: "SESSION_HANDSHAKE:<src_ip>,<dest_ip>,<ttl>|<session id>".
+# A handshake sent straight to its receiver is the bare session id.
+HANDSHAKE_PREFIX = "SESSION_HANDSHAKE:"
+
+class _Handshake:
+    """An in-flight session handshake that concurrent senders wait on."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.ok = False
 
 class SessionLayer:
-    def __init__(self, port: int = 5000):
+    def __init__(self, port: int = 5000, max_sessions: int = 10000, idle_timeout: float = 3600.0, link=None,
+                 ip: str = None, next_hop=None):
         self.port = port
-        # A dictionary mapping sender (or connection) identifiers to session ids.
-        self.sessions = {}  # { sender_ip: session_id }
+        # With a link (see virtual_network.VirtualLink), handshakes go over it instead of TCP.
+        self.link = link
+        # Handshakes are sent to next_hop(receiver_ip) (see NetworkLayer.next_hop), and
+        # handshakes for hosts other than ip are passed on the same way.
+        self.ip = ip
+        self.next_hop = next_hop if next_hop is not None else (lambda receiver_ip: receiver_ip)
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        # Sessions by peer, least recently used first.
+        self.sessions = OrderedDict()  # { sender_ip: session_id }
+        self._last_used = {}           # { sender_ip: monotonic time of last use }
+        # Evicted sessions, kept so either side can pick them up again without a handshake.
+        self._resumable = OrderedDict()  # { sender_ip: session_id }
+        self._handshakes = {}          # { receiver_ip: _Handshake }
+        self._lock = threading.Lock()
+        # Called with (peer_ip, session_id) whenever a session is stored (see capture.FrameCapture).
+        self.on_store = None
+
+    def store_session(self, peer_ip: str, session_id: str):
+        """Record the session for peer_ip and evict idle or excess sessions."""
+        with self._lock:
+            self.sessions[peer_ip] = session_id
+            self.sessions.move_to_end(peer_ip)
+            self._last_used[peer_ip] = time.monotonic()
+            self._resumable.pop(peer_ip, None)
+            self._evict()
+        if self.on_store is not None:
+            self.on_store(peer_ip, session_id)
+
+    def _evict(self):
+        """Evict from the least recently used end. Caller holds the lock."""
+        now = time.monotonic()
+        while self.sessions:
+            peer_ip = next(iter(self.sessions))
+            if len(self.sessions) <= self.max_sessions and now - self._last_used.get(peer_ip, now) <= self.idle_timeout:
+                break
+            self._resumable[peer_ip] = self.sessions.pop(peer_ip)
+            self._last_used.pop(peer_ip, None)
+            logger.debug("[SessionLayer] Evicted session with %s", peer_ip)
+        while len(self._resumable) > self.max_sessions:
+            self._resumable.popitem(last=False)
+
+    def lookup_session(self, peer_ip: str, offered_id: str = None) -> str:
+        """
+        Return the session id for peer_ip and mark it as used. An evicted session
+        is resumed if offered_id is None or matches it. Returns None if there is
+        no session to use.
+        """
+        with self._lock:
+            session_id = self.sessions.get(peer_ip)
+            if session_id is None:
+                resumed = self._resumable.get(peer_ip)
+                if resumed is None or (offered_id is not None and offered_id != resumed):
+                    return None
+                del self._resumable[peer_ip]
+                self.sessions[peer_ip] = session_id = resumed
+                logger.debug("[SessionLayer] Resumed session %s with %s", session_id, peer_ip)
+            self.sessions.move_to_end(peer_ip)
+            self._last_used[peer_ip] = time.monotonic()
+            self._evict()
+            return session_id
 
     def establish_session(self, receiver_ip: str) -> bool:
-        """Client-side: Initiate a session with the receiver."""
+        """Client-side: Initiate a session with the receiver, through its next hop."""
         session_id = str(uuid.uuid4())
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
-            try:
-                sock.connect((receiver_ip, self.port))
-                sock.sendall(session_id.encode('utf-8'))
-                print(f"[SessionLayer] Sent session id: {session_id} to {receiver_ip}")
-                ack = sock.recv(1024).decode('utf-8')
-                if ack == "ACK":
-                    print("[SessionLayer] Session established successfully.")
-                    # Store session using receiver_ip as key
-                    self.sessions[receiver_ip] = session_id
-                    return True
-                else:
-                    print(f"[SessionLayer] Unexpected response: {ack}")
-                    return False
-            except Exception as e:
-                print(f"[SessionLayer] Error establishing session: {e}")
-                return False
-
-    def handle_incoming_session(self, conn: socket.socket, sender_ip: str, initial_data: bytes) -> str:
-        """Server-side: Handle an incoming handshake initiated by a client."""
+        next_hop = self.next_hop(receiver_ip)
         try:
-            session_id = initial_data.decode('utf-8')
-            conn.sendall("ACK".encode('utf-8'))
-            print(f"[SessionLayer] Received session id: {session_id} from {sender_ip}. Sent ACK.")
-            # Store the session id keyed by the sender's IP
-            self.sessions[sender_ip] = session_id
-            return session_id
+            reply = self.request(next_hop, self.handshake_request(session_id, receiver_ip, next_hop))
+            logger.debug("[SessionLayer] Sent session id: %s to %s", session_id, receiver_ip)
         except Exception as e:
-            print(f"[SessionLayer] Error during incoming session handshake: {e}")
+            logger.warning("[SessionLayer] Error establishing session: %s", e)
+            return False
+        if reply != b"ACK":
+            logger.warning("[SessionLayer] Unexpected response: %s", reply)
+            return False
+        logger.debug("[SessionLayer] Session established successfully.")
+        # Store session using receiver_ip as key
+        self.store_session(receiver_ip, session_id)
+        return True
+
+    def request(self, host: str, data: bytes) -> bytes:
+        """Send a handshake to host and return its reply, or None if there was none."""
+        if self.link is not None:
+            return self.link.request(host, self.port, data)
+        with socket.create_connection((host, self.port)) as sock:
+            send_frame(sock, data)
+            return recv_frame(sock)
+
+    def handshake_request(self, session_id: str, receiver_ip: str, next_hop: str, src_ip: str = None,
+                          ttl: int = DEFAULT_TTL) -> bytes:
+        """
+        The handshake for receiver_ip: addressed if it goes through a router first,
+        or is being passed on for src_ip.
+        """
+        if next_hop == receiver_ip and src_ip is None:
+            return session_id.encode('utf-8')
+        return f"{HANDSHAKE_PREFIX}{src_ip or self.ip},{receiver_ip},{ttl}|{session_id}".encode('utf-8')
+
+    def route_handshake(self, data: bytes, sender_ip: str):
+        """
+        Accept a handshake received from sender_ip, or prepare to pass it on.
+        Returns (None, None) once a handshake addressed to this node is accepted,
+        or (next hop, handshake to send it) for one addressed to another host.
+        """
+        decoded = data.decode('utf-8')
+        if not decoded.startswith(HANDSHAKE_PREFIX):
+            self.accept_session(sender_ip, data)
+            return None, None
+        header, _, session_id = decoded[len(HANDSHAKE_PREFIX):].partition("|")
+        parts = header.split(",")
+        if len(parts) != 3 or not session_id:
+            raise Exception("Invalid session handshake format.")
+        src_ip, dest_ip, ttl = parts[0], parts[1], int(parts[2])
+        if dest_ip == self.ip:
+            self.accept_session(src_ip, session_id.encode('utf-8'))
+            return None, None
+        if ttl <= 1:
+            raise Exception(f"TTL expired for handshake from {src_ip} to {dest_ip}")
+        next_hop = self.next_hop(dest_ip)
+        if next_hop == self.ip:
+            raise Exception(f"No route for handshake from {src_ip} to {dest_ip}")
+        logger.debug("[SessionLayer] Passing handshake from %s to %s on to %s", src_ip, dest_ip, next_hop)
+        return next_hop, self.handshake_request(session_id, dest_ip, next_hop, src_ip, ttl - 1)
+
+    def answer_handshake(self, data: bytes, sender_ip: str) -> bytes:
+        """
+        The reply to a handshake received from sender_ip: ACK, or for a handshake
+        passed on to another host, that host's reply.
+        """
+        next_hop, request = self.route_handshake(data, sender_ip)
+        if next_hop is None:
+            return b"ACK"
+        return self.request(next_hop, request)
+
+    def accept_session(self, sender_ip: str, initial_data: bytes) -> str:
+        """Record the session id a client sent in its handshake. Returns the session id."""
+        session_id = initial_data.decode('utf-8')
+        # Store the session id keyed by the sender's IP
+        self.store_session(sender_ip, session_id)
+        return session_id
+
+    def handle_incoming_session(self, conn: socket.socket, sender_ip: str, initial_data: bytes) -> bytes:
+        """Server-side: Handle an incoming handshake initiated by a client. Returns the reply sent."""
+        try:
+            reply = self.answer_handshake(initial_data, sender_ip)
+            if reply is not None:
+                send_frame(conn, reply)
+            logger.debug("[SessionLayer] Handled session handshake from %s. Sent %s.", sender_ip, reply)
+            return reply
+        except Exception as e:
+            logger.warning("[SessionLayer] Error during incoming session handshake: %s", e)
             return None
 
+    def ensure_session(self, receiver_ip: str) -> str:
+        """
+        Return the session id for receiver_ip, establishing a session first if needed.
+        Concurrent callers share a single handshake per receiver.
+        """
+        session_id = self.lookup_session(receiver_ip)
+        if session_id is not None:
+            return session_id
+        with self._lock:
+            handshake = self._handshakes.get(receiver_ip)
+            leader = handshake is None
+            if leader:
+                handshake = self._handshakes[receiver_ip] = _Handshake()
+        if leader:
+            logger.debug("[SessionLayer] No active session for receiver. Establishing session now...")
+            try:
+                handshake.ok = self.establish_session(receiver_ip)
+            finally:
+                with self._lock:
+                    del self._handshakes[receiver_ip]
+                handshake.done.set()
+        else:
+            handshake.done.wait()
+        session_id = self.sessions.get(receiver_ip) if handshake.ok else None
+        if session_id is None:
+            raise Exception("Failed to establish session with the receiver.")
+        return session_id
+
+    def header(self, receiver_ip: str) -> bytes:
+        """The text session header for receiver_ip."""
+        return f"SESSION_ID:{self.ensure_session(receiver_ip)}|".encode('utf-8')
+
+    def binary_header(self, receiver_ip: str) -> bytes:
+        """The binary session header for receiver_ip."""
+        return SESSION_BINARY_HEADER.pack(uuid.UUID(self.ensure_session(receiver_ip)).bytes)
+
     def encapsulate(self, data: bytes, receiver_ip: str) -> bytes:
         """Encapsulate data with the session header for the session established with receiver_ip."""
-        if receiver_ip not in self.sessions:
-            print("[SessionLayer] No active session for receiver. Establishing session now...")
-            if not self.establish_session(receiver_ip):
-                raise Exception("Failed to establish session with the receiver.")
-        header = f"SESSION_ID:{self.sessions[receiver_ip]}|".encode('utf-8')
-        encapsulated_data = header + data
-        print(f"[SessionLayer] Encapsulated data: {encapsulated_data}")
+        encapsulated_data = self.header(receiver_ip) + data
+        logger.debug("[SessionLayer] Encapsulated data: %s", encapsulated_data)
         return encapsulated_data
 
     def decapsulate(self, data: bytes, sender_ip: str) -> bytes:
@@ -62,13 +234,36 @@ class SessionLayer:
             header = decoded[:header_end]
             inner = decoded[header_end+1:]
             received_session_id = header.split("SESSION_ID:")[1]
-            expected_session_id = self.sessions.get(sender_ip)
+            expected_session_id = self.lookup_session(sender_ip, received_session_id)
             if expected_session_id is None:
                 raise Exception("No active session for sender; cannot validate incoming session id.")
             if expected_session_id != received_session_id:
                 raise Exception(f"Session ID mismatch: expected {expected_session_id}, got {received_session_id}")
             else:
-                print(f"[SessionLayer] Session ID validated: {received_session_id}")
-                print(f"[SessionLayer] Decapsulated data: {inner}")
+                logger.debug("[SessionLayer] Session ID validated: %s", received_session_id)
+                logger.debug("[SessionLayer] Decapsulated data: %s", inner)
             return inner.encode('utf-8')
         return data
+
+    def encapsulate_binary(self, data: bytes, receiver_ip: str) -> bytes:
+        """Binary counterpart of encapsulate: the session id as 16 raw UUID bytes."""
+        header = self.binary_header(receiver_ip)
+        logger.debug("[SessionLayer] Encapsulated %s bytes (binary)", len(data))
+        return header + data
+
+    def decapsulate_binary(self, data: memoryview, sender_ip: str) -> memoryview:
+        """
+        Parse the binary session header, validate it against the stored session for
+        sender_ip and return a view of the payload.
+        """
+        if len(data) < SESSION_BINARY_HEADER.size:
+            raise Exception("Truncated binary session header.")
+        (received,) = SESSION_BINARY_HEADER.unpack_from(data)
+        received_session_id = str(uuid.UUID(bytes=received))
+        expected_session_id = self.lookup_session(sender_ip, received_session_id)
+        if expected_session_id is None:
+            raise Exception("No active session for sender; cannot validate incoming session id.")
+        if expected_session_id != received_session_id:
+            raise Exception(f"Session ID mismatch: expected {expected_session_id}, got {received_session_id}")
+        logger.debug("[SessionLayer] Session ID validated: %s", expected_session_id)
+        return data[SESSION_BINARY_HEADER.size:]
@@ -0,0 +1,124 @@
+import json
+import threading
+import time
+
+class Histogram:
+    """
+    Latency histogram with power-of-two nanosecond buckets: bucket i counts
+    samples in [2**(i-1), 2**i) ns. Percentiles are reported as bucket upper
+    bounds, which is accurate to within a factor of two.
+    """
+
+    BUCKETS = 64
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self._lock = threading.Lock()
+
+    def record(self, ns: int):
+        bucket = min(ns.bit_length(), self.BUCKETS - 1)
+        with self._lock:
+            self.counts[bucket] += 1
+            self.count += 1
+            self.total_ns += ns
+            if ns > self.max_ns:
+                self.max_ns = ns
+
+    def percentile(self, fraction: float) -> int:
+        """Upper bound, in ns, of the bucket holding the given fraction of samples."""
+        target = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= target:
+                return min(1 << bucket, self.max_ns)
+        return 0
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "mean_ns": self.total_ns // self.count if self.count else 0,
+            "p50_ns": self.percentile(0.50),
+            "p99_ns": self.percentile(0.99),
+            "p999_ns": self.percentile(0.999),
+            "max_ns": self.max_ns,
+        }
+
+class Tracer:
+    """
+    Per-stage latency histograms and packet counters for the send and receive
+    paths, plus optional sampled per-packet trace records.
+
+    When trace_path is set, one packet in every sample_every is traced: the
+    duration of each stage it passed through is written to trace_path as one
+    JSON object per line.
+    """
+
+    def __init__(self, trace_path: str = None, sample_every: int = 1000):
+        self.histograms = {}  # { stage: Histogram }
+        self.counters = {}    # { event: count }
+        self.sample_every = sample_every
+        self._trace_file = open(trace_path, "a", encoding="utf-8") if trace_path else None
+        self._packets = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _histogram(self, stage: str) -> Histogram:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, Histogram())
+        return histogram
+
+    def record(self, stage: str, ns: int):
+        self._histogram(stage).record(ns)
+        packet = getattr(self._local, "packet", None)
+        if packet is not None:
+            packet["stages"][stage] = ns
+
+    def timed(self, stage: str, fn, *args):
+        """Call fn(*args) and record how long it took under stage."""
+        start = time.perf_counter_ns()
+        try:
+            return fn(*args)
+        finally:
+            self.record(stage, time.perf_counter_ns() - start)
+
+    def count(self, event: str, n: int = 1):
+        with self._lock:
+            self.counters[event] = self.counters.get(event, 0) + n
+
+    def begin_packet(self, direction: str, size: int):
+        """Count a packet and, if it is sampled, start collecting its trace record."""
+        with self._lock:
+            self._packets += 1
+            sampled = self._trace_file is not None and self._packets % self.sample_every == 0
+            self.counters[direction] = self.counters.get(direction, 0) + 1
+        if sampled:
+            self._local.packet = {"ts": time.time(), "direction": direction, "size": size, "stages": {}}
+
+    def end_packet(self, **fields):
+        """Finish the current packet's trace record, if it was sampled, and write it out."""
+        packet = getattr(self._local, "packet", None)
+        if packet is None:
+            return
+        self._local.packet = None
+        packet.update(fields)
+        line = json.dumps(packet)
+        with self._lock:
+            self._trace_file.write(line + "\n")
+            self._trace_file.flush()
+
+    def stats(self) -> dict:
+        return {
+            "counters": dict(self.counters),
+            "stages": {stage: histogram.to_dict() for stage, histogram in sorted(self.histograms.items())},
+        }
+
+    def close(self):
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
@@ -1,66 +1,509 @@
+import itertools
+import logging
+import queue
+import random
 import socket
 import json
+import struct
+import threading
+import time
+from collections import OrderedDict
 from typing import Tuple
 
+from framing import MAX_MESSAGE_SIZE, StreamBuffer, send_frame
+from packet_buffer import PacketBuffer
+
+logger = logging.getLogger("osi.transport")
+
+# Binary transport header: destination port and flags.
+TRANS_BINARY_HEADER = struct.Struct("!HB")
+# Set in the flags when a binary segment header (message id, sequence number,
+# segment count) follows the transport header.
+FLAG_SEGMENTED = 0x01
+TRANS_SEGMENT_HEADER = struct.Struct("!III")
+
+# Payloads longer than this are split into segments of at most this many bytes.
+SEGMENT_SIZE = 64 * 1024
+# Segments a sender may have in flight before it waits for an acknowledgement.
+WINDOW = 16
+# Seconds without an acknowledgement before unacknowledged segments are resent.
+ACK_TIMEOUT = 2.0
+# Consecutive timeouts after which a segmented send gives up.
+MAX_RETRIES = 3
+
+class SegmentWindow:
+    """
+    Sender-side sliding window over the segments of one message: which segments
+    may be sent, and how cumulative acks and ack timeouts move the window.
+    """
+
+    def __init__(self, total: int, window: int):
+        self.total = total
+        self.window = window
+        self.base = 0      # Lowest unacknowledged segment.
+        self.next_seq = 0  # Next segment to send.
+        self.retries = 0
+
+    @property
+    def done(self) -> bool:
+        return self.base >= self.total
+
+    def sendable(self) -> range:
+        """The segments that may be sent now. They count as sent once returned."""
+        end = min(self.total, self.base + self.window)
+        seqs = range(self.next_seq, end)
+        self.next_seq = max(self.next_seq, end)
+        return seqs
+
+    def ack(self, next_seq: int) -> bool:
+        """Apply a cumulative ack. Returns True if it moved the window."""
+        if next_seq <= self.base:
+            return False
+        self.base = min(next_seq, self.total)
+        self.next_seq = max(self.next_seq, self.base)
+        self.retries = 0
+        return True
+
+    def timeout(self) -> bool:
+        """Go back to the first unacknowledged segment. Returns False once MAX_RETRIES is exceeded."""
+        self.retries += 1
+        self.next_seq = self.base
+        return self.retries <= MAX_RETRIES
+
+class SegmentSender:
+    """
+    Event-driven counterpart of TransportLayer.send_segments, for links with no
+    connection to block on while waiting for acks (see virtual_network): send(frame)
+    transmits one frame, clock.call_later schedules the ack timeouts, and acks
+    arrive through on_ack. on_finish(sender, ok) is called once at the end.
+    """
+
+    def __init__(self, msg_id: int, frames: list, window: int, send, clock, ack_timeout: float, on_finish):
+        self.msg_id = msg_id
+        self.frames = frames
+        self.window = SegmentWindow(len(frames), window)
+        self.send = send
+        self.clock = clock
+        self.ack_timeout = ack_timeout
+        self.on_finish = on_finish
+        # Only the most recently armed timer counts; earlier ones are ignored when they fire.
+        self._timer = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            self._pump()
+
+    def _pump(self):
+        for seq in self.window.sendable():
+            self.send(self.frames[seq])
+        self._timer += 1
+        self.clock.call_later(self.ack_timeout, self._on_timeout, self._timer)
+
+    def on_ack(self, next_seq: int):
+        with self._lock:
+            if not self.window.ack(next_seq):
+                return
+            if not self.window.done:
+                self._pump()
+                return
+        self.on_finish(self, True)
+
+    def _on_timeout(self, timer: int):
+        with self._lock:
+            if timer != self._timer or self.window.done:
+                return
+            if self.window.timeout():
+                self._pump()
+                return
+        logger.warning("[TransportLayer] No ack for message %s after %s retries.", self.msg_id, MAX_RETRIES)
+        self.on_finish(self, False)
+
+class Reassembly:
+    """The segments received so far for one segmented message."""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.segments = {}  # { seq: chunk }
+        self.size = 0
+        # Lowest sequence number not yet received; this is the cumulative ack.
+        self.next_seq = 0
+        self.created = time.monotonic()
+
+class Reassembler:
+    """
+    Collects the segments of messages, in any order, until each is complete.
+
+    Buffered segment bytes are bounded by max_buffer_bytes. To make room for a
+    new segment, partial messages older than timeout are dropped first, then
+    the oldest partial messages; a segment that still does not fit is dropped
+    unacknowledged, so the sender resends it later.
+    """
+
+    def __init__(self, max_buffer_bytes: int = MAX_MESSAGE_SIZE, timeout: float = 30.0,
+                 completed_history: int = 1024):
+        self.max_buffer_bytes = max_buffer_bytes
+        self.timeout = timeout
+        self.buffered = 0
+        self.dropped = 0
+        self._partial = OrderedDict()  # { (sender_ip, msg_id): Reassembly }, oldest first
+        # Recently completed messages and their segment counts, so resent
+        # segments of a finished message are acknowledged instead of buffered.
+        self._completed = OrderedDict()
+        self.completed_history = completed_history
+        self._lock = threading.Lock()
+
+    def add(self, key, seq: int, total: int, chunk) -> Tuple[bytes, int]:
+        """
+        Add segment seq of total for the message key. Returns (payload, ack):
+        payload is the reassembled message once its last missing segment arrives,
+        otherwise None; ack is the cumulative ack (the lowest missing sequence
+        number), or None if the segment was dropped.
+        """
+        if not 0 <= seq < total:
+            raise Exception(f"Invalid segment {seq} of {total}")
+        with self._lock:
+            if key in self._completed:
+                return None, self._completed[key]
+            entry = self._partial.get(key)
+            if entry is None:
+                entry = self._partial[key] = Reassembly(total)
+            elif entry.total != total:
+                raise Exception(f"Segment count changed from {entry.total} to {total}")
+            if seq < entry.next_seq or seq in entry.segments:
+                return None, entry.next_seq
+            if not self._make_room(len(chunk), key):
+                return None, None
+            entry.segments[seq] = chunk
+            entry.size += len(chunk)
+            self.buffered += len(chunk)
+            while entry.next_seq in entry.segments:
+                entry.next_seq += 1
+            if entry.next_seq < total:
+                return None, entry.next_seq
+            del self._partial[key]
+            self.buffered -= entry.size
+            self._completed[key] = total
+            if len(self._completed) > self.completed_history:
+                self._completed.popitem(last=False)
+        return b"".join(entry.segments[i] for i in range(total)), total
+
+    def reset(self):
+        """Forget every partial and recently completed message."""
+        with self._lock:
+            self._partial.clear()
+            self._completed.clear()
+            self.buffered = 0
+
+    def _make_room(self, size: int, keep) -> bool:
+        """Drop partial messages until size more bytes fit. Caller holds the lock."""
+        if self.buffered + size <= self.max_buffer_bytes:
+            return True
+        now = time.monotonic()
+        for key in [key for key, entry in self._partial.items()
+                    if key != keep and now - entry.created > self.timeout]:
+            self._drop(key)
+        for key in list(self._partial):
+            if self.buffered + size <= self.max_buffer_bytes:
+                break
+            if key != keep:
+                self._drop(key)
+        return self.buffered + size <= self.max_buffer_bytes
+
+    def _drop(self, key):
+        entry = self._partial.pop(key)
+        self.buffered -= entry.size
+        self.dropped += 1
+        logger.warning("[TransportLayer] Dropped incomplete message %s from %s (%s of %s segments).",
+                       key[1], key[0], len(entry.segments), entry.total)
+
+class ClientChannel:
+    """
+    Delivers messages to one registered chat client over its registration
+    connection. Messages wait in a bounded queue drained by a writer thread, so
+    a slow client never blocks the threads that receive frames; when the queue
+    is full, new messages for that client are dropped and counted.
+    """
+
+    def __init__(self, port: int, conn: socket.socket, max_queue: int = 1024):
+        self.port = port
+        self.conn = conn
+        self.dropped = 0
+        self.closed = False
+        self._queue = queue.Queue(maxsize=max_queue)
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def send(self, payload: bytes) -> bool:
+        """Queue payload for delivery. Returns False if the channel is closed or full."""
+        if self.closed:
+            return False
+        try:
+            self._queue.put_nowait(payload)
+            return True
+        except queue.Full:
+            self.dropped += 1
+            logger.warning("[TransportLayer] Delivery queue full on port %s; dropped message (%s so far).",
+                           self.port, self.dropped)
+            return False
+
+    def _run(self):
+        while not self.closed:
+            payload = self._queue.get()
+            if payload is None:
+                break
+            try:
+                send_frame(self.conn, payload)
+            except OSError as e:
+                logger.warning("[TransportLayer] Error sending message on port %s: %s", self.port, e)
+                self.closed = True
+
+    def close(self):
+        self.closed = True
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            pass  # The writer sees the closed flag after its current send.
+
 class TransportLayer:
-    def __init__(self):
-        # Registry mapping destination port numbers to connection objects.
+    def __init__(self, segment_size: int = SEGMENT_SIZE, window: int = WINDOW,
+                 ack_timeout: float = ACK_TIMEOUT, max_buffer_bytes: int = MAX_MESSAGE_SIZE):
+        # Registry mapping destination port numbers to client delivery channels.
+        # Messages are addressed by port alone, so a port belongs to one host at a
+        # time: the address of the client that registered it.
         self.port_registry = {}
+        self.port_owners = {}  # { port: client ip }
+        # Payloads longer than segment_size are sent as numbered segments, with at
+        # most window of them unacknowledged at a time.
+        self.segment_size = segment_size
+        self.window = window
+        self.ack_timeout = ack_timeout
+        self.reassembler = Reassembler(max_buffer_bytes=max_buffer_bytes)
+        # A random start keeps message ids from a restarted sender from matching stale partial messages.
+        self._msg_ids = itertools.count(random.getrandbits(32))
+        self._senders = {}  # { msg_id: SegmentSender } for sends waiting on acks
 
-    def register(self, port: int, conn: socket.socket):
-        """Register a client connection for a given port."""
-        self.port_registry[port] = conn
-        print(f"[TransportLayer] Registered connection on port {port}")
+    def register(self, port: int, conn: socket.socket, owner: str = None) -> bool:
+        """
+        Register a client connection for a given port. Returns False if another
+        host's client holds the port (see register_channel).
+        """
+        if self.port_taken(port, owner):
+            logger.warning("[TransportLayer] Port %s is registered by %s; refused %s",
+                           port, self.port_owners.get(port), owner)
+            return False
+        return self.register_channel(port, ClientChannel(port, conn), owner)
+
+    def port_taken(self, port: int, owner: str = None) -> bool:
+        """Whether port is registered by a client on a host other than owner."""
+        return port in self.port_registry and self.port_owners.get(port) != owner
+
+    def register_channel(self, port: int, channel, owner: str = None) -> bool:
+        """
+        Register any channel with send(payload) -> bool, conn and close() for the
+        client at owner. A channel from the same host replaces the previous one (a
+        reconnecting client); one from another host is refused and False returned.
+        """
+        if self.port_taken(port, owner):
+            logger.warning("[TransportLayer] Port %s is registered by %s; refused %s",
+                           port, self.port_owners.get(port), owner)
+            channel.close()
+            return False
+        previous = self.port_registry.get(port)
+        self.port_registry[port] = channel
+        self.port_owners[port] = owner
+        if previous is not None:
+            previous.close()
+        logger.debug("[TransportLayer] Registered connection on port %s", port)
+        return True
 
-    def deregister(self, port: int):
-        """Remove a client connection from the registry."""
-        if port in self.port_registry:
+    def deregister(self, port: int, conn=None):
+        """Remove a client connection from the registry, only if it is conn when given."""
+        channel = self.port_registry.get(port)
+        if channel is not None and (conn is None or channel.conn is conn):
             del self.port_registry[port]
-            print(f"[TransportLayer] Deregistered connection on port {port}")
+            self.port_owners.pop(port, None)
+            channel.close()
+            logger.debug("[TransportLayer] Deregistered connection on port %s", port)
 
     def send_via_registered(self, dest_port: int, message_obj: object) -> bool:
         """
-        Attempt to send a message via a registered connection.
-        Returns True if successful, False otherwise.
+        Attempt to send a message via a registered connection, as one
+        length-prefixed JSON message. Returns True if it was queued for delivery.
         """
-        if dest_port in self.port_registry:
-            conn = self.port_registry[dest_port]
-            try:
-                message_str = json.dumps(message_obj)
-                conn.sendall(message_str.encode('utf-8'))
-                print(f"[TransportLayer] Message routed to registered connection on port {dest_port}.")
-                return True
-            except Exception as e:
-                print(f"[TransportLayer] Error sending message on port {dest_port}: {e}")
-        else:
-            print(f"[TransportLayer] No registered connection for port {dest_port}.")
+        channel = self.port_registry.get(dest_port)
+        if channel is None:
+            logger.debug("[TransportLayer] No registered connection for port %s.", dest_port)
+            return False
+        if channel.send(json.dumps(message_obj).encode('utf-8')):
+            logger.debug("[TransportLayer] Message routed to registered connection on port %s.", dest_port)
+            return True
         return False
-    
+
+    def header(self, dest_port: int) -> bytes:
+        """The text transport header for dest_port."""
+        return f"TRANS_HEADER:{dest_port}|".encode('utf-8')
+
+    def binary_header(self, dest_port: int) -> bytes:
+        """The binary transport header for dest_port."""
+        return TRANS_BINARY_HEADER.pack(dest_port, 0)
+
+    def needs_segmentation(self, size: int) -> bool:
+        return size > self.segment_size
+
+    def segment(self, data: bytes, dest_port: int, binary: bool = False) -> Tuple[int, list]:
+        """
+        Split data into segments of at most segment_size bytes, each with a transport
+        header carrying the message id, its sequence number and the segment count.
+        The segments are PacketBuffers over slices of data, which is not copied.
+        Returns (message id, [segment, ...]).
+        """
+        msg_id = next(self._msg_ids) & 0xFFFFFFFF
+        packet = data if isinstance(data, PacketBuffer) else PacketBuffer(data)
+        chunks = packet.split(self.segment_size)
+        total = len(chunks)
+        segments = []
+        for seq, chunk in enumerate(chunks):
+            if binary:
+                header = (TRANS_BINARY_HEADER.pack(dest_port, FLAG_SEGMENTED)
+                          + TRANS_SEGMENT_HEADER.pack(msg_id, seq, total))
+            else:
+                header = f"TRANS_HEADER:{dest_port},{msg_id},{seq},{total}|".encode('utf-8')
+            segments.append(header + chunk)
+        logger.debug("[TransportLayer] Split %s bytes into %s segments (message %s)", len(data), total, msg_id)
+        return msg_id, segments
+
+    def send_segments(self, conn: socket.socket, msg_id: int, frames: list) -> bool:
+        """
+        Send the frames of one segmented message over conn with a sliding window:
+        at most window frames are unacknowledged at a time, and the receiver's
+        cumulative acks on the same connection move the window forward. After
+        ack_timeout without progress, every unacknowledged frame is sent again.
+        Returns True once the last frame is acknowledged.
+        """
+        window = SegmentWindow(len(frames), self.window)
+        acks = StreamBuffer()
+        conn.settimeout(self.ack_timeout)
+        try:
+            while not window.done:
+                for seq in window.sendable():
+                    send_frame(conn, frames[seq])
+                try:
+                    replies = acks.read_from(conn)
+                except socket.timeout:
+                    if not window.timeout():
+                        logger.warning("[TransportLayer] No ack for message %s after %s retries.", msg_id, MAX_RETRIES)
+                        return False
+                    continue
+                if replies is None:
+                    raise ConnectionResetError("Connection closed while waiting for acks")
+                for reply in replies:
+                    ack = self.parse_ack(reply)
+                    if ack is not None and ack[0] == msg_id:
+                        window.ack(ack[1])
+        finally:
+            conn.settimeout(None)
+        return True
+
+    def start_segments(self, msg_id: int, frames: list, send, clock):
+        """
+        Start sending a segmented message over a link without connections: send(frame)
+        transmits a frame and clock schedules ack timeouts. Acks for it must be
+        passed to handle_ack. Returns immediately.
+        """
+        sender = SegmentSender(msg_id, frames, self.window, send, clock, self.ack_timeout, self._finish_sender)
+        self._senders[msg_id] = sender
+        sender.start()
+
+    def handle_ack(self, data: bytes):
+        """Pass an ack that arrived on its own to the segmented send it belongs to."""
+        ack = self.parse_ack(data)
+        sender = self._senders.get(ack[0]) if ack is not None else None
+        if sender is not None:
+            sender.on_ack(ack[1])
+
+    def _finish_sender(self, sender: SegmentSender, ok: bool):
+        self._senders.pop(sender.msg_id, None)
+
+    @staticmethod
+    def ack_message(msg_id: int, next_seq: int) -> bytes:
+        """A cumulative ack: every segment of msg_id below next_seq has arrived."""
+        return f"TRANS_ACK:{msg_id},{next_seq}".encode('utf-8')
+
+    @staticmethod
+    def parse_ack(data: bytes) -> Tuple[int, int]:
+        """Return (msg_id, next_seq) from an ack, or None if data is not one."""
+        if not data.startswith(b"TRANS_ACK:"):
+            return None
+        try:
+            msg_id, next_seq = data[len(b"TRANS_ACK:"):].split(b",")
+            return int(msg_id), int(next_seq)
+        except ValueError:
+            return None
+
+    def receive_segment(self, sender_ip: str, msg_id: int, seq: int, total: int, chunk, ack=None) -> bytes:
+        """
+        Buffer one segment and acknowledge it with ack(message) when given.
+        Returns the reassembled payload once the message is complete, otherwise None.
+        """
+        payload, next_seq = self.reassembler.add((sender_ip, msg_id), seq, total, chunk)
+        if ack is not None and next_seq is not None:
+            ack(self.ack_message(msg_id, next_seq))
+        return payload
+
     def encapsulate(self, data: bytes, dest_port: int) -> bytes:
         """
         Encapsulate the data with a transport header that includes the destination port.
         This header is prepended to the given bytes data.
         """
-        header = f"TRANS_HEADER:{dest_port}|".encode('utf-8')
-        encapsulated_data = header + data
-        print(f"[TransportLayer] Encapsulated data: {encapsulated_data}")
+        encapsulated_data = self.header(dest_port) + data
+        logger.debug("[TransportLayer] Encapsulated data: %s", encapsulated_data)
         return encapsulated_data
     
-    def decapsulate(self, data: bytes) -> Tuple[bytes, int]:
+    def decapsulate(self, data: bytes, sender_ip: str = None, ack=None) -> Tuple[bytes, int]:
         """
         Decapsulate the transport header from the data.
-        Returns a tuple of the inner data and the destination port.
+        Returns a tuple of the inner data and the destination port. For a segment,
+        the inner data is the reassembled message once it is complete and None
+        until then; ack is called with the ack to send back to the sender.
         """
         decoded = data.decode('utf-8')
         if decoded.startswith("TRANS_HEADER:") and "|" in decoded:
-            # Expected format: "TRANS_HEADER:{dest_port}|{inner_data}"
+            # Expected format: "TRANS_HEADER:{dest_port}|{inner_data}", or
+            # "TRANS_HEADER:{dest_port},{msg_id},{seq},{total}|{segment}" for a segment.
             header_part, inner_part = decoded.split('|', 1)
+            fields = header_part.split(':')[1].split(',')
             try:
-                dest_port = int(header_part.split(':')[1])
+                dest_port = int(fields[0])
             except Exception as e:
-                print(f"[TransportLayer] Error parsing transport header port: {e}")
+                logger.warning("[TransportLayer] Error parsing transport header port: %s", e)
                 dest_port = None
-            print(f"[TransportLayer] Decapsulated data: {inner_part}")
+            if len(fields) == 4:
+                msg_id, seq, total = (int(field) for field in fields[1:])
+                inner = self.receive_segment(sender_ip, msg_id, seq, total, inner_part.encode('utf-8'), ack)
+                return inner, dest_port
+            logger.debug("[TransportLayer] Decapsulated data: %s", inner_part)
             return inner_part.encode('utf-8'), dest_port
         return data, None
 
+    def encapsulate_binary(self, data: bytes, dest_port: int) -> bytes:
+        """Binary counterpart of encapsulate: the destination port as an unsigned short."""
+        header = self.binary_header(dest_port)
+        logger.debug("[TransportLayer] Encapsulated %s bytes (binary)", len(data))
+        return header + data
+
+    def decapsulate_binary(self, data: memoryview, sender_ip: str = None, ack=None) -> Tuple[memoryview, int]:
+        """
+        Parse the binary transport header and return (payload view, dest_port).
+        Segments are handled as in decapsulate.
+        """
+        if len(data) < TRANS_BINARY_HEADER.size:
+            raise Exception("Truncated binary transport header.")
+        dest_port, flags = TRANS_BINARY_HEADER.unpack_from(data)
+        if not flags & FLAG_SEGMENTED:
+            return data[TRANS_BINARY_HEADER.size:], dest_port
+        end = TRANS_BINARY_HEADER.size + TRANS_SEGMENT_HEADER.size
+        if len(data) < end:
+            raise Exception("Truncated binary segment header.")
+        msg_id, seq, total = TRANS_SEGMENT_HEADER.unpack_from(data, TRANS_BINARY_HEADER.size)
+        payload = self.receive_segment(sender_ip, msg_id, seq, total, data[end:], ack)
+        return (memoryview(payload) if payload is not None else None), dest_port
@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger("osi.virtual")
+
+
+class VirtualClock:
+    """
+    Discrete-event clock. Callbacks scheduled with call_later run in time order,
+    and only when run() or advance() moves the clock forward; nothing happens
+    in the background. Time is in seconds and starts at 0.
+    """
+
+    def __init__(self):
+        self._now = 0.0
+        self._events = []  # heap of (when, seq, fn, args)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        return self._now
+
+    def call_later(self, delay: float, fn, *args):
+        with self._lock:
+            heapq.heappush(self._events, (self._now + max(0.0, delay), next(self._seq), fn, args))
+
+    def run(self, until: float = None) -> int:
+        """
+        Run scheduled callbacks in time order until none are left, or until the next
+        one is due after until. Returns the number of callbacks run.
+        """
+        count = 0
+        while True:
+            with self._lock:
+                if not self._events or (until is not None and self._events[0][0] > until):
+                    break
+                when, _, fn, args = heapq.heappop(self._events)
+                self._now = max(self._now, when)
+            _run_callback(fn, args)
+            count += 1
+        if until is not None:
+            self._now = max(self._now, until)
+        return count
+
+    def advance(self, seconds: float) -> int:
+        """Move the clock forward by seconds, running every callback due on the way."""
+        return self.run(self._now + seconds)
+
+    def pending(self) -> int:
+        return len(self._events)
+
+class RealClock:
+    """Runs scheduled callbacks at real (monotonic) times on one timer thread."""
+
+    def __init__(self):
+        self._events = []  # heap of (when, seq, fn, args)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def call_later(self, delay: float, fn, *args):
+        with self._cond:
+            event = (self.now() + max(0.0, delay), next(self._seq), fn, args)
+            heapq.heappush(self._events, event)
+            # The timer thread only needs waking when this is now the earliest event.
+            if self._events[0] is event:
+                self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    if not self._events:
+                        self._cond.wait()
+                        continue
+                    wait = self._events[0][0] - self.now()
+                    if wait <= 0:
+                        break
+                    self._cond.wait(wait)
+                _, _, fn, args = heapq.heappop(self._events)
+            _run_callback(fn, args)
+
+def _run_callback(fn, args):
+    try:
+        fn(*args)
+    except Exception as e:
+        logger.warning("[VirtualSwitch] Error in scheduled callback: %s", e)
+
+class LinkProfile:
+    """
+    Impairments applied to every frame a node sends: one-way latency plus up to
+    jitter seconds of random extra delay, bandwidth in bytes per second (None for
+    unlimited; frames queue behind each other on the sending port), the
+    probability that a frame is lost, and the probability that a frame is held
+    back by reorder_delay so that later frames overtake it.
+    """
+
+    def __init__(self, latency: float = 0.0005, jitter: float = 0.0, bandwidth: float = None,
+                 loss: float = 0.0, reorder: float = 0.0, reorder_delay: float = 0.002):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.loss = loss
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+
+class VirtualLink:
+    """
+    One node's port on a VirtualSwitch. It is the link backend of the node's
+    PhysicalLayer (frames), DataLinkLayer (ARP) and SessionLayer (handshakes).
+    """
+
+    def __init__(self, switch, ip: str, node, mac: str, profile: LinkProfile):
+        self.switch = switch
+        self.ip = ip
+        self.node = node
+        self.mac = mac
+        self.profile = profile
+        # When the port finishes sending the frames already queued on it.
+        self.busy_until = 0.0
+
+    @property
+    def clock(self):
+        return self.switch.clock
+
+    def transmit(self, data, ip_address: str, dest_port: int, stream=None) -> bool:
+        """Send a frame (bytes or a PacketBuffer) to the node at ip_address. stream is not used."""
+        return self.switch.forward(self, ip_address, bytes(data))
+
+    def arp_request(self, ip_address: str) -> str:
+        """Resolve ip_address to the MAC address of the node attached there, or None."""
+        return self.switch.arp_request(ip_address)
+
+    def request(self, ip_address: str, dest_port: int, payload: bytes) -> bytes:
+        """Send a session handshake to ip_address and return its reply, or None."""
+        return self.switch.request(self.ip, ip_address, payload)
+
+class VirtualSwitch:
+    """
+    In-memory switch connecting OSIServer nodes in one process, in place of TCP
+    connections and the ARP UDP listener, so thousands of nodes can run without
+    sockets. Frames reach their destination through the clock, after the sending
+    port's LinkProfile has been applied. ARP requests and session handshakes are
+    answered immediately.
+
+    With a VirtualClock the network only moves when the clock is advanced, which
+    makes runs repeatable for a given seed; the default RealClock delivers frames
+    on a timer thread in real time.
+    """
+
+    def __init__(self, clock=None, profile: LinkProfile = None, seed: int = None):
+        self.clock = clock if clock is not None else RealClock()
+        self.profile = profile if profile is not None else LinkProfile()
+        self.random = random.Random(seed)
+        self.links = {}  # { ip: VirtualLink }
+        self.stats = {"frames": 0, "bytes": 0, "delivered": 0, "lost": 0, "reordered": 0, "unroutable": 0}
+        self._macs = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def attach(self, ip: str, node, profile: LinkProfile = None) -> VirtualLink:
+        """
+        Connect node (an OSIServer) at ip. Frames for ip are passed to
+        node.handle_link_frame and handshakes to node.handle_link_request.
+        """
+        if ip in self.links:
+            raise Exception(f"Address {ip} is already attached to the switch")
+        # Locally administered unicast addresses, one per port.
+        mac = "02:" + next(self._macs).to_bytes(5, "big").hex(":")
+        link = VirtualLink(self, ip, node, mac, profile if profile is not None else self.profile)
+        self.links[ip] = link
+        return link
+
+    def detach(self, ip: str):
+        self.links.pop(ip, None)
+
+    def forward(self, link: VirtualLink, dest_ip: str, frame: bytes) -> bool:
+        """
+        Schedule delivery of frame from link to dest_ip. Returns False if nothing is
+        attached at dest_ip; a frame lost to the link profile still returns True.
+        """
+        if dest_ip not in self.links:
+            self.stats["unroutable"] += 1
+            return False
+        profile = link.profile
+        with self._lock:
+            self.stats["frames"] += 1
+            self.stats["bytes"] += len(frame)
+            if profile.loss and self.random.random() < profile.loss:
+                self.stats["lost"] += 1
+                return True
+            now = self.clock.now()
+            delay = profile.latency
+            if profile.jitter:
+                delay += self.random.uniform(0, profile.jitter)
+            if profile.bandwidth:
+                link.busy_until = max(now, link.busy_until) + len(frame) / profile.bandwidth
+                delay += link.busy_until - now
+            if profile.reorder and self.random.random() < profile.reorder:
+                self.stats["reordered"] += 1
+                delay += profile.reorder_delay
+        self.clock.call_later(delay, self._deliver, link.ip, dest_ip, frame)
+        return True
+
+    def _deliver(self, src_ip: str, dest_ip: str, frame: bytes):
+        dest = self.links.get(dest_ip)
+        if dest is None:
+            self.stats["unroutable"] += 1
+            return
+        self.stats["delivered"] += 1
+        dest.node.handle_link_frame(frame, src_ip)
+
+    def arp_request(self, ip_address: str) -> str:
+        dest = self.links.get(ip_address)
+        if dest is None:
+            return None
+        data_link_layer = dest.node.data_link_layer
+        return data_link_layer.parse_arp_response(data_link_layer.arp_response(b"ARP_REQUEST"))
+
+    def request(self, src_ip: str, dest_ip: str, payload: bytes) -> bytes:
+        dest = self.links.get(dest_ip)
+        if dest is None:
+            return None
+        return dest.node.handle_link_request(payload, src_ip)
+
+class Inbox:
+    """
+    A delivery channel for a virtual node's port (see TransportLayer.register_channel)
+    that keeps the last max_messages messages instead of writing to a client.
+    """
+
+    def __init__(self, port: int, max_messages: int = 1000):
+        self.port = port
+        self.conn = None
+        self.received = 0
+        self.max_messages = max_messages
+        self.messages = []
+
+    def send(self, payload: bytes) -> bool:
+        self.received += 1
+        self.messages.append(payload)
+        if len(self.messages) > self.max_messages:
+            del self.messages[0]
+        return True
+
+    def close(self):
+        pass
@@ -0,0 +1,129 @@
+import collections
+import json
+import random
+import struct
+import zlib
+
+from application_layer import ApplicationLayer
+
+# A dictionary file: magic, dictionary id, then the dictionary bytes.
+DICTIONARY_HEADER = struct.Struct("!4sH")
+DICTIONARY_MAGIC = b"ZDCT"
+# Dictionaries past deflate's 32 KB window are never fully used.
+MAX_DICTIONARY_SIZE = 32 * 1024
+DEFAULT_DICTIONARY_SIZE = 4096
+# Substring lengths counted when building a dictionary.
+SUBSTRING_LENGTHS = (4, 6, 8, 12, 16, 24, 32)
+
+class CompressionDictionary:
+    """
+    A zlib preset dictionary (zdict) and its id. Payloads are compressed as raw
+    deflate streams with a window just large enough for the dictionary, so the
+    compressor is cheap to set up; each message starts from a copy of a
+    compressor already primed with the dictionary. Decompression always uses the
+    full window, which accepts any smaller one.
+    """
+
+    def __init__(self, dict_id: int, data: bytes, level: int = 6):
+        if len(data) > MAX_DICTIONARY_SIZE:
+            raise ValueError(f"Dictionary larger than {MAX_DICTIONARY_SIZE} bytes")
+        self.id = dict_id
+        self.data = data
+        wbits = min(15, max(9, (len(data) - 1).bit_length()))
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, -wbits, 4, zlib.Z_DEFAULT_STRATEGY, data)
+
+    def compress(self, raw: bytes) -> bytes:
+        compressor = self._compressor.copy()
+        return compressor.compress(raw) + compressor.flush()
+
+    def decompress(self, body) -> bytes:
+        decompressor = zlib.decompressobj(-15, zdict=self.data)
+        raw = decompressor.decompress(body) + decompressor.flush()
+        if not decompressor.eof:
+            raise Exception("Truncated dictionary-compressed payload.")
+        return raw
+
+def load_dictionary(path: str) -> CompressionDictionary:
+    with open(path, "rb") as f:
+        content = f.read()
+    magic, dict_id = DICTIONARY_HEADER.unpack_from(content)
+    if magic != DICTIONARY_MAGIC:
+        raise Exception(f"Not a compression dictionary: {path}")
+    return CompressionDictionary(dict_id, content[DICTIONARY_HEADER.size:])
+
+def save_dictionary(path: str, dict_id: int, data: bytes):
+    with open(path, "wb") as f:
+        f.write(DICTIONARY_HEADER.pack(DICTIONARY_MAGIC, dict_id) + data)
+
+def build_dictionary(samples: list, size: int = DEFAULT_DICTIONARY_SIZE) -> bytes:
+    """
+    Build a dictionary of at most size bytes from sample payloads. Substrings are
+    scored by the number of samples containing them times the bytes they would
+    save, and the best are taken greedily, skipping any already covered by a
+    longer one. The best end up last, where deflate reaches them most cheaply.
+    """
+    counts = collections.Counter()
+    for sample in samples:
+        seen = set()
+        for length in SUBSTRING_LENGTHS:
+            for start in range(len(sample) - length + 1):
+                seen.add(sample[start:start + length])
+        counts.update(seen)
+    # A substring must repeat across samples to be worth a place.
+    candidates = sorted(((count * (len(substring) - 3), substring) for substring, count in counts.items()
+                         if count > 1), reverse=True)
+    chosen = []
+    covered = set()  # every counted substring of the chosen pieces
+    total = 0
+    for _, substring in candidates:
+        if total + len(substring) > size or substring in covered:
+            continue
+        chosen.append(substring)
+        total += len(substring)
+        for length in SUBSTRING_LENGTHS:
+            for start in range(len(substring) - length + 1):
+                covered.add(substring[start:start + length])
+        if total >= size - SUBSTRING_LENGTHS[0]:
+            break
+    return b"".join(reversed(chosen))
+
+def read_capture(path: str, encoding: str = "json") -> list:
+    """
+    Application payloads, in the given application encoding, from a capture of
+    chat messages, one JSON object per line.
+    """
+    app_layer = ApplicationLayer(encoding=encoding)
+    samples = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                samples.append(app_layer.encapsulate(json.loads(line)))
+    return samples
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Build a presentation-layer compression dictionary from captured chat messages.")
+    parser.add_argument("capture", help="chat messages, one JSON object per line")
+    parser.add_argument("--output", "-o", required=True, help="dictionary file to write")
+    parser.add_argument("--id", type=int, required=True,
+                        help="dictionary id (0-65535) carried in every payload compressed with it")
+    parser.add_argument("--size", type=int, default=DEFAULT_DICTIONARY_SIZE,
+                        help="dictionary size in bytes (up to 32768; larger is slower to compress with)")
+    parser.add_argument("--app-encoding", choices=("json", "binary"), default="json",
+                        help="application encoding the servers using the dictionary send with")
+    parser.add_argument("--max-samples", type=int, default=5000, help="use at most this many messages")
+    args = parser.parse_args()
+    if not 0 <= args.id <= 0xFFFF:
+        parser.error("--id must be between 0 and 65535")
+    if not 0 < args.size <= MAX_DICTIONARY_SIZE:
+        parser.error(f"--size must be between 1 and {MAX_DICTIONARY_SIZE}")
+    samples = read_capture(args.capture, args.app_encoding)
+    if len(samples) > args.max_samples:
+        samples = random.sample(samples, args.max_samples)
+    data = build_dictionary(samples, args.size)
+    save_dictionary(args.output, args.id, data)
+    print(f"Wrote {len(data)}-byte dictionary {args.id} from {len(samples)} messages to {args.output}")
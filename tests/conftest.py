@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The osi modules import each other as top-level modules (osi_server.py is run
+# as a script), so the tests put the osi directory on the path the same way.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osi"))
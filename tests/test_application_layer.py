@@ -0,0 +1,71 @@
+import json
+
+import pytest
+
+from application_layer import APP_BINARY_MAGIC, APP_JSON_HEADER, ApplicationLayer
+
+MESSAGE = {
+    "sender": "alice",
+    "content": "hello, wörld",
+    "timestamp": "2024-05-01 12:34:56",
+    "destination": "10.0.0.3",
+    "dest_port": 4000,
+}
+
+def round_trip(message):
+    encoded = ApplicationLayer(encoding="binary").encapsulate(message)
+    return encoded, ApplicationLayer().decode(encoded)
+
+def test_chat_message_round_trips_in_binary():
+    encoded, decoded = round_trip(MESSAGE)
+    assert encoded[0] == APP_BINARY_MAGIC
+    assert decoded == MESSAGE
+    assert len(encoded) < len(json.dumps(MESSAGE))
+
+@pytest.mark.parametrize("fields", [
+    ("content",),
+    ("sender", "content"),
+    ("destination", "dest_port"),
+    (),
+])
+def test_partial_messages_round_trip(fields):
+    message = {field: MESSAGE[field] for field in fields}
+    encoded, decoded = round_trip(message)
+    assert encoded[0] == APP_BINARY_MAGIC
+    assert decoded == message
+
+def test_integer_timestamp_round_trips():
+    message = dict(MESSAGE, timestamp=1714566896)
+    assert round_trip(message)[1] == message
+
+def test_empty_content_round_trips():
+    message = dict(MESSAGE, content="")
+    assert round_trip(message)[1] == message
+
+@pytest.mark.parametrize("message", [
+    dict(MESSAGE, extra="field"),
+    dict(MESSAGE, timestamp="yesterday"),
+    dict(MESSAGE, destination="example.com"),
+    dict(MESSAGE, dest_port=70000),
+    dict(MESSAGE, sender="x" * 256),
+    dict(MESSAGE, content=None),
+    ["not", "a", "dict"],
+])
+def test_messages_outside_schema_fall_back_to_json(message):
+    encoded, decoded = round_trip(message)
+    assert encoded.startswith(APP_JSON_HEADER)
+    assert decoded == message
+
+def test_json_encoding_round_trips():
+    encoded = ApplicationLayer().encapsulate(MESSAGE)
+    assert encoded.startswith(APP_JSON_HEADER)
+    assert ApplicationLayer(encoding="binary").decode(encoded) == MESSAGE
+
+def test_truncated_binary_payload_is_rejected():
+    encoded = ApplicationLayer(encoding="binary").encapsulate({"sender": "alice", "dest_port": 4000})
+    with pytest.raises(Exception, match="Truncated"):
+        ApplicationLayer().decode(encoded[:-1])
+
+def test_unknown_encoding_is_rejected():
+    with pytest.raises(ValueError):
+        ApplicationLayer(encoding="xml")
@@ -0,0 +1,54 @@
+from capture import CAPTURE_IN, CAPTURE_OUT, RECORD_HEADER, CaptureReader, FrameCapture
+from packet_buffer import PacketBuffer
+
+def frames_in(path):
+    reader = CaptureReader(path)
+    try:
+        return [(direction, bytes(frame)) for _, direction, frame in reader.records()]
+    finally:
+        reader.close()
+
+def test_records_are_read_back_in_order(tmp_path):
+    path = str(tmp_path / "capture")
+    capture = FrameCapture(path, ring_size=1024, ip="10.0.0.1", mac="02:00:00:00:00:01")
+    capture.record(CAPTURE_IN, b"first")
+    capture.record(CAPTURE_OUT, PacketBuffer(b"body").prepend(b"head:"))
+    capture.close()
+    reader = CaptureReader(path)
+    assert (reader.ip, reader.mac) == ("10.0.0.1", "02:00:00:00:00:01")
+    reader.close()
+    assert frames_in(path) == [(CAPTURE_IN, b"first"), (CAPTURE_OUT, b"head:body")]
+
+def test_ring_keeps_most_recent_frames_after_wrapping(tmp_path):
+    path = str(tmp_path / "capture")
+    # Room for exactly four 50-byte frames.
+    capture = FrameCapture(path, ring_size=4 * (RECORD_HEADER.size + 50))
+    frames = [bytes([i]) * 50 for i in range(10)]
+    for frame in frames:
+        capture.record(CAPTURE_IN, frame)
+    stats = capture.stats()
+    capture.close()
+    assert stats == {"written": 10, "overwritten": 6, "skipped": 0, "records": 4}
+    assert frames_in(path) == [(CAPTURE_IN, frame) for frame in frames[-4:]]
+
+def test_ring_wraps_frames_of_varying_size(tmp_path):
+    path = str(tmp_path / "capture")
+    capture = FrameCapture(path, ring_size=200)
+    frames = [bytes([i]) * (10 + i * 7 % 60) for i in range(40)]
+    for i, frame in enumerate(frames):
+        capture.record(CAPTURE_IN, frame)
+        recorded = frames_in(path)
+        assert recorded
+        # Whatever was evicted, the ring holds the newest frames, oldest first.
+        assert recorded == [(CAPTURE_IN, f) for f in frames[i + 1 - len(recorded):i + 1]]
+        assert sum(RECORD_HEADER.size + len(f) for _, f in recorded) <= 200
+    capture.close()
+
+def test_frame_larger_than_ring_is_skipped(tmp_path):
+    path = str(tmp_path / "capture")
+    capture = FrameCapture(path, ring_size=100)
+    capture.record(CAPTURE_IN, b"kept")
+    capture.record(CAPTURE_IN, b"x" * 100)
+    assert capture.stats()["skipped"] == 1
+    capture.close()
+    assert frames_in(path) == [(CAPTURE_IN, b"kept")]
@@ -0,0 +1,88 @@
+import pytest
+
+from network_layer import IP_BINARY_HEADER, IP_BINARY_VERSION, NetworkLayer, RoutingTable
+
+def test_longest_prefix_wins():
+    routes = RoutingTable()
+    routes.add_route("10.0.0.0/8", "192.168.0.1")
+    routes.add_route("10.1.0.0/16", "192.168.0.2")
+    routes.add_route("10.1.2.0/24", "192.168.0.3")
+    assert routes.lookup("10.9.9.9") == "192.168.0.1"
+    assert routes.lookup("10.1.9.9") == "192.168.0.2"
+    assert routes.lookup("10.1.2.9") == "192.168.0.3"
+    assert routes.lookup("11.0.0.1") is None
+
+def test_host_and_default_routes():
+    routes = RoutingTable()
+    routes.add_route("0.0.0.0/0", "192.168.0.254")
+    routes.add_route("10.1.2.3", "192.168.0.5")
+    assert routes.lookup("10.1.2.3") == "192.168.0.5"
+    assert routes.lookup("10.1.2.4") == "192.168.0.254"
+
+def test_directly_connected_route_returns_destination():
+    routes = RoutingTable()
+    routes.add_route("10.0.0.0/8", "192.168.0.1")
+    routes.add_route("10.1.0.0/16")
+    assert routes.lookup("10.1.2.3") == "10.1.2.3"
+
+def test_removed_route_falls_back_to_shorter_prefix():
+    routes = RoutingTable()
+    routes.add_route("10.0.0.0/8", "192.168.0.1")
+    routes.add_route("10.1.0.0/16", "192.168.0.2")
+    routes.remove_route("10.1.0.0/16")
+    assert routes.lookup("10.1.2.3") == "192.168.0.1"
+    assert len(routes) == 1
+
+def test_invalid_prefix_length_is_rejected():
+    with pytest.raises(ValueError):
+        RoutingTable().add_route("10.0.0.0/33", "192.168.0.1")
+
+def test_next_hop_without_route_is_destination():
+    network = NetworkLayer("10.0.0.1")
+    network.routes.add_route("10.2.0.0/16", "10.0.0.2")
+    assert network.next_hop("10.2.3.4") == "10.0.0.2"
+    assert network.next_hop("10.3.3.4") == "10.3.3.4"
+
+def forwarded_packets():
+    packets = []
+    return packets, lambda packet, dest_ip: packets.append((bytes(packet), dest_ip))
+
+def test_text_packet_is_forwarded_with_decremented_ttl():
+    router = NetworkLayer("10.0.0.2")
+    packets, forward = forwarded_packets()
+    assert router.decapsulate(b"IP_HEADER:10.0.0.1,10.0.0.3,5|data", forward) == (None, "10.0.0.1")
+    assert packets == [(b"IP_HEADER:10.0.0.1,10.0.0.3,4|data", "10.0.0.3")]
+
+def test_text_packet_with_expired_ttl_is_dropped():
+    router = NetworkLayer("10.0.0.2")
+    packets, forward = forwarded_packets()
+    with pytest.raises(Exception, match="TTL expired"):
+        router.decapsulate(b"IP_HEADER:10.0.0.1,10.0.0.3,1|data", forward)
+    assert packets == []
+
+def test_text_packet_for_us_is_not_forwarded_whatever_its_ttl():
+    host = NetworkLayer("10.0.0.3")
+    assert host.decapsulate(b"IP_HEADER:10.0.0.1,10.0.0.3,1|data") == (b"data", "10.0.0.1")
+
+def test_binary_packet_is_forwarded_with_decremented_ttl():
+    sender = NetworkLayer("10.0.0.1", ttl=2)
+    router = NetworkLayer("10.0.0.2")
+    packets, forward = forwarded_packets()
+    packet = sender.encapsulate_binary(b"data", "10.0.0.3")
+    assert router.decapsulate_binary(memoryview(packet), forward) == (None, "10.0.0.1")
+    [(forwarded, dest_ip)] = packets
+    assert dest_ip == "10.0.0.3"
+    assert IP_BINARY_HEADER.unpack_from(forwarded)[3] == 1
+    assert forwarded[IP_BINARY_HEADER.size:] == b"data"
+    with pytest.raises(Exception, match="TTL expired"):
+        router.decapsulate_binary(memoryview(forwarded), forward)
+
+def test_binary_packet_of_other_version_is_rejected():
+    packet = bytearray(NetworkLayer("10.0.0.1").encapsulate_binary(b"data", "10.0.0.3"))
+    packet[0] = IP_BINARY_VERSION + 1
+    with pytest.raises(Exception, match="Unsupported binary IP header version"):
+        NetworkLayer("10.0.0.3").decapsulate_binary(memoryview(packet))
+
+def test_packet_for_other_host_without_forward_is_rejected():
+    with pytest.raises(Exception, match="not addressed to us"):
+        NetworkLayer("10.0.0.2").decapsulate(b"IP_HEADER:10.0.0.1,10.0.0.3,5|data")
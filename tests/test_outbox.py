@@ -0,0 +1,99 @@
+import os
+
+from outbox import RECORD_HEADER, SEGMENT_SUFFIX, OutboxLog
+
+SEGMENT_SIZE = 4096
+MAX_BYTES = 1024 * 1024
+
+def payloads(log, limit=100):
+    return [(dest_port, src_port, bytes(payload)) for dest_port, src_port, payload in log.read(limit)]
+
+def segment_files(directory):
+    return sorted(name for name in os.listdir(directory) if name.endswith(SEGMENT_SUFFIX))
+
+def test_records_survive_reopen(tmp_path):
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    for i in range(3):
+        assert log.append(4000 + i, 5000, b"message %d" % i)
+    log.close()
+
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    assert log.pending()
+    assert payloads(log) == [(4000 + i, 5000, b"message %d" % i) for i in range(3)]
+    log.close()
+
+def test_cursor_survives_reopen(tmp_path):
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    for i in range(3):
+        log.append(4000, 5000, b"message %d" % i)
+    log.advance(2)
+    log.close()
+
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    assert payloads(log) == [(4000, 5000, b"message 2")]
+    log.advance(1)
+    assert not log.pending()
+    log.close()
+
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    assert not log.pending()
+    assert payloads(log) == []
+    log.close()
+
+def test_torn_record_is_discarded_on_reopen(tmp_path):
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    log.append(4000, 5000, b"complete")
+    offset = log.tail_offset
+    log.append(4000, 5000, b"torn")
+    log.close()
+    # A crash part way through the second record leaves its payload corrupt.
+    path = os.path.join(str(tmp_path), segment_files(str(tmp_path))[-1])
+    with open(path, "r+b") as f:
+        f.seek(offset + RECORD_HEADER.size)
+        f.write(b"XXXX")
+
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    assert payloads(log) == [(4000, 5000, b"complete")]
+    # The next record goes where the torn one was.
+    log.append(4000, 5000, b"after")
+    assert payloads(log) == [(4000, 5000, b"complete"), (4000, 5000, b"after")]
+    log.close()
+
+def test_records_span_segments_across_reopen(tmp_path):
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    payload = b"x" * 1500
+    for _ in range(5):
+        log.append(4000, 5000, payload)
+    assert len(segment_files(str(tmp_path))) > 1
+    log.advance(3)
+    log.close()
+
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    assert payloads(log) == [(4000, 5000, payload)] * 2
+    log.close()
+
+def test_segments_behind_cursor_are_removed_on_reopen(tmp_path):
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    payload = b"x" * 3000
+    for _ in range(3):
+        log.append(4000, 5000, payload)
+    first = segment_files(str(tmp_path))[0]
+    log.advance(2)
+    log.close()
+    # A crash between saving the cursor and deleting old segments leaves them behind.
+    with open(os.path.join(str(tmp_path), first), "wb") as f:
+        f.truncate(SEGMENT_SIZE)
+
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, MAX_BYTES)
+    assert first not in segment_files(str(tmp_path))
+    assert payloads(log) == [(4000, 5000, payload)]
+    log.close()
+
+def test_append_over_max_bytes_is_rejected(tmp_path):
+    log = OutboxLog(str(tmp_path), SEGMENT_SIZE, 2 * SEGMENT_SIZE)
+    payload = b"x" * 3000
+    assert log.append(4000, 5000, payload)
+    assert log.append(4000, 5000, payload)
+    assert not log.append(4000, 5000, payload)
+    assert log.stats()["rejected"] == 1
+    log.close()
@@ -0,0 +1,104 @@
+import pytest
+
+from transport_layer import MAX_RETRIES, Reassembler, SegmentWindow
+
+KEY = ("10.0.0.1", 7)
+
+def test_reassembles_segments_in_order():
+    reassembler = Reassembler()
+    assert reassembler.add(KEY, 0, 3, b"ab") == (None, 1)
+    assert reassembler.add(KEY, 1, 3, b"cd") == (None, 2)
+    assert reassembler.add(KEY, 2, 3, b"ef") == (b"abcdef", 3)
+    assert reassembler.buffered == 0
+
+def test_out_of_order_segments_ack_lowest_missing():
+    reassembler = Reassembler()
+    assert reassembler.add(KEY, 2, 3, b"ef") == (None, 0)
+    assert reassembler.add(KEY, 1, 3, b"cd") == (None, 0)
+    assert reassembler.buffered == 4
+    assert reassembler.add(KEY, 0, 3, b"ab") == (b"abcdef", 3)
+
+def test_duplicate_segment_is_acked_not_buffered():
+    reassembler = Reassembler()
+    reassembler.add(KEY, 0, 3, b"ab")
+    reassembler.add(KEY, 2, 3, b"ef")
+    assert reassembler.add(KEY, 0, 3, b"ab") == (None, 1)
+    assert reassembler.add(KEY, 2, 3, b"ef") == (None, 1)
+    assert reassembler.buffered == 4
+    assert reassembler.add(KEY, 1, 3, b"cd") == (b"abcdef", 3)
+
+def test_resent_segment_of_completed_message_is_acked():
+    reassembler = Reassembler()
+    reassembler.add(KEY, 0, 2, b"ab")
+    reassembler.add(KEY, 1, 2, b"cd")
+    assert reassembler.add(KEY, 1, 2, b"cd") == (None, 2)
+    assert reassembler.buffered == 0
+
+def test_messages_from_different_keys_are_kept_apart():
+    reassembler = Reassembler()
+    other = ("10.0.0.2", 7)
+    reassembler.add(KEY, 0, 2, b"ab")
+    reassembler.add(other, 0, 2, b"xy")
+    assert reassembler.add(other, 1, 2, b"z") == (b"xyz", 2)
+    assert reassembler.add(KEY, 1, 2, b"cd") == (b"abcd", 2)
+
+def test_invalid_sequence_number_and_changed_count_are_rejected():
+    reassembler = Reassembler()
+    with pytest.raises(Exception, match="Invalid segment"):
+        reassembler.add(KEY, 3, 3, b"ab")
+    reassembler.add(KEY, 0, 3, b"ab")
+    with pytest.raises(Exception, match="Segment count changed"):
+        reassembler.add(KEY, 1, 4, b"cd")
+
+def test_full_buffer_evicts_oldest_partial_message():
+    reassembler = Reassembler(max_buffer_bytes=4)
+    other = ("10.0.0.2", 7)
+    reassembler.add(KEY, 0, 2, b"abc")
+    assert reassembler.add(other, 0, 2, b"xy") == (None, 1)
+    assert reassembler.dropped == 1
+    assert reassembler.buffered == 2
+    # The evicted message starts over when its segments are resent.
+    assert reassembler.add(KEY, 1, 2, b"d") == (None, 0)
+
+def test_segment_larger_than_buffer_is_dropped_unacked():
+    reassembler = Reassembler(max_buffer_bytes=4)
+    assert reassembler.add(KEY, 0, 2, b"abcde") == (None, None)
+    assert reassembler.buffered == 0
+
+def test_window_limits_segments_in_flight():
+    window = SegmentWindow(total=5, window=2)
+    assert list(window.sendable()) == [0, 1]
+    assert list(window.sendable()) == []
+    assert window.ack(1)
+    assert list(window.sendable()) == [2]
+
+def test_stale_ack_does_not_move_window():
+    window = SegmentWindow(total=5, window=2)
+    window.sendable()
+    window.ack(2)
+    assert not window.ack(1)
+    assert not window.ack(2)
+    assert window.base == 2
+
+def test_timeout_resends_from_first_unacked_segment():
+    window = SegmentWindow(total=5, window=3)
+    assert list(window.sendable()) == [0, 1, 2]
+    window.ack(1)
+    assert window.timeout()
+    assert list(window.sendable()) == [1, 2, 3]
+
+def test_ack_resets_retries_and_finishes_window():
+    window = SegmentWindow(total=3, window=3)
+    window.sendable()
+    window.timeout()
+    window.ack(5)
+    assert window.retries == 0
+    assert window.base == 3
+    assert window.done
+
+def test_window_gives_up_after_max_retries():
+    window = SegmentWindow(total=2, window=2)
+    window.sendable()
+    for _ in range(MAX_RETRIES):
+        assert window.timeout()
+    assert not window.timeout()